@@ -0,0 +1,85 @@
+"""Time the bulk NDJSON importer against one POST /novels/ style insert per novel.
+
+    python benchmarks/bulk_import.py --novels 100000 --words 2000
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+from bulk_import import import_file  # noqa: E402
+from chapters import write_chapters  # noqa: E402
+from database import connect  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+
+WORDS = ("the night river came down from the hills and every lantern in the village "
+         "went out one by one while she counted the boats").split()
+
+
+def write_corpus(path, novels, words, seed=3):
+    rng = random.Random(seed)
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as f:
+        for i in range(novels):
+            body = " ".join(rng.choices(WORDS, k=words))
+            record = {"title": f"Novel {i}", "description": "Imported", "content": f"Chapter 1\n\n{body}\n"}
+            f.write(json.dumps(record) + "\n")
+
+
+def fresh_db(path):
+    db = connect(path)
+    run_migrations(db)
+    db.execute("INSERT INTO users (username, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+    db.commit()
+    return db
+
+
+def one_by_one(db, path, limit):
+    # What a client looping over POST /novels/ costs the database, one commit per novel
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for count, line in enumerate(f):
+            if count == limit:
+                break
+            record = json.loads(line)
+            cursor = db.execute("INSERT INTO novels (title, description, user_id) VALUES (?, ?, 1)",
+                                (record["title"], record["description"]))
+            write_chapters(db, cursor.lastrowid, record["content"])
+            db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--novels", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=2000, help="words per novel")
+    parser.add_argument("--baseline", type=int, default=2000, help="novels inserted one by one for comparison")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = os.path.join(tmp, "novels.ndjson.gz")
+        write_corpus(corpus, args.novels, args.words)
+
+        db = fresh_db(os.path.join(tmp, "baseline.db"))
+        started = time.perf_counter()
+        one_by_one(db, corpus, args.baseline)
+        baseline = min(args.baseline, args.novels) / (time.perf_counter() - started)
+        db.close()
+
+        db = fresh_db(os.path.join(tmp, "bulk.db"))
+        started = time.perf_counter()
+        report = import_file(db, corpus, 1)
+        elapsed = time.perf_counter() - started
+        db.close()
+
+    print(f"one by one  {baseline:8.0f} novels/s")
+    print(f"bulk import {report['imported'] / elapsed:8.0f} novels/s  "
+          f"({report['imported']} novels in {elapsed:.1f}s, {report['failed']} failed)")
+    print(f"100k novels would take {100000 / (report['imported'] / elapsed) / 60:.1f} min")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Check that a write in one serve.py worker reaches the caches of every other.
+
+Starts the app with several workers, caches a novel's detail response and
+the first catalog page in all of them, then updates the novel round after
+round. Right after each update returns, a burst of reads on fresh
+connections, which the kernel spreads over the workers, must all see the
+new title. The same is checked for a token revoked by logging out.
+
+    python benchmarks/coherence.py --workers 4 --rounds 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from harness import free_port, percentile, start_server, stop_server
+
+PASSWORD = "coherence-password"
+
+
+async def burst(base_url, count, request):
+    # No keep-alive, so every request is a new connection the kernel may hand to any worker
+    async with httpx.AsyncClient(base_url=base_url, timeout=30,
+                                 limits=httpx.Limits(max_keepalive_connections=0)) as http:
+        return await asyncio.gather(*(request(http) for _ in range(count)))
+
+
+async def check(base_url, rounds, reads):
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+        await http.post("/users/", json={"username": "writer", "password": PASSWORD, "email": "writer@example.com"})
+        login = (await http.post("/login/", params={"username": "writer", "password": PASSWORD})).json()
+        token = login["token"]
+        novel = {"title": "Round 0", "description": "Coherence check", "content": "Chapter 1\n\nOnce."}
+        (await http.post("/novels/", params={"token": token}, json=novel)).raise_for_status()
+        novel_id = (await http.get("/novels/")).json()["items"][-1]["id"]
+
+        async def title(client):
+            started = time.perf_counter()
+            detail = (await client.get(f"/novels/{novel_id}/")).json()["title"]
+            listed = next(item["title"] for item in (await client.get("/novels/")).json()["items"]
+                          if item["id"] == novel_id)
+            return detail, listed, (time.perf_counter() - started) * 1000
+
+        stale = 0
+        latencies = []
+        await burst(base_url, reads, title)
+        for number in range(1, rounds + 1):
+            novel["title"] = f"Round {number}"
+            (await http.put(f"/novels/{novel_id}/", params={"token": token}, json=novel)).raise_for_status()
+            for detail, listed, elapsed in await burst(base_url, reads, title):
+                stale += (detail, listed) != (novel["title"], novel["title"])
+                latencies.append(elapsed)
+
+        # Every worker caches the verified token, then one of them revokes it
+        async def like(client):
+            return (await client.post("/novels/like/", params={"token": token}, json={"novel_id": novel_id})).status_code
+
+        await burst(base_url, reads, like)
+        (await http.post("/logout/", params={"token": token, "refresh_token": login["refresh_token"]})).raise_for_status()
+        accepted = sum(status != 401 for status in await burst(base_url, reads, like))
+    return stale, accepted, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=32, help="reads right after every update")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        server = start_server(os.path.join(tmp, "coherence.db"), port, workers=args.workers)
+        try:
+            stale, accepted, latencies = asyncio.run(check(f"http://127.0.0.1:{port}", args.rounds, args.reads))
+        finally:
+            stop_server(server)
+
+    print(f"{args.workers} workers, {args.rounds} updates, {args.reads} reads after each")
+    print(f"stale reads          {stale} of {args.rounds * args.reads}")
+    print(f"revoked token taken  {accepted} of {args.reads}")
+    print(f"read latency         p50 {percentile(latencies, 50):.2f} ms  p99 {percentile(latencies, 99):.2f} ms")
+    if stale or accepted:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Report stored size and read latency of chapter text per compression setting.
+
+Builds one database per setting from the same synthetic corpus, then
+reads random novels in full (the detail endpoint) and random single
+chapters (the chapter endpoint).
+
+    python benchmarks/compression.py --novels 200 --words 40000 --reads 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+import compression  # noqa: E402
+from chapters import read_content, write_chapters  # noqa: E402
+from database import connect  # noqa: E402
+from harness import percentile  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+
+# (label, zlib level), None stores plain text
+SETTINGS = (("plain", None), ("zlib-1", 1), ("zlib-6", 6), ("zlib-9", 9))
+
+
+def synthetic_novel(rng, vocabulary, weights, words):
+    """Chapters of Zipf distributed words, shaped like prose."""
+    parts = []
+    chapter = 1
+    while words > 0:
+        parts.append(f"Chapter {chapter}\n\n")
+        for _ in range(rng.randint(20, 40)):
+            sentence_count = rng.randint(3, 8)
+            sentences = []
+            for _ in range(sentence_count):
+                sentence = rng.choices(vocabulary, weights, k=rng.randint(6, 20))
+                sentences.append(" ".join(sentence).capitalize() + ".")
+                words -= len(sentence)
+            parts.append(" ".join(sentences) + "\n\n")
+        chapter += 1
+    return "".join(parts)
+
+
+def corpus(novels, words, seed=7):
+    rng = random.Random(seed)
+    letters = "etaoinshrdlucmfwypvbgkjqxz"
+    vocabulary = sorted({
+        "".join(rng.choices(letters, weights=range(26, 0, -1), k=rng.randint(2, 10))) for _ in range(8000)
+    })
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    return [synthetic_novel(rng, vocabulary, weights, words) for _ in range(novels)]
+
+
+def measure(path, texts, level, reads):
+    min_bytes = compression.MIN_COMPRESS_BYTES
+    if level is None:
+        compression.MIN_COMPRESS_BYTES = float("inf")
+    else:
+        compression.LEVEL = level
+    try:
+        db = connect(path)
+        run_migrations(db)
+        started = time.perf_counter()
+        for text in texts:
+            cursor = db.execute("INSERT INTO novels (title, description, user_id) VALUES ('t', 'd', 1)")
+            write_chapters(db, cursor.lastrowid, text)
+            db.commit()
+        write_seconds = time.perf_counter() - started
+    finally:
+        compression.MIN_COMPRESS_BYTES = min_bytes
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    stored = db.execute("SELECT SUM(length(CAST(content AS BLOB))) FROM novel_chapters").fetchone()[0]
+    file_size = os.path.getsize(path)
+
+    rng = random.Random(11)
+    novel_ids = [row[0] for row in db.execute("SELECT id FROM novels")]
+    chapter_ids = [row[0] for row in db.execute("SELECT id FROM novel_chapters")]
+    full, single = [], []
+    for _ in range(reads):
+        started = time.perf_counter()
+        read_content(db, rng.choice(novel_ids))
+        full.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        db.execute("SELECT novel_text(content) FROM novel_chapters WHERE id = ?", (rng.choice(chapter_ids),)).fetchone()
+        single.append((time.perf_counter() - started) * 1000)
+    db.close()
+    return stored, file_size, write_seconds, full, single
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--novels", type=int, default=200)
+    parser.add_argument("--words", type=int, default=40000, help="approximate words per novel")
+    parser.add_argument("--reads", type=int, default=2000)
+    args = parser.parse_args()
+
+    texts = corpus(args.novels, args.words)
+    raw = sum(len(text.encode("utf-8")) for text in texts)
+    print(f"corpus: {args.novels} novels, {raw / 2**20:.1f} MiB of text")
+    print(f"{'setting':8} {'stored MiB':>10} {'ratio':>6} {'file MiB':>9} {'write s':>8} "
+          f"{'full p50':>9} {'full p99':>9} {'chap p50':>9} {'chap p99':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, level in SETTINGS:
+            stored, file_size, write_seconds, full, single = measure(
+                os.path.join(tmp, f"{label}.db"), texts, level, args.reads
+            )
+            print(f"{label:8} {stored / 2**20:10.1f} {raw / stored:6.2f} {file_size / 2**20:9.1f} "
+                  f"{write_seconds:8.2f} {statistics.median(full):8.2f}ms {percentile(full, 99):7.2f}ms "
+                  f"{statistics.median(single):7.3f}ms {percentile(single, 99):7.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Compare the pooled WAL connection manager with opening a connection per request.
+
+Each simulated request does what a handler does: borrow a connection, run
+a novel lookup (or a like insert on every Nth request) and give it back.
+
+    python benchmarks/connection_pool.py --threads 16 --requests 20000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+from database import ConnectionPool, connect  # noqa: E402
+
+
+def seed(path, novels):
+    db = connect(path)
+    db.executescript("""
+        CREATE TABLE novels (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL,
+                             description TEXT, content TEXT, user_id INTEGER);
+        CREATE TABLE likes (id INTEGER PRIMARY KEY AUTOINCREMENT, novel_id INTEGER, user_id INTEGER);
+    """)
+    db.executemany(
+        "INSERT INTO novels (title, description, content, user_id) VALUES (?, ?, ?, ?)",
+        ((f"Novel {i}", "A description", "lorem ipsum " * 200, i % 50) for i in range(novels)),
+    )
+    db.commit()
+    db.close()
+
+
+def per_request(path):
+    # The old get_db(): default rollback journal, fresh connection every call
+    def borrow():
+        db = sqlite3.connect(path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+    return borrow, lambda db: db.close()
+
+
+def pooled(path, size):
+    p = ConnectionPool(path, size=size)
+    return p.acquire, p.release
+
+
+def run(borrow, give_back, threads, requests, novels, write_every):
+    per_thread = requests // threads
+    errors = []
+
+    def worker(n):
+        for i in range(per_thread):
+            db = borrow()
+            try:
+                if write_every and i % write_every == 0:
+                    db.execute("INSERT INTO likes (novel_id, user_id) VALUES (?, ?)", (i % novels + 1, n))
+                    db.commit()
+                else:
+                    db.execute("SELECT * FROM novels WHERE id = ?", (i % novels + 1,)).fetchone()
+            except sqlite3.Error as e:
+                errors.append(e)
+            finally:
+                give_back(db)
+
+    pool_threads = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in pool_threads:
+        t.start()
+    for t in pool_threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--novels", type=int, default=1000)
+    parser.add_argument("--write-every", type=int, default=10,
+                        help="make every Nth request a like insert (0 for read only)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("per-request", "pooled"):
+            path = os.path.join(tmp, f"{name}.db")
+            seed(path, args.novels)
+            if name == "per-request":
+                # seed() goes through connect(), switch back to the default journal
+                db = sqlite3.connect(path)
+                db.execute("PRAGMA journal_mode = DELETE")
+                db.close()
+                borrow, give_back = per_request(path)
+            else:
+                borrow, give_back = pooled(path, args.threads)
+            rps, errors = run(borrow, give_back, args.threads, args.requests, args.novels, args.write_every)
+            print(f"{name:12} {rps:10.0f} req/s  errors={errors}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Build time and quality of the content-based similar novel lists.
+
+The dataset tiers draw every word from one small vocabulary, which leaves
+nothing to tell novels apart, so this builds its own catalog: each novel
+is written mostly from the words of one of --topics topics plus shared
+filler. The full build is timed, then indexing a batch of new uploads the
+way ContentIndexer does. Quality is the share of listed neighbours that
+share the novel's topic.
+
+    python benchmarks/content_similarity.py --novels 20000
+    python benchmarks/content_similarity.py --novels 100000 --shards 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+import content_similarity  # noqa: E402
+import repository  # noqa: E402
+from database import connect  # noqa: E402
+from sharding import Shards  # noqa: E402
+
+
+def word(rng):
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(3, 9)))
+
+
+class Catalog:
+    def __init__(self, topics, seed):
+        self.rng = random.Random(seed)
+        self.topics = [[word(self.rng) for _ in range(300)] for _ in range(topics)]
+        self.filler = [word(self.rng) for _ in range(2000)]
+        self.topic_of = {}
+
+    def novel(self, topic, words):
+        rng = self.rng
+        text = " ".join(rng.choices(self.topics[topic], k=words // 3) + rng.choices(self.filler, k=words))
+        title = " ".join(rng.choices(self.topics[topic], k=2)).title()
+        return title, f"A {rng.choice(self.topics[topic])} story", text
+
+    def add(self, shards, count, words):
+        ids = []
+        for _ in range(count):
+            topic = self.rng.randrange(len(self.topics))
+            novel_id = shards.new_novel_id()
+            with shards.pool_for(novel_id).connection() as db:
+                novel_id = repository.create_novel(db, 1, *self.novel(topic, words), novel_id)
+                db.commit()
+            self.topic_of[novel_id] = topic
+            ids.append(novel_id)
+        return ids
+
+
+def precision(shards, catalog, sample, seed):
+    rng = random.Random(seed)
+    same = listed = 0
+    for novel_id in rng.sample(sorted(catalog.topic_of), min(sample, len(catalog.topic_of))):
+        with shards.read_pool_for(novel_id).connection() as db:
+            for similar_id, _ in content_similarity.similar_by_content(db, novel_id, 10):
+                listed += 1
+                same += catalog.topic_of.get(similar_id) == catalog.topic_of[novel_id]
+    return same / max(listed, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--novels", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=600, help="words of text per novel")
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--uploads", type=int, default=50, help="novels indexed incrementally after the build")
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "content.db")
+        db = connect(path)
+        repository.migrate(db)
+        db.execute("INSERT INTO users (username, email, password) VALUES ('writer', 'writer@example.com', 'x')")
+        db.commit()
+        db.close()
+        shards = Shards(args.shards, path)
+        shards.migrate()
+
+        catalog = Catalog(args.topics, args.seed)
+        started = time.perf_counter()
+        catalog.add(shards, args.novels, args.words)
+        print(f"{args.novels} novels written in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        content_similarity.rebuild(shards, log=lambda line: print(f"  {line}"))
+        full = time.perf_counter() - started
+
+        uploads = catalog.add(shards, args.uploads, args.words)
+        started = time.perf_counter()
+        content_similarity.index_novels(shards, uploads)
+        incremental = time.perf_counter() - started
+
+        quality = precision(shards, catalog, 2000, args.seed)
+        for connections in shards.pools + shards.read_pools:
+            connections.close()
+
+    print(f"full build           {full:.2f}s")
+    print(f"incremental index    {incremental:.2f}s  ({args.uploads} uploads in one batch)")
+    print(f"same-topic share     {quality:.1%} of listed neighbours")
+
+
+if __name__ == "__main__":
+    main()
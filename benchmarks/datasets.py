@@ -0,0 +1,276 @@
+"""Seeded synthetic databases at fixed scale tiers, cached between runs.
+
+The base tables are loaded with journaling and syncing off, in large
+transactions, right after the migrations that create them. Everything
+derived (search index, counters, lookup indexes) is then built by the
+remaining migrations, the same way an existing database is upgraded.
+
+The data is shaped like a real catalog:
+
+    novel length     log-normal, a few very long novels
+    likes, comments  Zipf distributed over novels, heavy-tailed per user
+    wishlists        clustered, users mostly save novels of their own genre
+
+Every user is called bench<N> with the password "bench-password".
+
+    python benchmarks/datasets.py build 1m          # or 10k, 10m
+    python benchmarks/datasets.py path 1m           # cached file, built if needed
+
+From another benchmark:
+
+    from datasets import copy_dataset
+    copy_dataset("1m", os.path.join(tmp, "bench.db"))
+"""
+import argparse
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+import bcrypt  # noqa: E402
+
+from chapters import chapter_rows, novel_etag  # noqa: E402
+from database import connect  # noqa: E402
+from migrations import LATEST_VERSION, run_migrations  # noqa: E402
+
+# Rows per tier add up to roughly the tier's name
+TIERS = {
+    "10k": {"users": 500, "novels": 1000, "likes": 5000, "comments": 2500, "wishlists": 1000, "words": 600},
+    "1m": {"users": 20000, "novels": 50000, "likes": 600000, "comments": 250000, "wishlists": 80000,
+           "words": 600},
+    "10m": {"users": 200000, "novels": 300000, "likes": 6000000, "comments": 2500000, "wishlists": 1000000,
+            "words": 400},
+}
+
+DEFAULT_SEED = 42
+PASSWORD = "bench-password"
+GENRES = 12
+# Zipf exponent of novel popularity
+POPULARITY_ALPHA = 1.1
+# Share of a user's wishlist taken from their own genre
+HOME_GENRE_SHARE = 0.8
+LOAD_BATCH = 50000
+
+CACHE_DIR = os.environ.get(
+    "NOVEL_DATASET_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "novel_app", "datasets")
+)
+
+VOCABULARY = ("the a of and to in he she they was were had his her it that with for on at as by from "
+              "night river hill village lantern boat storm king sword road winter letter mother father "
+              "door window stone forest city ship silver fire dream shadow voice garden tower bridge "
+              "walked said looked turned waited remembered whispered ran fell opened closed held knew "
+              "quiet cold old young dark bright long small broken hidden last first strange gentle").split()
+
+
+def paragraph_pool(rng, size=5000):
+    """Enough distinct paragraphs that a chapter rarely repeats one, so compression stays honest."""
+    pool = []
+    for _ in range(size):
+        sentences = []
+        for _ in range(rng.randint(3, 7)):
+            words = rng.choices(VOCABULARY, k=rng.randint(6, 18))
+            sentences.append(" ".join(words).capitalize() + ".")
+        pool.append(" ".join(sentences))
+    return pool
+
+
+def novel_content(rng, pool, median_words):
+    # Log-normal length, clamped so one novel cannot dominate the tier
+    words = min(int(rng.lognormvariate(math.log(median_words), 1.0)), median_words * 50)
+    paragraphs = max(1, words // 60)
+    parts = []
+    for start in range(0, paragraphs, 25):
+        parts.append(f"Chapter {start // 25 + 1}\n\n")
+        parts.append("\n\n".join(rng.choices(pool, k=min(25, paragraphs - start))) + "\n\n")
+    return "".join(parts)
+
+
+def heavy_tailed_counts(rng, users, total, cap):
+    """Split total over users by Pareto distributed activity."""
+    activity = [rng.paretovariate(1.5) for _ in range(users)]
+    scale = total / sum(activity)
+    return [min(cap, int(round(value * scale))) for value in activity]
+
+
+def distinct_sample(rng, population, cum_weights, k):
+    """k distinct items drawn with the given weights."""
+    chosen = set()
+    while len(chosen) < k:
+        chosen.update(rng.choices(population, cum_weights=cum_weights, k=k - len(chosen)))
+    return chosen
+
+
+def _cumulative(weights):
+    total, cumulative = 0.0, []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def _insert_batches(db, sql, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= LOAD_BATCH:
+            db.executemany(sql, batch)
+            db.commit()
+            batch = []
+    if batch:
+        db.executemany(sql, batch)
+        db.commit()
+
+
+def generate(path, tier, seed=DEFAULT_SEED, log=print):
+    sizes = TIERS[tier]
+    rng = random.Random(seed)
+    db = connect(path)
+    # Base tables and chapters only, derived structures are built after the load
+    run_migrations(db, target=2)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+
+    started = time.perf_counter()
+    hashed = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(4))
+    _insert_batches(db, "INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)", (
+        (user_id, f"bench{user_id - 1}", f"bench{user_id - 1}@example.com", hashed)
+        for user_id in range(1, sizes["users"] + 1)
+    ))
+    log(f"users      {sizes['users']:>9}  {time.perf_counter() - started:6.1f}s")
+
+    pool = paragraph_pool(rng)
+    genre_of = [rng.randrange(GENRES) for _ in range(sizes["novels"])]
+
+    def novels():
+        for novel_id in range(1, sizes["novels"] + 1):
+            content = novel_content(rng, pool, sizes["words"])
+            rows = chapter_rows(content)
+            yield novel_id, rows, (
+                novel_id, f"{rng.choice(VOCABULARY).capitalize()} {rng.choice(VOCABULARY)} {novel_id}",
+                f"A genre {genre_of[novel_id - 1]} story", rng.randint(1, sizes["users"]),
+                novel_etag(row[3] for row in rows),
+            )
+
+    def write_novels(novel_batch, chapters):
+        db.executemany("INSERT INTO novels (id, title, description, user_id, content_etag) VALUES (?, ?, ?, ?, ?)",
+                       novel_batch)
+        db.executemany("INSERT INTO novel_chapters (novel_id, position, title, content, content_hash, "
+                       "byte_length) VALUES (?, ?, ?, ?, ?, ?)", chapters)
+        db.commit()
+
+    novel_batch, chapters = [], []
+    for novel_id, rows, novel in novels():
+        novel_batch.append(novel)
+        chapters.extend((novel_id, *row) for row in rows)
+        # Chapters carry the text, so they set the batch size
+        if len(chapters) >= LOAD_BATCH // 10:
+            write_novels(novel_batch, chapters)
+            novel_batch, chapters = [], []
+    if novel_batch:
+        write_novels(novel_batch, chapters)
+    log(f"novels     {sizes['novels']:>9}  {time.perf_counter() - started:6.1f}s")
+
+    # Popularity rank is shuffled so it does not follow novel ids
+    ids = list(range(1, sizes["novels"] + 1))
+    ranked = ids[:]
+    rng.shuffle(ranked)
+    popularity = _cumulative(1 / rank ** POPULARITY_ALPHA for rank in range(1, len(ranked) + 1))
+    # Drawing distinct novels from a Zipf distribution gets slow near the whole catalog
+    cap = min(sizes["novels"] // 4, 2000)
+
+    def likes():
+        for user_id, count in enumerate(heavy_tailed_counts(rng, sizes["users"], sizes["likes"], cap), start=1):
+            for novel_id in distinct_sample(rng, ranked, popularity, count):
+                yield novel_id, user_id
+
+    _insert_batches(db, "INSERT INTO likes (novel_id, user_id) VALUES (?, ?)", likes())
+    log(f"likes      {sizes['likes']:>9}  {time.perf_counter() - started:6.1f}s")
+
+    def comments():
+        for user_id, count in enumerate(heavy_tailed_counts(rng, sizes["users"], sizes["comments"], cap), start=1):
+            for novel_id in rng.choices(ranked, cum_weights=popularity, k=count):
+                yield novel_id, user_id, " ".join(rng.choices(VOCABULARY, k=rng.randint(4, 30)))
+
+    _insert_batches(db, "INSERT INTO comments (novel_id, user_id, text) VALUES (?, ?, ?)", comments())
+    log(f"comments   {sizes['comments']:>9}  {time.perf_counter() - started:6.1f}s")
+
+    by_genre = [[] for _ in range(GENRES)]
+    for novel_id in ranked:
+        by_genre[genre_of[novel_id - 1]].append(novel_id)
+    genre_popularity = [_cumulative(1 / rank ** POPULARITY_ALPHA for rank in range(1, len(members) + 1))
+                        for members in by_genre]
+
+    def wishlists():
+        counts = heavy_tailed_counts(rng, sizes["users"], sizes["wishlists"], cap)
+        for user_id, count in enumerate(counts, start=1):
+            genre = rng.randrange(GENRES)
+            home = min(int(count * HOME_GENRE_SHARE), len(by_genre[genre]) // 2)
+            chosen = distinct_sample(rng, by_genre[genre], genre_popularity[genre], home)
+            while len(chosen) < count:
+                chosen.add(rng.choices(ranked, cum_weights=popularity)[0])
+            for novel_id in chosen:
+                yield novel_id, user_id
+
+    _insert_batches(db, "INSERT INTO wishlists (novel_id, user_id) VALUES (?, ?)", wishlists())
+    log(f"wishlists  {sizes['wishlists']:>9}  {time.perf_counter() - started:6.1f}s")
+
+    # The pairs are unique by construction, with these indexes in place the
+    # dedupe pass of the unique engagement migration is a cheap lookup per row
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_likes_novel_user ON likes (novel_id, user_id)")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_wishlists_novel_user ON wishlists (novel_id, user_id)")
+    db.commit()
+    run_migrations(db)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("ANALYZE")
+    db.commit()
+    db.close()
+    log(f"derived tables and indexes  {time.perf_counter() - started:6.1f}s")
+
+
+def dataset_path(tier, seed=DEFAULT_SEED, log=print):
+    """Path of the cached database for tier, generating it the first time."""
+    if tier not in TIERS:
+        raise ValueError(f"Unknown tier {tier}, pick one of {', '.join(TIERS)}")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Keyed on the schema version too, a migration invalidates old copies
+    path = os.path.join(CACHE_DIR, f"{tier}-seed{seed}-schema{LATEST_VERSION}.db")
+    if not os.path.exists(path):
+        fd, building = tempfile.mkstemp(suffix=".db", dir=CACHE_DIR)
+        os.close(fd)
+        try:
+            generate(building, tier, seed, log)
+            os.replace(building, path)
+        finally:
+            if os.path.exists(building):
+                os.remove(building)
+    return path
+
+
+def copy_dataset(tier, destination, seed=DEFAULT_SEED, log=print):
+    """Copy a cached tier to destination, for benchmarks that write to it."""
+    shutil.copyfile(dataset_path(tier, seed, log), destination)
+    return destination
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or locate a synthetic novel database")
+    parser.add_argument("command", choices=["build", "path"])
+    parser.add_argument("tier", choices=list(TIERS))
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--out", help="build into this file instead of the cache")
+    args = parser.parse_args()
+
+    if args.command == "build" and args.out:
+        generate(args.out, args.tier, args.seed)
+        print(args.out)
+    else:
+        print(dataset_path(args.tier, args.seed))
+
+
+if __name__ == "__main__":
+    main()
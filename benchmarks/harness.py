@@ -0,0 +1,49 @@
+"""Helpers shared by the HTTP benchmarks: a throwaway server and percentiles."""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "novel_app")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(db_path, port, env=None, workers=None):
+    """Run novel_app under uvicorn on db_path and wait until it answers."""
+    if workers:
+        # Forked from one preloaded parent, with the caches kept coherent between workers
+        command = [sys.executable, os.path.join(APP_DIR, "serve.py"), "--workers", str(workers),
+                   "--port", str(port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", APP_DIR,
+                   "--port", str(port), "--log-level", "warning"]
+    server = subprocess.Popen(command, env={**os.environ, "NOVEL_DB_PATH": db_path, **(env or {})})
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/novels/", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
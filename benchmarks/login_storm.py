@@ -0,0 +1,76 @@
+"""Measure catalog read latency while a storm of logins hits the server.
+
+Starts novel_app under uvicorn on a temporary database, registers a user,
+then runs concurrent logins and catalog reads together and reports read
+p50/p99 next to a baseline taken with no logins running.
+
+    python benchmarks/login_storm.py --logins 64 --readers 8 --seconds 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from harness import free_port, percentile, start_server, stop_server
+
+
+async def reader(client, until, latencies):
+    while time.perf_counter() < until:
+        started = time.perf_counter()
+        await client.get("/novels/", params={"limit": 20})
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def login(client, until, statuses):
+    while time.perf_counter() < until:
+        response = await client.post("/login/", params={"username": "storm", "password": "storm-password"})
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+
+async def run(base_url, logins, readers, seconds):
+    limits = httpx.Limits(max_connections=logins + readers)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await client.post("/users/", json={"username": "storm", "password": "storm-password", "email": "storm@example.com"})
+
+        baseline = []
+        until = time.perf_counter() + seconds / 2
+        await asyncio.gather(*(reader(client, until, baseline) for _ in range(readers)))
+
+        loaded, statuses = [], {}
+        until = time.perf_counter() + seconds
+        await asyncio.gather(
+            *(reader(client, until, loaded) for _ in range(readers)),
+            *(login(client, until, statuses) for _ in range(logins)),
+        )
+    return baseline, loaded, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64, help="concurrent login loops")
+    parser.add_argument("--readers", type=int, default=8, help="concurrent catalog readers")
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        server = start_server(os.path.join(tmp, "bench.db"), port)
+        try:
+            baseline, loaded, statuses = asyncio.run(
+                run(f"http://127.0.0.1:{port}", args.logins, args.readers, args.seconds)
+            )
+        finally:
+            stop_server(server)
+
+    for name, samples in (("idle", baseline), ("login storm", loaded)):
+        print(f"reads {name:12} n={len(samples):6}  p50={statistics.median(samples):7.1f} ms  "
+              f"p99={percentile(samples, 99):7.1f} ms")
+    print("login responses", dict(sorted(statuses.items())))
+
+
+if __name__ == "__main__":
+    main()
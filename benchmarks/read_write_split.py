@@ -0,0 +1,134 @@
+"""Readers on the read-only pool against a steady bulk write load.
+
+Reader threads run what the GET routes run (list pages, novel details,
+batch fetches, leaderboards) on connections from a read-only pool while a
+writer thread keeps committing large transactions through the single
+writer connection, with a WAL checkpoint now and then. Any reader error
+fails the run, "database is locked" included, and so does a read-only
+connection that accepts a write.
+
+    python benchmarks/read_write_split.py --readers 16 --seconds 20
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+import catalog  # noqa: E402
+import repository  # noqa: E402
+import stats  # noqa: E402
+from database import ConnectionPool  # noqa: E402
+from datasets import copy_dataset  # noqa: E402
+from harness import percentile  # noqa: E402
+
+WORDS = ("the night river came down from the hills and every lantern in the village "
+         "went out one by one while she counted the boats").split()
+
+
+def read_once(db, rng, max_id):
+    novel_id = rng.randint(1, max_id)
+    action = rng.randrange(4)
+    if action == 0:
+        catalog.list_novel_summaries(db, catalog.encode_cursor(novel_id), 20)
+    elif action == 1:
+        repository.get_novel(db, novel_id)
+    elif action == 2:
+        catalog.fetch_novels(db, [rng.randint(1, max_id) for _ in range(50)])
+    else:
+        stats.top_novels(db, "likes", 10)
+
+
+def write_load(writers, stop, batch, hold, checkpoint_every, counts):
+    rng = random.Random(7)
+    batches = 0
+    while not stop.is_set():
+        with writers.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            for _ in range(batch):
+                content = "Chapter 1\n\n" + " ".join(rng.choices(WORDS, k=1500))
+                repository.create_novel(db, 1, "Bulk", "Written under load", content)
+            # Keep the write lock a while, like a large import batch does
+            time.sleep(hold)
+            db.commit()
+            batches += 1
+            counts["novels"] += batch
+            if checkpoint_every and batches % checkpoint_every == 0:
+                db.execute("PRAGMA wal_checkpoint(RESTART)").fetchone()
+                counts["checkpoints"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tier", default="10k", help="dataset tier to start from, see datasets.py")
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--batch", type=int, default=100, help="novels per write transaction")
+    parser.add_argument("--hold", type=float, default=0.05, help="seconds each write transaction stays open")
+    parser.add_argument("--checkpoint-every", type=int, default=3, help="write batches between WAL checkpoints")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = copy_dataset(args.tier, os.path.join(tmp, "split.db"))
+        writers = ConnectionPool(path, size=1)
+        readers = ConnectionPool(path, size=args.readers, readonly=True)
+
+        with readers.connection() as db:
+            max_id = db.execute("SELECT MAX(id) FROM novels").fetchone()[0]
+            try:
+                db.execute("INSERT INTO likes (novel_id, user_id) VALUES (1, 1)")
+                refused = None
+            except sqlite3.Error as e:
+                refused = str(e)
+
+        stop = threading.Event()
+        written = Counter()
+        errors = Counter()
+        latencies = []
+
+        def reader(seed):
+            rng = random.Random(seed)
+            samples = []
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    with readers.connection() as db:
+                        read_once(db, rng, max_id)
+                except sqlite3.Error as e:
+                    errors[str(e)] += 1
+                samples.append((time.perf_counter() - started) * 1000)
+            latencies.extend(samples)
+
+        threads = [threading.Thread(target=write_load, args=(writers, stop, args.batch, args.hold,
+                                                              args.checkpoint_every, written))]
+        threads += [threading.Thread(target=reader, args=(seed,)) for seed in range(args.readers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writers.close()
+        readers.close()
+
+    print(f"writes   {written['novels']} novels in {elapsed:.1f}s, {written['checkpoints']} checkpoints")
+    print(f"reads    {len(latencies)} ({len(latencies) / elapsed:.0f}/s)  p50 {percentile(latencies, 50):.2f} ms  "
+          f"p99 {percentile(latencies, 99):.2f} ms  max {max(latencies, default=0):.2f} ms")
+    print(f"write on a read-only connection: {'refused (' + refused + ')' if refused else 'ACCEPTED'}")
+    for message, count in errors.most_common():
+        print(f"reader error x{count}: {message}")
+    if errors or not refused:
+        sys.exit(1)
+    print("No reader errors")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Build time of the similar novel lists, and the cost of serving them.
+
+Times a full rebuild over every like and wishlist entry of a dataset tier,
+then an incremental refresh after a batch of new likes, then the two
+lookups the API serves: a novel's neighbours and a user's recommendations.
+
+    python benchmarks/recommendations.py --tier 1m
+    python benchmarks/recommendations.py --tier 10m --new-likes 10000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+import recommendations  # noqa: E402
+from database import connect  # noqa: E402
+from datasets import TIERS, copy_dataset  # noqa: E402
+from harness import percentile  # noqa: E402
+from sharding import Shards  # noqa: E402
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def add_likes(path, count, seed):
+    db = connect(path)
+    users = db.execute("SELECT MAX(id) FROM users").fetchone()[0]
+    novels = db.execute("SELECT MAX(id) FROM novels").fetchone()[0]
+    rng = random.Random(seed)
+    db.executemany("INSERT OR IGNORE INTO likes (novel_id, user_id) VALUES (?, ?)",
+                   ((rng.randint(1, novels), rng.randint(1, users)) for _ in range(count)))
+    db.commit()
+    db.close()
+
+
+def lookups(shards, path, count, seed):
+    db = connect(path, readonly=True)
+    novels = db.execute("SELECT MAX(id) FROM novels").fetchone()[0]
+    users = db.execute("SELECT MAX(id) FROM users").fetchone()[0]
+    rng = random.Random(seed)
+    similar, recommended = [], []
+    for _ in range(count):
+        _, elapsed = timed(recommendations.similar_to, db, rng.randint(1, novels), 10)
+        similar.append(elapsed * 1000)
+        _, elapsed = timed(recommendations.recommend, shards, rng.randint(1, users), 20)
+        recommended.append(elapsed * 1000)
+    db.close()
+    return similar, recommended
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tier", choices=list(TIERS), default="1m")
+    parser.add_argument("--new-likes", type=int, default=2000, help="likes added before the incremental refresh")
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = copy_dataset(args.tier, os.path.join(tmp, "recommendations.db"))
+        shards = Shards(1, path)
+        db = connect(path)
+        interactions = sum(db.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0]
+                           for source in recommendations.SOURCES)
+        db.close()
+
+        index = recommendations.SimilarityIndex(shards)
+        novels, full = timed(index.rebuild)
+        add_likes(path, args.new_likes, args.seed)
+        refreshed, incremental = timed(index.refresh)
+        similar, recommended = lookups(shards, path, args.lookups, args.seed)
+        shards.stop()
+        for connections in shards.pools + shards.read_pools:
+            connections.close()
+
+    print(f"tier {args.tier}, {interactions} likes and wishlist entries")
+    print(f"full rebuild         {full:.2f}s  ({novels} novels)")
+    print(f"incremental refresh  {incremental:.2f}s  ({refreshed} novels after {args.new_likes} new likes)")
+    print(f"similar novels       p50 {percentile(similar, 50):.3f} ms  p99 {percentile(similar, 99):.3f} ms")
+    print(f"recommendations      p50 {percentile(recommended, 50):.3f} ms  p99 {percentile(recommended, 99):.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
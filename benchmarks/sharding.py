@@ -0,0 +1,93 @@
+"""Write throughput of the sharded layout against shard count.
+
+Several writer processes, like several uvicorn workers, do what uploads and
+the write queue do: take a novel id from the main file, write the novel
+with its chapter text to its shard and commit a batch of comments on it in
+the same transaction. With one shard every process queues for the same
+write lock, with N shards up to N of them commit at once.
+
+    python benchmarks/sharding.py --shards 1,2,4 --processes 4 --seconds 10
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "novel_app"))
+
+import repository  # noqa: E402
+from database import connect  # noqa: E402
+from sharding import Shards  # noqa: E402
+
+WORDS = ("the night river came down from the hills and every lantern in the village "
+         "went out one by one while she counted the boats").split()
+
+
+def prepare(path, count, users=50):
+    db = connect(path)
+    repository.migrate(db)
+    db.executemany("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                   ((f"writer{i}", f"writer{i}@example.com", b"$2b$04$hash") for i in range(users)))
+    db.commit()
+    db.close()
+    Shards(count, path).migrate()
+
+
+def write(path, count, seconds, comments, words, seed, results):
+    shards = Shards(count, path)
+    rng = random.Random(seed)
+    novels = rows = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        novel_id = shards.new_novel_id()
+        with shards.pool_for(novel_id).connection() as db:
+            content = "Chapter 1\n\n" + " ".join(rng.choices(WORDS, k=words))
+            novel_id = repository.create_novel(db, rng.randint(1, 50), "Benchmark", "", content, novel_id)
+            db.executemany(repository.ADD_COMMENT,
+                           ((novel_id, rng.randint(1, 50), f"comment {i}") for i in range(comments)))
+            db.commit()
+        novels += 1
+        rows += comments
+    results.put((novels, rows))
+
+
+def run(count, processes, seconds, comments, words):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sharded.db")
+        prepare(path, count)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=write, args=(path, count, seconds, comments, words, seed, results))
+                   for seed in range(processes)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        totals = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+    return sum(novels for novels, _ in totals) / elapsed, sum(rows for _, rows in totals) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", default="1,2,4", help="comma separated shard counts to compare")
+    parser.add_argument("--processes", type=int, default=min(os.cpu_count() or 1, 8))
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--comments", type=int, default=50, help="comments committed with every novel")
+    parser.add_argument("--words", type=int, default=3000, help="words of chapter text per novel")
+    args = parser.parse_args()
+
+    print(f"{args.processes} writer processes, {args.seconds:.0f}s per layout")
+    print(f"{'shards':>6} {'novels/s':>9} {'comments/s':>11} {'speedup':>8}")
+    baseline = None
+    for count in (int(value) for value in args.shards.split(",")):
+        novels, rows = run(count, args.processes, args.seconds, args.comments, args.words)
+        baseline = baseline or novels
+        print(f"{count:>6} {novels:>9.0f} {rows:>11.0f} {novels / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""Scenario driven HTTP load test of novel_app.
+
+Starts the app under uvicorn on a temporary database, seeds users and
+novels, then runs each scenario: a number of concurrent clients for a
+number of seconds, every client picking its next action from a weighted
+mix. Results are latency percentiles and throughput per endpoint, as
+JSON. Given a baseline from an earlier run, regressions beyond the
+tolerance are listed and the exit status is 1.
+
+    python benchmarks/suite.py --scenarios browse,mixed --out results.json
+    python benchmarks/suite.py --baseline baseline.json --tolerance 0.25
+    python benchmarks/suite.py --config my_scenarios.json
+    python benchmarks/suite.py --dataset 1m       # start from a synthetic tier, see datasets.py
+
+A config file maps scenario names to {"clients", "seconds", "mix"}, where
+mix maps action names (see ACTIONS) to weights.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import httpx
+
+from datasets import TIERS, copy_dataset
+from harness import free_port, percentile, start_server, stop_server
+
+SCENARIOS = {
+    "browse": {"clients": 16, "seconds": 10, "mix": {"browse": 6, "open_novel": 4}},
+    "engage": {"clients": 16, "seconds": 10, "mix": {"like": 4, "comment": 3, "open_novel": 3}},
+    "login_storm": {"clients": 32, "seconds": 10, "mix": {"login": 7, "browse": 3}},
+    "upload": {"clients": 8, "seconds": 10, "mix": {"upload": 7, "bulk_upload": 3}},
+    "mixed": {
+        "clients": 24,
+        "seconds": 15,
+        "mix": {"browse": 35, "open_novel": 25, "search": 5, "like": 15, "comment": 10, "login": 5, "upload": 5},
+    },
+}
+
+WORDS = ("the night river came down from the hills and every lantern in the village "
+         "went out one by one while she counted the boats").split()
+
+
+def novel_text(rng, words=3000):
+    chapters = []
+    for number in range(1, 4):
+        chapters.append(f"Chapter {number}\n\n" + " ".join(rng.choices(WORDS, k=words // 3)) + "\n")
+    return "".join(chapters)
+
+
+class Client:
+    """One simulated user: an account, a token and a place in the catalog."""
+
+    def __init__(self, http, state, rng):
+        self.http = http
+        self.state = state
+        self.rng = rng
+        self.account = rng.choice(state["accounts"])
+        self.cursor = None
+
+    @property
+    def token(self):
+        return self.state["tokens"][self.account]
+
+
+async def browse(client):
+    params = {"limit": 20}
+    if client.cursor:
+        params["cursor"] = client.cursor
+    response = await client.http.get("/novels/", params=params)
+    if response.status_code == 200:
+        client.cursor = response.json()["next_cursor"]
+    return "GET /novels/", response
+
+
+async def open_novel(client):
+    novel_id = client.rng.choice(client.state["novel_ids"])
+    return "GET /novels/{novel_id}/", await client.http.get(f"/novels/{novel_id}/")
+
+
+async def search(client):
+    response = await client.http.get("/novels/search/", params={"q": client.rng.choice(WORDS)})
+    return "GET /novels/search/", response
+
+
+async def like(client):
+    novel_id = client.rng.choice(client.state["novel_ids"])
+    response = await client.http.post("/novels/like/", params={"token": client.token}, json={"novel_id": novel_id})
+    return "POST /novels/like/", response
+
+
+async def comment(client):
+    novel_id = client.rng.choice(client.state["novel_ids"])
+    text = " ".join(client.rng.choices(WORDS, k=12))
+    response = await client.http.post(
+        "/novels/comment/", params={"token": client.token}, json={"novel_id": novel_id, "text": text}
+    )
+    return "POST /novels/comment/", response
+
+
+async def login(client):
+    response = await client.http.post("/login/", params={"username": client.account, "password": "bench-password"})
+    return "POST /login/", response
+
+
+async def upload(client):
+    novel = {"title": f"Upload {client.rng.random():.6f}", "description": "Benchmark upload",
+             "content": novel_text(client.rng)}
+    return "POST /novels/", await client.http.post("/novels/", params={"token": client.token}, json=novel)
+
+
+async def bulk_upload(client, novels=50):
+    body = "".join(
+        json.dumps({"title": f"Bulk {client.rng.random():.6f}", "description": "Benchmark import",
+                    "content": novel_text(client.rng)}) + "\n"
+        for _ in range(novels)
+    )
+    response = await client.http.post("/novels/import/", params={"token": client.token}, content=body.encode("utf-8"))
+    return "POST /novels/import/", response
+
+
+ACTIONS = {action.__name__: action for action in (browse, open_novel, search, like, comment, login, upload, bulk_upload)}
+
+
+async def log_in(http, accounts):
+    tokens = {}
+    for name in accounts:
+        response = await http.post("/login/", params={"username": name, "password": "bench-password"})
+        response.raise_for_status()
+        tokens[name] = response.json()["token"]
+    return tokens
+
+
+# Account creations in flight while seeding, each one is a bcrypt hash on the server
+SEED_CONCURRENCY = 4
+
+
+async def create_account(http, name, slots):
+    """Register one account, waiting out the 503s of a full hashing pool."""
+    async with slots:
+        while True:
+            response = await http.post(
+                "/users/", json={"username": name, "password": "bench-password", "email": f"{name}@example.com"}
+            )
+            if response.status_code != 503:
+                break
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+    response.raise_for_status()
+
+
+async def seed(http, users, novels):
+    accounts = [f"bench{i}" for i in range(users)]
+    slots = asyncio.Semaphore(SEED_CONCURRENCY)
+    await asyncio.gather(*(create_account(http, name, slots) for name in accounts))
+    tokens = await log_in(http, accounts)
+
+    rng = random.Random(1)
+    state = {"accounts": accounts, "tokens": tokens}
+    for start in range(0, novels, 500):
+        await bulk_upload(Client(http, state, rng), min(500, novels - start))
+
+    novel_ids, cursor = [], None
+    while True:
+        params = {"limit": 100, **({"cursor": cursor} if cursor else {})}
+        page = (await http.get("/novels/", params=params)).json()
+        novel_ids += [novel["id"] for novel in page["items"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    state["novel_ids"] = novel_ids
+    return state
+
+
+async def seed_from_dataset(http, db_path, users):
+    """State for a database copied from a dataset tier, whose users are bench0, bench1, ..."""
+    accounts = [f"bench{i}" for i in range(users)]
+    with sqlite3.connect(db_path) as db:
+        novel_ids = [row[0] for row in db.execute("SELECT id FROM novels")]
+    return {"accounts": accounts, "tokens": await log_in(http, accounts), "novel_ids": novel_ids}
+
+
+async def run_client(client, mix, until, samples):
+    names, weights = list(mix), list(mix.values())
+    while time.perf_counter() < until:
+        action = ACTIONS[client.rng.choices(names, weights)[0]]
+        started = time.perf_counter()
+        try:
+            endpoint, response = await action(client)
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            endpoint, failed = action.__name__, True
+        samples.append((endpoint, (time.perf_counter() - started) * 1000, failed))
+
+
+async def run_scenario(base_url, state, scenario, seed_value):
+    samples = []
+    limits = httpx.Limits(max_connections=scenario["clients"])
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+        clients = [Client(http, state, random.Random(seed_value + i)) for i in range(scenario["clients"])]
+        # Refresh tokens, the scenario may outlive the access token TTL of an earlier one
+        for name in state["accounts"]:
+            response = await http.post("/login/", params={"username": name, "password": "bench-password"})
+            state["tokens"][name] = response.json()["token"]
+        started = time.perf_counter()
+        until = started + scenario["seconds"]
+        await asyncio.gather(*(run_client(client, scenario["mix"], until, samples) for client in clients))
+        elapsed = time.perf_counter() - started
+    return summarize(samples, elapsed)
+
+
+def summarize(samples, elapsed):
+    by_endpoint = {}
+    for endpoint, latency, failed in samples:
+        by_endpoint.setdefault(endpoint, []).append((latency, failed))
+    report = {}
+    for endpoint, values in sorted(by_endpoint.items()):
+        latencies = [latency for latency, _ in values]
+        report[endpoint] = {
+            "count": len(values),
+            "errors": sum(failed for _, failed in values),
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+        }
+    return report
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Regressions of results against baseline, as human readable lines."""
+    regressions = []
+    for scenario, endpoints in results.items():
+        for endpoint, current in endpoints.items():
+            before = baseline.get(scenario, {}).get(endpoint)
+            if before is None:
+                continue
+            for key in ("p95_ms", "p99_ms"):
+                if current[key] > before[key] * (1 + tolerance) and current[key] - before[key] > min_delta_ms:
+                    regressions.append(f"{scenario} {endpoint} {key} {before[key]:.1f} -> {current[key]:.1f}")
+            if current["rps"] < before["rps"] * (1 - tolerance):
+                regressions.append(f"{scenario} {endpoint} rps {before['rps']:.1f} -> {current['rps']:.1f}")
+            before_errors = before["errors"] / max(before["count"], 1)
+            current_errors = current["errors"] / max(current["count"], 1)
+            if current_errors > before_errors + 0.01:
+                regressions.append(f"{scenario} {endpoint} error rate {before_errors:.1%} -> {current_errors:.1%}")
+    return regressions
+
+
+def print_table(results):
+    for scenario, endpoints in results.items():
+        print(f"\n{scenario}")
+        print(f"  {'endpoint':28} {'count':>7} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for endpoint, row in endpoints.items():
+            print(f"  {endpoint:28} {row['count']:7} {row['errors']:6} {row['rps']:8.1f} "
+                  f"{row['p50_ms']:8.1f} {row['p95_ms']:8.1f} {row['p99_ms']:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", help="comma separated, all of them by default")
+    parser.add_argument("--config", help="JSON file of scenarios to use instead of the built-in ones")
+    parser.add_argument("--seconds", type=float, help="override every scenario's duration")
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--novels", type=int, default=2000)
+    parser.add_argument("--dataset", choices=list(TIERS), help="start from this synthetic tier instead of seeding")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, help="worker processes, forked by serve.py")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="server environment")
+    parser.add_argument("--out", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="ignore latency changes smaller than this")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.config:
+        with open(args.config) as f:
+            scenarios = json.load(f)
+    if args.scenarios:
+        scenarios = {name: scenarios[name] for name in args.scenarios.split(",")}
+    for name, scenario in scenarios.items():
+        unknown = set(scenario["mix"]) - set(ACTIONS)
+        if unknown:
+            parser.error(f"scenario {name} uses unknown actions {', '.join(sorted(unknown))}")
+        if args.seconds:
+            scenario["seconds"] = args.seconds
+    env = dict(value.split("=", 1) for value in args.env)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        db_path = os.path.join(tmp, "bench.db")
+        if args.dataset:
+            copy_dataset(args.dataset, db_path)
+        server = start_server(db_path, port, env, args.workers)
+        try:
+            async def seed_server():
+                async with httpx.AsyncClient(base_url=base_url, timeout=120) as http:
+                    if args.dataset:
+                        users = min(args.users, TIERS[args.dataset]["users"])
+                        return await seed_from_dataset(http, db_path, users)
+                    return await seed(http, args.users, args.novels)
+
+            state = asyncio.run(seed_server())
+            for name, scenario in scenarios.items():
+                results[name] = asyncio.run(run_scenario(base_url, state, scenario, args.seed))
+        finally:
+            stop_server(server)
+
+    print_table(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
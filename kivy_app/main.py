@@ -87,8 +87,8 @@ class LoginScreen(Screen):
             response = requests.post(f"{BASE_URL}/login/?username={username}&password={password}")
             if response.status_code == 200:
                 token = response.json()["token"]
-                print('got the token from server',token)
                 global_idmap["app"].token = token
+                global_idmap["app"].refresh_token = response.json()["refresh_token"]
                 self.manager.current = "home"
             else:
                 self.error_label.text = "Invalid credentials"
@@ -281,6 +281,18 @@ class MyScreenManager(ScreenManager):
 
 class NovelApp(App):
     token = None
+    refresh_token = None
+
+    def renew_token(self):
+        # Access tokens are short lived, trade the refresh token for a new pair
+        if not self.refresh_token:
+            return False
+        response = requests.post(f"{BASE_URL}/token/refresh/", params={"refresh_token": self.refresh_token})
+        if response.status_code != 200:
+            return False
+        self.token = response.json()["token"]
+        self.refresh_token = response.json()["refresh_token"]
+        return True
 
     def build(self):
         return MyScreenManager()
@@ -86,14 +86,11 @@ class AddNovelScreen(Screen):
             self.result_label.text = "No token found. Please login again."
             return
         
-        headers = {"Authorization": f"Bearer {token}"}
-
         try:
-            response = requests.post(
-                f"{BASE_URL}/novels/",
-                json={"title": title, "description": description, "content": content},params={"token":token},
-                headers=headers, 
-            )
+            response = self.post_novel(title, description, content, token)
+            # The access token may have expired, renew it once and retry
+            if response.status_code == 401 and global_idmap["app"].renew_token():
+                response = self.post_novel(title, description, content, global_idmap["app"].token)
             if response.status_code == 200:
                 self.result_label.text = "Novel added successfully"
                 self.cancel_btn.text = 'Back'
@@ -105,6 +102,14 @@ class AddNovelScreen(Screen):
         except requests.exceptions.ConnectionError:
             self.result_label.text = "Cannot connect to server"
 
+    def post_novel(self, title, description, content, token):
+        headers = {"Authorization": f"Bearer {token}"}
+        return requests.post(
+            f"{BASE_URL}/novels/",
+            json={"title": title, "description": description, "content": content},params={"token":token},
+            headers=headers, 
+        )
+
     def clear_inputs(self):
         self.title_input.text = ''
         self.description_input.text = ''
@@ -15,6 +15,7 @@ import requests
 
 
 BASE_URL = 'http://127.0.0.1:8000'
+PAGE_SIZE = 20
 
 class IconButton(ButtonBehavior,BoxLayout):
     def __init__(self, icon_src, text, **kwargs):
@@ -31,8 +32,11 @@ class IconButton(ButtonBehavior,BoxLayout):
         
 
 class NovelModal(Popup):
-    def __init__(self, novel, **kwargs):
+    def __init__(self, novel, chapters, **kwargs):
         super().__init__(**kwargs)
+        self.novel = novel
+        self.chapters = chapters
+        self.chapter_index = 0
         self.title = f"Novel: {novel['title']}"
         self.size_hint = (0.8, 0.8)
         self.auto_dismiss = True
@@ -51,14 +55,24 @@ class NovelModal(Popup):
         self.content_layout = BoxLayout(orientation='vertical', size_hint_y=None)
         self.content_layout.bind(minimum_height=self.content_layout.setter('height'))
 
-        # Novel Content
-        self.content_label = Label(text=novel['content'], size_hint_y=None, text_size=(self.width, None))
+        # Novel Content, one chapter at a time
+        self.content_label = Label(text='', size_hint_y=None, text_size=(self.width, None))
         self.content_label.bind(height=self.content_label.setter('height'))  # Automatically adjust height
         self.content_layout.add_widget(self.content_label)
         self.content_scroll.add_widget(self.content_layout)
 
         self.layout.add_widget(self.content_scroll)
 
+        # Chapter navigation
+        self.chapter_nav = BoxLayout(size_hint_y=None, height=40, spacing=10)
+        self.prev_btn = Button(text="<", size_hint_x=None, width=50, on_release=lambda x: self.load_chapter(self.chapter_index - 1))
+        self.chapter_label = Label()
+        self.next_btn = Button(text=">", size_hint_x=None, width=50, on_release=lambda x: self.load_chapter(self.chapter_index + 1))
+        self.chapter_nav.add_widget(self.prev_btn)
+        self.chapter_nav.add_widget(self.chapter_label)
+        self.chapter_nav.add_widget(self.next_btn)
+        self.layout.add_widget(self.chapter_nav)
+
         # Comment Input
         self.layout.add_widget(Label(text="Your Comment", font_size='18sp', bold=True))
         self.comment_input = TextInput(multiline=True, size_hint_y=None, height=100)
@@ -93,6 +107,23 @@ class NovelModal(Popup):
         self.layout.add_widget(self.result_label)
 
         self.add_widget(self.layout)
+        self.load_chapter(0)
+
+    def load_chapter(self, index):
+        if not 0 <= index < len(self.chapters):
+            return
+        chapter = self.chapters[index]
+        try:
+            response = requests.get(f"{BASE_URL}/novels/{self.novel['id']}/chapters/{chapter['position']}/")
+            if response.status_code == 200:
+                self.chapter_index = index
+                self.content_label.text = response.json()['content']
+                self.chapter_label.text = f"{chapter['title']} ({index + 1}/{len(self.chapters)})"
+                self.content_scroll.scroll_y = 1
+            else:
+                self.result_label.text = "Failed to load chapter"
+        except requests.exceptions.ConnectionError:
+            self.result_label.text = "Cannot connect to server"
 
     def like_novel(self, instance):
         # Logic to like the novel
@@ -165,6 +196,20 @@ class HomeScreen(Screen):
         self.scroll_view.add_widget(self.novels_list)
         self.layout.add_widget(self.scroll_view)
 
+        # Shown at the end of the list while the server has more pages
+        self.next_cursor = None
+        # cursor -> (ETag, page), so a refresh of unchanged pages costs a 304
+        self.page_cache = {}
+        self.load_more_btn = Button(
+            text="Load more",
+            size_hint_y=None,
+            height=50,
+            background_color=(0.3, 0.6, 0.8, 1),
+            color=(1, 1, 1, 1),
+            font_size='16sp',
+            on_release=self.fetch_page
+        )
+
         self.add_widget(self.layout)
     def on_enter(self):
         self.fetch_novels()
@@ -174,22 +219,44 @@ class HomeScreen(Screen):
 
     def fetch_novels(self, instance=None):
         self.novels_list.clear_widgets()
+        self.next_cursor = None
+        self.fetch_page()
+
+    def fetch_page(self, instance=None):
         self.result_label.text = ""  # Clear previous messages
+        if self.load_more_btn.parent:
+            self.novels_list.remove_widget(self.load_more_btn)
+        params = {"limit": PAGE_SIZE}
+        if self.next_cursor:
+            params["cursor"] = self.next_cursor
+        cached = self.page_cache.get(self.next_cursor)
+        headers = {"If-None-Match": cached[0]} if cached else {}
         try:
-            response = requests.get(f"{BASE_URL}/novels/")
-            if response.status_code == 200:
-                novels = response.json()
-                for novel in novels:
+            response = requests.get(f"{BASE_URL}/novels/", params=params, headers=headers)
+            if response.status_code == 304:
+                page = cached[1]
+            elif response.status_code == 200:
+                page = response.json()
+                if "ETag" in response.headers:
+                    self.page_cache[self.next_cursor] = (response.headers["ETag"], page)
+            else:
+                page = None
+            if page is not None:
+                for novel in page["items"]:
                     btn = Button(
-                        text=f"Title: {novel['title']}\nDescription: {novel['description']}",
+                        text=f"Title: {novel['title']}\nDescription: {novel['description']}\n"
+                             f"{novel['like_count']} likes  {novel['comment_count']} comments",
                         size_hint_y=None,
                         height=100,
                         background_color=(0.9, 0.9, 0.9, 1),
                         color=(0, 0, 0, 1),
                         font_size='16sp',
-                        on_release=lambda x:self.show_novel_modal(novel)
+                        on_release=lambda x, novel=novel: self.show_novel_modal(novel)
                     )
                     self.novels_list.add_widget(btn)
+                self.next_cursor = page["next_cursor"]
+                if self.next_cursor:
+                    self.novels_list.add_widget(self.load_more_btn)
             else:
                 self.result_label.text = "Failed to fetch novels"
         except requests.exceptions.ConnectionError:
@@ -199,9 +266,16 @@ class HomeScreen(Screen):
         self.manager.current = "add_novel"
     
     def show_novel_modal(self, novel,*args):
-        print(novel)
-        modal = NovelModal(novel)
-        modal.open()
+        # Only the chapter list is loaded here, the modal fetches chapters as they are read
+        try:
+            response = requests.get(f"{BASE_URL}/novels/{novel['id']}/chapters/")
+            if response.status_code == 200:
+                modal = NovelModal(novel, response.json())
+                modal.open()
+            else:
+                self.result_label.text = "Failed to load novel"
+        except requests.exceptions.ConnectionError:
+            self.result_label.text = "Cannot connect to server"
 
 class MyApp(App):
     def build(self):
@@ -0,0 +1,335 @@
+"""Bulk NDJSON import of novels.
+
+The body is one novel per line, optionally gzipped:
+
+    {"title": "...", "description": "...", "content": "..."}
+
+Lines of a GET /export/ file work as they are: records of another
+"type" than "novel" are skipped. Every line is validated on its own and a
+bad line is reported with its line number instead of failing the import.
+
+Valid novels are written IMPORT_BATCH at a time. Chapter splitting,
+compression and hashing happen before the write lock is taken, then the
+novels and all their chapters go in with one executemany each. With a
+job name, the last committed line is stored in the same transaction,
+so running the same job again continues where it stopped.
+
+    python bulk_import.py novels.ndjson.gz --user-id 1 [--job backlist-2024] [--db novel_db.db]
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import time
+import zlib
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from chapters import chapter_rows, novel_etag
+from database import pool
+
+IMPORT_BATCH = 500
+# Per-record errors beyond this are counted but not listed
+MAX_REPORTED_ERRORS = 100
+# A single line may not buffer more than this
+MAX_LINE_BYTES = 64 * 1024 * 1024
+
+FIELDS = ("title", "description", "content")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS import_checkpoints (
+            job TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            line INTEGER NOT NULL,
+            PRIMARY KEY (job, user_id)
+        )
+    """,
+)
+
+
+def create_import_checkpoints(db):
+    for statement in SCHEMA:
+        db.execute(statement)
+
+
+class LineReader:
+    """Split a stream of byte chunks, gzipped or not, into numbered lines."""
+
+    def __init__(self, gzipped=None):
+        # None means look at the first bytes for the gzip magic
+        self.gzipped = gzipped
+        self._inflater = None
+        self._buffer = b""
+        self._number = 0
+
+    def feed(self, chunk):
+        if self.gzipped is None:
+            if len(self._buffer) + len(chunk) < 2:
+                self._buffer += chunk
+                return []
+            chunk, self._buffer = self._buffer + chunk, b""
+            self.gzipped = chunk[:2] == b"\x1f\x8b"
+        if self.gzipped:
+            if self._inflater is None:
+                self._inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            try:
+                chunk = self._inflater.decompress(chunk)
+            except zlib.error:
+                raise HTTPException(status_code=400, detail="Body is not valid gzip")
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        if len(self._buffer) > MAX_LINE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Line {self._number + len(lines) + 1} is too long")
+        return self._numbered(lines)
+
+    def close(self):
+        if self.gzipped is None:
+            self.gzipped = False
+        if self._inflater is not None:
+            self._buffer += self._inflater.flush()
+        lines = self._buffer.split(b"\n")
+        self._buffer = b""
+        return self._numbered(lines)
+
+    def _numbered(self, lines):
+        numbered = []
+        for line in lines:
+            self._number += 1
+            numbered.append((self._number, line))
+        return numbered
+
+
+def validate(raw):
+    """Return the (title, description, content) of one line, None for a record of another type.
+
+    Raises ValueError for an invalid novel.
+    """
+    try:
+        record = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(record, dict):
+        raise ValueError("expected a JSON object")
+    if record.get("type", "novel") != "novel":
+        return None
+    values = []
+    for field in FIELDS:
+        value = record.get(field)
+        if not isinstance(value, str):
+            raise ValueError(f"{field} must be a string")
+        values.append(value)
+    if not values[0].strip():
+        raise ValueError("title must not be empty")
+    return tuple(values)
+
+
+class NovelImporter:
+    def __init__(self, db, user_id, job=None, batch_size=IMPORT_BATCH):
+        self.db = db
+        self.user_id = user_id
+        self.job = job
+        self.batch_size = batch_size
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self._pending = []
+        self._last_line = 0
+        self.resume_after = 0
+        if job:
+            row = db.execute(
+                "SELECT line FROM import_checkpoints WHERE job = ? AND user_id = ?", (job, user_id)
+            ).fetchone()
+            self.resume_after = row[0] if row else 0
+        self.checkpoint = self.resume_after
+
+    def add(self, number, raw):
+        """Validate one line. Returns True once a batch is ready for flush()."""
+        self._last_line = number
+        if number <= self.resume_after or not raw.strip():
+            return False
+        try:
+            values = validate(raw)
+        except ValueError as e:
+            self._error(number, str(e))
+            return False
+        if values is None:
+            self.skipped += 1
+        else:
+            self._pending.append((number, values))
+        return len(self._pending) >= self.batch_size
+
+    def _error(self, number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": number, "error": message})
+
+    def flush(self):
+        """Write every pending novel in one transaction, with the checkpoint."""
+        batch, self._pending = self._pending, []
+        last_line = self._last_line
+        if not batch:
+            self._save_checkpoint(last_line)
+            return
+        # The expensive part, done before taking the write lock
+        prepared = []
+        for number, (title, description, content) in batch:
+            rows = chapter_rows(content)
+            prepared.append((number, title, description, novel_etag(row[3] for row in rows), rows))
+
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "INSERT INTO novels (title, description, user_id, content_etag) VALUES (?, ?, ?, ?)",
+                [(title, description, self.user_id, etag) for _, title, description, etag, _ in prepared],
+            )
+            # One writer inside one transaction, so the new AUTOINCREMENT ids are consecutive
+            last_id = self.db.execute("SELECT last_insert_rowid()").fetchone()[0]
+            first_id = last_id - len(prepared) + 1
+            self.db.executemany(
+                "INSERT INTO novel_chapters (novel_id, position, title, content, content_hash, byte_length) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (novel_id, *row)
+                    for novel_id, (_, _, _, _, rows) in enumerate(prepared, start=first_id)
+                    for row in rows
+                ),
+            )
+            self._write_checkpoint(last_line)
+            self.db.commit()
+            self.imported += len(prepared)
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.rollback()
+            logging.warning(f"Import batch failed ({e}), retrying its {len(prepared)} novels one by one")
+            self._flush_one_by_one(prepared, last_line)
+        self.checkpoint = last_line
+
+    def _flush_one_by_one(self, prepared, last_line):
+        self.db.execute("BEGIN IMMEDIATE")
+        for number, title, description, etag, rows in prepared:
+            self.db.execute("SAVEPOINT import_row")
+            try:
+                cursor = self.db.execute(
+                    "INSERT INTO novels (title, description, user_id, content_etag) VALUES (?, ?, ?, ?)",
+                    (title, description, self.user_id, etag),
+                )
+                self.db.executemany(
+                    "INSERT INTO novel_chapters (novel_id, position, title, content, content_hash, byte_length) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    ((cursor.lastrowid, *row) for row in rows),
+                )
+                self.db.execute("RELEASE import_row")
+                self.imported += 1
+            except sqlite3.Error as e:
+                self.db.execute("ROLLBACK TO import_row")
+                self.db.execute("RELEASE import_row")
+                self._error(number, str(e))
+        self._write_checkpoint(last_line)
+        self.db.commit()
+
+    def _write_checkpoint(self, line):
+        if self.job:
+            self.db.execute(
+                "INSERT INTO import_checkpoints (job, user_id, line) VALUES (?, ?, ?) "
+                "ON CONFLICT (job, user_id) DO UPDATE SET line = MAX(line, excluded.line)",
+                (self.job, self.user_id, line),
+            )
+
+    def _save_checkpoint(self, line):
+        if self.job and line > self.checkpoint:
+            self._write_checkpoint(line)
+            self.db.commit()
+            self.checkpoint = line
+
+    def report(self):
+        return {
+            "job": self.job,
+            "resumed_after_line": self.resume_after,
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "errors": self.errors,
+            "checkpoint": self.checkpoint,
+        }
+
+
+async def import_stream(request, user_id, job=None):
+    """Import a request body as it arrives.
+
+    Only the upload is awaited on the event loop. Inflating, parsing,
+    validating and writing happen on a worker thread, one chunk at a time.
+    """
+    gzipped = True if request.headers.get("content-encoding", "").lower() == "gzip" else None
+
+    # The writer connection is borrowed per batch, not while the body is uploading,
+    # so other writes get their turn between batches
+    def start():
+        with pool.connection() as db:
+            return NovelImporter(db, user_id, job)
+
+    def flush():
+        with pool.connection() as db:
+            importer.db = db
+            importer.flush()
+
+    def add(lines):
+        for number, raw in lines:
+            if importer.add(number, raw):
+                flush()
+
+    def feed(chunk):
+        add(reader.feed(chunk))
+
+    def finish():
+        add(reader.close())
+        flush()
+
+    importer = await run_in_threadpool(start)
+    reader = LineReader(gzipped)
+    async for chunk in request.stream():
+        await run_in_threadpool(feed, chunk)
+    await run_in_threadpool(finish)
+    return importer.report()
+
+
+def import_file(db, path, user_id, job=None, batch_size=IMPORT_BATCH, chunk_size=1024 * 1024):
+    importer = NovelImporter(db, user_id, job, batch_size)
+    reader = LineReader()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            for number, raw in reader.feed(chunk):
+                if importer.add(number, raw):
+                    importer.flush()
+    for number, raw in reader.close():
+        importer.add(number, raw)
+    importer.flush()
+    return importer.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import novels from an NDJSON file, gzipped or not")
+    parser.add_argument("path")
+    parser.add_argument("--user-id", type=int, required=True, help="author of the imported novels")
+    parser.add_argument("--job", help="checkpoint name, run again with the same name to resume")
+    parser.add_argument("--db", help="database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH)
+    args = parser.parse_args()
+
+    from database import connect
+
+    db = connect(args.db)
+    started = time.perf_counter()
+    report = import_file(db, args.path, args.user_id, args.job, args.batch_size)
+    db.close()
+    elapsed = time.perf_counter() - started
+    for error in report["errors"]:
+        print(f"line {error['line']}: {error['error']}")
+    print(f"Imported {report['imported']} novels in {elapsed:.1f}s "
+          f"({report['imported'] / max(elapsed, 1e-9):.0f}/s), {report['failed']} failed, "
+          f"{report['skipped']} skipped, checkpoint at line {report['checkpoint']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import base64
+import binascii
+import json
+from typing import Optional
+
+from fastapi import HTTPException
+
+from compression import decompress
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Most ids one batch fetch may ask for
+MAX_BATCH_IDS = 500
+# The full projection buffers the text of every novel, so it gets far fewer
+MAX_FULL_BATCH_IDS = 20
+
+# Columns returned by list endpoints, content is only served by the detail endpoint
+SUMMARY_COLUMNS = (
+    "novels.id, novels.title, novels.description, novels.user_id, users.username AS author, "
+    "COALESCE(novel_stats.like_count, 0) AS like_count, "
+    "COALESCE(novel_stats.comment_count, 0) AS comment_count, "
+    "COALESCE(novel_stats.wishlist_count, 0) AS wishlist_count"
+)
+SUMMARY_FROM = (
+    "novels LEFT JOIN users ON users.id = novels.user_id "
+    "LEFT JOIN novel_stats ON novel_stats.novel_id = novels.id"
+)
+
+
+def encode_cursor(last_id: int, **extra) -> str:
+    raw = json.dumps({"id": last_id, **extra}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor_payload(cursor: str) -> dict:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(payload, dict) or not isinstance(payload.get("id"), int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return payload
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    return decode_cursor_payload(cursor)["id"]
+
+
+def list_novel_summaries(db, cursor: Optional[str], limit: int, user_id: Optional[int] = None):
+    """Return one keyset page of novel summaries ordered by id."""
+    after_id = decode_cursor(cursor)
+    query = f"SELECT {SUMMARY_COLUMNS} FROM {SUMMARY_FROM} WHERE novels.id > ?"
+    params = [after_id]
+    if user_id is not None:
+        query += " AND novels.user_id = ?"
+        params.append(user_id)
+    # Fetch one extra row to know whether there is a next page
+    query += " ORDER BY novels.id LIMIT ?"
+    params.append(limit + 1)
+
+    return _page(db.execute(query, params).fetchall(), limit)
+
+
+def list_wishlist(db, user_id: int, cursor: Optional[str], limit: int):
+    """Return one keyset page of the novels on a user's wishlist, ordered by id."""
+    # CROSS JOIN starts from the user's wishlist rows, a handful, instead of walking novels
+    rows = db.execute(
+        f"SELECT {SUMMARY_COLUMNS} FROM wishlists CROSS JOIN {SUMMARY_FROM} "
+        f"WHERE wishlists.user_id = ? AND novels.id = wishlists.novel_id AND novels.id > ? "
+        f"ORDER BY novels.id LIMIT ?",
+        (user_id, decode_cursor(cursor), limit + 1),
+    ).fetchall()
+    return _page(rows, limit)
+
+
+def _page(rows, limit):
+    # rows has limit + 1 entries when another page follows
+    novels = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(novels[-1]["id"]) if len(rows) > limit else None
+    return {"items": novels, "next_cursor": next_cursor}
+
+
+def parse_ids(ids: str, projection="summary"):
+    """Parse a comma separated id list such as "3,1,7"."""
+    try:
+        parsed = [int(value) for value in ids.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma separated integers")
+    return check_ids(parsed, projection)
+
+
+def check_ids(ids, projection="summary"):
+    if not ids:
+        raise HTTPException(status_code=400, detail="No ids given")
+    limit = MAX_FULL_BATCH_IDS if projection == "full" else MAX_BATCH_IDS
+    if len(ids) > limit:
+        raise HTTPException(status_code=400, detail=f"At most {limit} ids per {projection} request")
+    return ids
+
+
+def fetch_novels(db, ids, projection="summary"):
+    """Fetch many novels at once, in the order of ids, with None for ids that do not exist.
+
+    Summaries and counts come from one IN query. The "full" projection adds
+    the text of every found novel from one more query over their chapters.
+    """
+    unique = list(dict.fromkeys(ids))
+    placeholders = ",".join("?" * len(unique))
+    novels = {
+        row["id"]: dict(row)
+        for row in db.execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM {SUMMARY_FROM} WHERE novels.id IN ({placeholders})", unique
+        )
+    }
+    if projection == "full" and novels:
+        found = list(novels)
+        parts = {novel_id: [] for novel_id in found}
+        for row in db.execute(
+            f"SELECT novel_id, content FROM novel_chapters WHERE novel_id IN ({','.join('?' * len(found))}) "
+            f"ORDER BY novel_id, position",
+            found,
+        ):
+            parts[row[0]].append(decompress(row[1]) or "")
+        for novel_id, novel in novels.items():
+            novel["content"] = "".join(parts[novel_id])
+    return {
+        "items": [novels.get(novel_id) for novel_id in ids],
+        "missing": [novel_id for novel_id in unique if novel_id not in novels],
+    }
@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import re
+
+from compression import compress, decompress
+
+# Chapters larger than this are split again on paragraph boundaries
+MAX_CHAPTER_CHARS = 32 * 1024
+
+_NUMBER = (r"(?:\d+|[ivxlcdm]+|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve"
+           r"|thirteen|fourteen|fifteen|sixteen|seventeen|eighteen|nineteen|twenty)")
+
+# Short lines such as "Chapter 12", "CHAPTER IV: The Storm", "Part Two", "Prologue" or "## Title"
+HEADING_RE = re.compile(
+    rf"^[ \t]*(?:(?:chapter|chap\.|part|book)[ \t]+{_NUMBER}\b[^\n]{{0,80}}"
+    r"|(?:prologue|epilogue)\b[^\n]{0,80}"
+    r"|#{1,3}[ \t]+[^\n]{1,80})$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+CHAPTER_SUMMARY_COLUMNS = "position, title, byte_length"
+
+
+def content_hash(text) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def _split_large(text, limit):
+    """Cut text into pieces of at most limit characters, preferring paragraph breaks."""
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        cut = cut + 1 if cut > 0 else limit
+        pieces.append(text[:cut])
+        text = text[cut:]
+    pieces.append(text)
+    return pieces
+
+
+def split_chapters(content, limit=MAX_CHAPTER_CHARS):
+    """Split a novel into (title, text) chapters.
+
+    The split is lossless: joining the chapter texts gives back the original
+    content, so downloads and full reads are byte for byte unchanged.
+    """
+    if not content:
+        return []
+    starts = [match.start() for match in HEADING_RE.finditer(content)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    starts.append(len(content))
+
+    chapters = []
+    for begin, end in zip(starts, starts[1:]):
+        text = content[begin:end]
+        heading = HEADING_RE.match(text)
+        title = heading.group(0).strip().lstrip("#").strip() if heading else None
+        for index, piece in enumerate(_split_large(text, limit)):
+            chapters.append((title if index == 0 else None, piece))
+
+    for number, (title, text) in enumerate(chapters, start=1):
+        if not title:
+            chapters[number - 1] = (f"Part {number}", text)
+    return chapters
+
+
+def chapter_rows(content):
+    """(position, title, stored content, content_hash, byte_length) of every chapter of content."""
+    return [
+        (position, title, compress(text), content_hash(text), len(text.encode("utf-8")))
+        for position, (title, text) in enumerate(split_chapters(content), start=1)
+    ]
+
+
+def novel_etag(hashes):
+    """Novel ETag from its chapter hashes in position order."""
+    digest = hashlib.sha256()
+    for value in hashes:
+        digest.update(value.encode("ascii"))
+    return digest.hexdigest()
+
+
+def refresh_novel_etag(db, novel_id):
+    """Derive the novel ETag from its chapter hashes, no chapter text is read."""
+    etag = novel_etag(
+        row[0] for row in db.execute(
+            "SELECT content_hash FROM novel_chapters WHERE novel_id = ? ORDER BY position", (novel_id,)
+        )
+    )
+    db.execute("UPDATE novels SET content_etag = ? WHERE id = ?", (etag, novel_id))
+    return etag
+
+
+def write_chapters(db, novel_id, content):
+    """Replace every chapter of a novel with a fresh split of content. Caller commits."""
+    db.execute("DELETE FROM novel_chapters WHERE novel_id = ?", (novel_id,))
+    db.executemany(
+        "INSERT INTO novel_chapters (novel_id, position, title, content, content_hash, byte_length) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((novel_id, *row) for row in chapter_rows(content)),
+    )
+    return refresh_novel_etag(db, novel_id)
+
+
+def write_chapter(db, novel_id, position, title, text):
+    """Replace (or append) one chapter, only that chapter's row is rewritten. Caller commits.
+
+    A title of None keeps the current title of the chapter. Text without a
+    line end is stored with a blank line after it, so the next chapter's
+    heading starts its own paragraph and the full text stays a plain join of
+    the stored chapters, which downloads stream byte for byte.
+    """
+    if text and not text.endswith("\n"):
+        text += "\n\n"
+    db.execute(
+        "INSERT INTO novel_chapters (novel_id, position, title, content, content_hash, byte_length) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (novel_id, position) DO UPDATE SET title = COALESCE(excluded.title, novel_chapters.title), content = excluded.content, "
+        "content_hash = excluded.content_hash, byte_length = excluded.byte_length",
+        (novel_id, position, title, compress(text), content_hash(text), len(text.encode("utf-8"))),
+    )
+    return refresh_novel_etag(db, novel_id)
+
+
+def list_chapters(db, novel_id):
+    return db.execute(
+        f"SELECT {CHAPTER_SUMMARY_COLUMNS} FROM novel_chapters WHERE novel_id = ? ORDER BY position",
+        (novel_id,),
+    ).fetchall()
+
+
+def read_content(db, novel_id):
+    """Assemble the full text, only used by endpoints that really need all of it."""
+    rows = db.execute(
+        "SELECT content FROM novel_chapters WHERE novel_id = ? ORDER BY position", (novel_id,)
+    )
+    return "".join(decompress(row[0]) or "" for row in rows)
+
+
+def migrate_inline_content(db, batch_size=50):
+    """Move novels.content written before chapters existed into novel_chapters."""
+    moved = 0
+    last_id = 0
+    while True:
+        # Keyset paging, each batch starts where the last one ended instead of rescanning from the start
+        rows = db.execute(
+            "SELECT id, content FROM novels WHERE id > ? AND content IS NOT NULL ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        for row in rows:
+            write_chapters(db, row["id"], row["content"])
+            db.execute("UPDATE novels SET content = NULL WHERE id = ?", (row["id"],))
+        # Commit per batch so readers are never blocked behind one huge transaction
+        db.commit()
+        moved += len(rows)
+    if moved:
+        logging.info(f"Split {moved} novels into chapters")
+    return moved
@@ -0,0 +1,165 @@
+"""Keeps the in-process caches of forked workers in step.
+
+serve.py calls enable() before forking, which maps a small shared memory
+ring that every worker inherits. A worker that invalidates something, a
+response cache tag or a revoked token, publishes a message to the ring
+and bumps its generation counter. Before trusting one of its caches a
+worker calls sync(), which compares that counter with the last generation
+it applied and replays the messages it missed. When nothing changed this
+is one 8 byte read, and a write committed in one worker is seen by the
+next request served by any other.
+
+A worker that falls more than SLOTS messages behind has lost the ones in
+between, so every subscriber is reset instead: the response cache is
+cleared and revocations are reloaded from the database.
+
+Without enable(), in a single process, publish() and sync() do nothing.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+SLOTS = int(os.environ.get("NOVEL_COHERENCE_SLOTS", 8192))
+SLOT_SIZE = 128
+
+# Generation of the last published message
+_HEADER = struct.Struct("<Q")
+# Generation, publishing pid and length, followed by "channel\0message"
+_SLOT = struct.Struct("<QIH")
+MAX_MESSAGE = SLOT_SIZE - _SLOT.size
+
+logger = logging.getLogger(__name__)
+
+_file = None
+_region = None
+_applied = 0
+# Serializes this process' threads, the record lock below serializes processes
+_publish_lock = threading.Lock()
+_apply_lock = threading.Lock()
+# channel -> (apply(message), reset())
+_subscribers = {}
+
+
+def enable():
+    """Map the shared ring. Call once in the parent, before forking workers."""
+    global _file, _region
+    if _region is not None:
+        return
+    _file = tempfile.TemporaryFile(prefix="novel-coherence-")
+    _file.truncate(_HEADER.size + SLOTS * SLOT_SIZE)
+    _region = mmap.mmap(_file.fileno(), _HEADER.size + SLOTS * SLOT_SIZE)
+
+
+def enabled():
+    return _region is not None
+
+
+def subscribe(channel, apply, reset):
+    _subscribers[channel] = (apply, reset)
+
+
+def _head():
+    return _HEADER.unpack_from(_region, 0)[0]
+
+
+def _offset(generation):
+    return _HEADER.size + (generation % SLOTS) * SLOT_SIZE
+
+
+def publish(channel, message):
+    """Tell the other workers about message. The publishing worker has applied it already."""
+    global _applied
+    if _region is None:
+        return
+    import fcntl
+
+    data = f"{channel}\0{message}".encode("utf-8")
+    if len(data) > MAX_MESSAGE:
+        # Too long for a slot, an empty message resets the whole channel instead
+        data = f"{channel}\0".encode("utf-8")
+    with _publish_lock:
+        # A record lock, unlike a semaphore, is released if its holder dies
+        fcntl.lockf(_file, fcntl.LOCK_EX)
+        try:
+            generation = _head() + 1
+            offset = _offset(generation)
+            # Readers check the generation before and after copying, so clear it while the slot is rewritten
+            _SLOT.pack_into(_region, offset, 0, 0, 0)
+            _region[offset + _SLOT.size:offset + _SLOT.size + len(data)] = data
+            _SLOT.pack_into(_region, offset, generation, os.getpid(), len(data))
+            _HEADER.pack_into(_region, 0, generation)
+            with _apply_lock:
+                # Nothing to replay when this worker was up to date, it has seen its own message
+                if _applied == generation - 1:
+                    _applied = generation
+        finally:
+            fcntl.lockf(_file, fcntl.LOCK_UN)
+
+
+def _read(generation):
+    """The message published as generation, or None if it has been overwritten since."""
+    offset = _offset(generation)
+    slot_generation, pid, length = _SLOT.unpack_from(_region, offset)
+    data = bytes(_region[offset + _SLOT.size:offset + _SLOT.size + length])
+    if slot_generation != generation or _SLOT.unpack_from(_region, offset)[0] != generation:
+        return None
+    return pid, data
+
+
+def _missed(start, head):
+    """Messages of other workers in generations start+1 to head, None if some were overwritten."""
+    if head - start > SLOTS:
+        return None
+    pid = os.getpid()
+    messages = []
+    for generation in range(start + 1, head + 1):
+        message = _read(generation)
+        if message is None:
+            return None
+        if message[0] != pid:
+            messages.append(message[1])
+    return messages
+
+
+def _deliver(data):
+    channel, _, text = data.decode("utf-8").partition("\0")
+    apply, reset = _subscribers.get(channel, (None, None))
+    if apply is None:
+        return
+    if text:
+        apply(text)
+    else:
+        reset()
+
+
+def sync():
+    """Apply what other workers published since the last call."""
+    global _applied
+    if _region is None or _head() == _applied:
+        return
+    with _apply_lock:
+        head = _head()
+        messages = _missed(_applied, head)
+        if messages is None:
+            logger.warning("Missed %d cache invalidations, resetting every cache", head - _applied)
+            for _, reset in _subscribers.values():
+                reset()
+        else:
+            for data in messages:
+                _deliver(data)
+        # Only now, so other threads of this worker wait above until the caches are current
+        _applied = head
+
+
+def _forked():
+    # A new worker starts with empty caches, nothing published before it exists concerns it
+    global _applied
+    if _region is not None:
+        _applied = _head()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forked)
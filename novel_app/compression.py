@@ -0,0 +1,144 @@
+"""Compressed-at-rest chapter text.
+
+novel_chapters.content holds either plain TEXT, for short chapters and
+rows written before compression, or a BLOB that starts with a format
+marker:
+
+    b"NC" + version byte + payload
+    version 1   zlib stream of the UTF-8 text
+
+SQLite's type tells the two apart, so old rows stay readable as they are.
+Bytes without the marker are read as UTF-8 text, which is how MySQL, with
+a single BLOB column, hands back the short chapters.
+Text is only decompressed by the endpoints that return it. SQL sees it
+through the novel_text() function that connect() registers, which the
+full-text index reads from.
+
+Compress the rows of an existing database offline with:
+
+    python compression.py recompress [--db novel_db.db] [--batch-size 500] [--vacuum]
+"""
+import argparse
+import os
+import time
+import zlib
+
+MAGIC = b"NC"
+ZLIB_V1 = 1
+FORMAT_VERSION = ZLIB_V1
+
+LEVEL = int(os.environ.get("NOVEL_COMPRESSION_LEVEL", 6))
+# Below this the zlib header and the marker cost more than they save
+MIN_COMPRESS_BYTES = 256
+
+BATCH_SIZE = 500
+
+
+def compress(text, level=None):
+    """Return the value to store for text, a marked BLOB or the text itself."""
+    if text is None:
+        return None
+    data = text.encode("utf-8")
+    if len(data) < MIN_COMPRESS_BYTES:
+        return text
+    packed = MAGIC + bytes([FORMAT_VERSION]) + zlib.compress(data, LEVEL if level is None else level)
+    if len(packed) >= len(data):
+        return text
+    return packed
+
+
+def decompress_bytes(value) -> bytes:
+    """UTF-8 bytes of a stored value, whichever format it is in."""
+    if value is None:
+        return b""
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    # Format versions are control characters, which no chapter text starts with. Plain text
+    # can still arrive as bytes, MySQL returns everything stored in a BLOB column that way
+    if value[:2] != MAGIC or len(value) < 3 or value[2] >= 0x20:
+        return bytes(value)
+    version = value[2]
+    if version == ZLIB_V1:
+        return zlib.decompress(value[3:])
+    raise ValueError(f"Unknown chapter content format version {version}")
+
+
+def decompress(value):
+    """Text of a stored value, None stays None."""
+    if value is None or isinstance(value, str):
+        return value
+    return decompress_bytes(value).decode("utf-8")
+
+
+def register_functions(db):
+    db.create_function("novel_text", 1, decompress, deterministic=True)
+
+
+def stored_size(value):
+    if value is None:
+        return 0
+    return len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+
+
+def is_current(value):
+    return isinstance(value, bytes) and value[:3] == MAGIC + bytes([FORMAT_VERSION])
+
+
+def recompress(db, batch_size=BATCH_SIZE, level=None):
+    """Rewrite plain or outdated chapter rows in the current format, one batch per transaction.
+
+    content_hash is unchanged, so the search index is left alone.
+    Returns (rows rewritten, bytes before, bytes after).
+    """
+    rewritten = before = after = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            "SELECT id, content FROM novel_chapters WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        updates = []
+        for row in rows:
+            if row["content"] is None or is_current(row["content"]):
+                continue
+            value = compress(decompress(row["content"]), level)
+            if value == row["content"]:
+                continue
+            updates.append((value, row["id"]))
+            before += stored_size(row["content"])
+            after += stored_size(value)
+        if updates:
+            db.executemany("UPDATE novel_chapters SET content = ? WHERE id = ?", updates)
+            db.commit()
+            rewritten += len(updates)
+    return rewritten, before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress stored chapter text in place")
+    parser.add_argument("command", choices=["recompress"])
+    parser.add_argument("--db", help="database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--level", type=int, default=LEVEL, help="zlib level, 1 (fast) to 9 (small)")
+    parser.add_argument("--vacuum", action="store_true", help="give the freed pages back to the filesystem")
+    args = parser.parse_args()
+
+    from database import connect
+    from migrations import run_migrations
+
+    db = connect(args.db)
+    # The search index must read through novel_text() before rows change format
+    run_migrations(db)
+    started = time.perf_counter()
+    rewritten, before, after = recompress(db, args.batch_size, args.level)
+    print(f"Recompressed {rewritten} chapters in {time.perf_counter() - started:.1f}s, "
+          f"{before / 1024:.0f} KiB -> {after / 1024:.0f} KiB")
+    if args.vacuum:
+        db.execute("VACUUM")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
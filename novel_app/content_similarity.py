@@ -0,0 +1,707 @@
+"""Content-based similar novels, for novels nobody has liked yet.
+
+Title, description and the first MAX_CONTENT_CHARS of the text are
+tokenized and hashed into DIMENSIONS features, titles counting
+TITLE_WEIGHT times and descriptions DESCRIPTION_WEIGHT times. Each novel's
+term frequencies, as 1 + log(tf), are kept in novel_term_vectors and the
+number of novels using each feature in term_document_counts. Comparing two
+novels weighs their terms by idf = 1 + log((1 + N) / (1 + df)), keeps the
+TERMS_PER_NOVEL heaviest, and takes the cosine. Features in more than
+MAX_DOCUMENT_SHARE of the catalog are treated as stop words.
+
+The SIMILAR_K nearest novels of each novel are stored in
+content_neighbours, in the novel's shard. Building them never holds more
+than two chunks of CHUNK_NOVELS vectors: every chunk is scored against
+every other one through a sorted feature join, and a running top-K per
+novel is kept.
+
+The weighted terms every novel is scored with are kept in
+content_postings as well. Uploads and edits queue the novel for
+ContentIndexer, whose thread re-vectorizes it and scores it against the
+novels found there: the CANDIDATES_PER_TERM heaviest holders of each of
+its terms, rather than every vector in the catalog. It is offered to the
+lists of its new neighbours, and lists it dropped out of are refilled in
+the same pass. The idf it weighs with is at most IDF_MAX_AGE seconds old,
+and a full build every FULL_REBUILD_INTERVAL seconds brings every weight
+up to date. Novels without a vector, after a bulk import or a queue lost
+at shutdown, are picked up by sweep(). Offline:
+
+    python content_similarity.py rebuild [--db novel_db.db]
+"""
+import argparse
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from compression import decompress
+from recommendations import claim
+
+DIMENSIONS = int(os.environ.get("NOVEL_CONTENT_DIMENSIONS", 1 << 18))
+SIMILAR_K = int(os.environ.get("NOVEL_CONTENT_SIMILAR_K", 20))
+TERMS_PER_NOVEL = int(os.environ.get("NOVEL_CONTENT_TERMS", 64))
+CHUNK_NOVELS = int(os.environ.get("NOVEL_CONTENT_CHUNK", 2000))
+MAX_CONTENT_CHARS = 200_000
+MAX_DOCUMENT_SHARE = 0.5
+# Below this many novels every shared term counts, there is no telling stop words apart
+MIN_NOVELS_FOR_STOP_WORDS = 20
+TITLE_WEIGHT = 3
+DESCRIPTION_WEIGHT = 2
+# Query x candidate term pairs joined at once
+PAIR_BUDGET = 4_000_000
+# Queued novels indexed together, they share their candidate lookups
+BATCH_NOVELS = 256
+# Postings read per term of the novels being indexed
+CANDIDATES_PER_TERM = int(os.environ.get("NOVEL_CONTENT_CANDIDATES_PER_TERM", 1000))
+# Past this many distinct terms in a batch, one pass over every vector is cheaper than the lookups
+MAX_TERM_LOOKUPS = 4096
+IDF_MAX_AGE = 600
+FULL_REBUILD_INTERVAL = float(os.environ.get("NOVEL_CONTENT_FULL_REBUILD", 24 * 3600))
+# Weighted candidate chunks kept between passes of a full build
+CACHE_BYTES = int(os.environ.get("NOVEL_CONTENT_CACHE_MB", 256)) * 1024 * 1024
+FEATURE_CACHE_SIZE = 1_000_000
+
+TOKEN_RE = re.compile(r"\w\w+")
+
+SCHEMA = (
+    # Hashed features as little-endian int32, ascending, and their 1 + log(tf) as float32
+    """CREATE TABLE IF NOT EXISTS novel_term_vectors (
+            novel_id INTEGER PRIMARY KEY,
+            features BLOB NOT NULL,
+            weights BLOB NOT NULL
+        )
+    """,
+    """CREATE TABLE IF NOT EXISTS term_document_counts (
+            feature INTEGER PRIMARY KEY,
+            documents INTEGER NOT NULL
+        )
+    """,
+    """CREATE TABLE IF NOT EXISTS content_neighbours (
+            novel_id INTEGER NOT NULL,
+            similar_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (novel_id, similar_id)
+        ) WITHOUT ROWID
+    """,
+    # An edited or deleted novel is taken out of every list it appears in
+    "CREATE INDEX IF NOT EXISTS idx_content_neighbours_similar ON content_neighbours (similar_id)",
+)
+
+POSTINGS_SCHEMA = (
+    # The TERMS_PER_NOVEL weighted terms of every novel, as Block scores them
+    """CREATE TABLE IF NOT EXISTS content_postings (
+            novel_id INTEGER NOT NULL,
+            feature INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            PRIMARY KEY (novel_id, feature)
+        ) WITHOUT ROWID
+    """,
+    # The novels holding a term, heaviest first
+    "CREATE INDEX IF NOT EXISTS idx_content_postings_feature ON content_postings (feature, weight DESC)",
+)
+
+UPSERT_NEIGHBOUR = (
+    "INSERT INTO content_neighbours (novel_id, similar_id, score) VALUES (?, ?, ?) "
+    "ON CONFLICT (novel_id, similar_id) DO UPDATE SET score = excluded.score"
+)
+
+logger = logging.getLogger(__name__)
+
+
+def create_content_index(db):
+    for statement in SCHEMA:
+        db.execute(statement)
+
+
+def create_content_postings(db):
+    # Filled by the next full build, which the startup sweep runs when the table is empty
+    for statement in POSTINGS_SCHEMA:
+        db.execute(statement)
+
+
+# Vectors
+
+class _Features(dict):
+    """token -> feature, hashed once per token while the cache has room."""
+
+    def __missing__(self, token):
+        # crc32 rather than hash(), which differs between worker processes
+        feature = zlib.crc32(token.encode("utf-8")) % DIMENSIONS
+        if len(self) < FEATURE_CACHE_SIZE:
+            self[token] = feature
+        return feature
+
+
+_features = _Features()
+
+
+def term_vector(title, description, content):
+    """(features, weights) of one novel: ascending int32 features and float32 1 + log(tf)."""
+    features, counts = [], []
+    for text, weight in ((title, TITLE_WEIGHT), (description, DESCRIPTION_WEIGHT), (content, 1)):
+        tokens = Counter(TOKEN_RE.findall((text or "").lower()))
+        features.append(np.fromiter(map(_features.__getitem__, tokens), dtype=np.int32, count=len(tokens)))
+        counts.append(np.fromiter(tokens.values(), dtype=np.float32, count=len(tokens)) * weight)
+    # Sums the counts of tokens hashed to the same feature, in any field
+    features, slots = np.unique(np.concatenate(features), return_inverse=True)
+    frequencies = np.bincount(slots, weights=np.concatenate(counts), minlength=len(features))
+    return features, (1 + np.log(frequencies)).astype(np.float32)
+
+
+def _encode(vector):
+    features, weights = vector
+    return features.astype("<i4").tobytes(), weights.astype("<f4").tobytes()
+
+
+def _decode(features, weights):
+    return np.frombuffer(features, dtype="<i4"), np.frombuffer(weights, dtype="<f4")
+
+
+def read_texts(db, novel_ids):
+    """(novel_id, title, description, content) of the novels that exist, content cut to MAX_CONTENT_CHARS."""
+    if not novel_ids:
+        return []
+    marks = ",".join("?" * len(novel_ids))
+    novels = db.execute(f"SELECT id, title, description FROM novels WHERE id IN ({marks}) ORDER BY id",
+                        novel_ids).fetchall()
+    parts = {novel[0]: [] for novel in novels}
+    lengths = dict.fromkeys(parts, 0)
+    rows = db.execute(f"SELECT novel_id, content FROM novel_chapters WHERE novel_id IN ({marks}) "
+                      f"ORDER BY novel_id, position", novel_ids)
+    for novel_id, content in rows:
+        if novel_id in lengths and lengths[novel_id] < MAX_CONTENT_CHARS:
+            text = decompress(content) or ""
+            parts[novel_id].append(text)
+            lengths[novel_id] += len(text)
+    return [(novel_id, title, description, "".join(parts[novel_id])[:MAX_CONTENT_CHARS])
+            for novel_id, title, description in novels]
+
+
+def _document_deltas(added, removed):
+    """(feature, change) rows for term_document_counts."""
+    delta = np.zeros(DIMENSIONS, dtype=np.int64)
+    for features in added:
+        delta[features] += 1
+    for features in removed:
+        delta[features] -= 1
+    changed = np.flatnonzero(delta)
+    return list(zip(changed.tolist(), delta[changed].tolist()))
+
+
+def vectorize(connections, novel_ids):
+    """{novel_id: (features, weights)} of the novels of novel_ids that exist, read through connections."""
+    with connections.connection() as db:
+        texts = read_texts(db, novel_ids)
+    return {row[0]: term_vector(*row[1:]) for row in texts}
+
+
+def store_vectors(db, novel_ids, vectors):
+    """Store the vectors of novel_ids, dropping those of the novels missing from vectors.
+
+    Returns the ids that were vectorized. The caller commits.
+    """
+    marks = ",".join("?" * len(novel_ids))
+    old = db.execute(f"SELECT features, weights FROM novel_term_vectors WHERE novel_id IN ({marks})",
+                     novel_ids).fetchall()
+    db.execute(f"DELETE FROM novel_term_vectors WHERE novel_id IN ({marks})", novel_ids)
+    db.executemany("INSERT INTO novel_term_vectors (novel_id, features, weights) VALUES (?, ?, ?)",
+                   [(novel_id, *_encode(vector)) for novel_id, vector in vectors.items()])
+    db.executemany(
+        "INSERT INTO term_document_counts (feature, documents) VALUES (?, ?) "
+        "ON CONFLICT (feature) DO UPDATE SET documents = term_document_counts.documents + excluded.documents",
+        _document_deltas([vector[0] for vector in vectors.values()], [_decode(*row)[0] for row in old]),
+    )
+    return list(vectors)
+
+
+def _read_counts(db, index):
+    rows = db.execute("SELECT feature, documents FROM term_document_counts WHERE documents > 0")
+    pairs = np.fromiter((value for row in rows for value in row), dtype=np.int64).reshape(-1, 2)
+    novels = db.execute("SELECT COUNT(*) FROM novel_term_vectors").fetchone()[0]
+    return pairs, novels
+
+
+def inverse_document_frequencies(shards):
+    """idf of every feature over all shards, 0 for stop words."""
+    documents = np.zeros(DIMENSIONS, dtype=np.float64)
+    novels = 0
+    for pairs, count in shards.fan_out(_read_counts):
+        np.add.at(documents, pairs[:, 0], pairs[:, 1])
+        novels += count
+    idf = 1 + np.log((1 + novels) / (1 + documents))
+    if novels >= MIN_NOVELS_FOR_STOP_WORDS:
+        idf[documents > MAX_DOCUMENT_SHARE * novels] = 0
+    return idf.astype(np.float32)
+
+
+def read_vectors(db, after=0, limit=CHUNK_NOVELS, novel_ids=None):
+    """[(novel_id, (features, weights))], the next chunk by id or the given novels."""
+    if novel_ids is None:
+        rows = db.execute("SELECT novel_id, features, weights FROM novel_term_vectors WHERE novel_id > ? "
+                          "ORDER BY novel_id LIMIT ?", (after, limit))
+    else:
+        rows = db.execute(f"SELECT novel_id, features, weights FROM novel_term_vectors "
+                          f"WHERE novel_id IN ({','.join('?' * len(novel_ids))}) ORDER BY novel_id", novel_ids)
+    return [(row[0], _decode(row[1], row[2])) for row in rows]
+
+
+def store_postings(db, novel_ids, rows):
+    """Replace the postings of novel_ids with rows of (novel_id, feature, weight). The caller commits."""
+    db.execute(f"DELETE FROM content_postings WHERE novel_id IN ({','.join('?' * len(novel_ids))})", novel_ids)
+    db.executemany("INSERT INTO content_postings (novel_id, feature, weight) VALUES (?, ?, ?)", rows)
+
+
+def read_postings(db, features, limit=CANDIDATES_PER_TERM):
+    """(novel_ids, features, weights) arrays of the heaviest limit holders of each feature in one file."""
+    rows = [row for feature in features for row in db.execute(
+        "SELECT novel_id, feature, weight FROM content_postings WHERE feature = ? ORDER BY weight DESC LIMIT ?",
+        (feature, limit),
+    )]
+    return _entries(rows)
+
+
+def _entries(rows):
+    return (np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+            np.fromiter((row[1] for row in rows), dtype=np.int32, count=len(rows)),
+            np.fromiter((row[2] for row in rows), dtype=np.float32, count=len(rows)))
+
+
+def iter_vector_chunks(connections):
+    """Every stored vector of one file, CHUNK_NOVELS at a time."""
+    after = 0
+    while True:
+        with connections.connection() as db:
+            chunk = read_vectors(db, after)
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1][0]
+
+
+# Scoring
+
+class Block:
+    """TF-IDF vectors of a chunk of novels as sparse (novel, feature, weight) entries sorted by feature."""
+
+    def __init__(self, vectors, idf):
+        self.ids = np.array([novel_id for novel_id, _ in vectors], dtype=np.int64)
+        lengths = [len(vector[0]) for _, vector in vectors]
+        docs = np.repeat(np.arange(len(vectors), dtype=np.int32), lengths)
+        features = np.concatenate([vector[0] for _, vector in vectors] or [np.empty(0, np.int32)])
+        weights = np.concatenate([vector[1] for _, vector in vectors] or [np.empty(0, np.float32)])
+        weights = weights * idf[features]
+        kept = weights > 0
+        docs, features, weights = docs[kept], features[kept], weights[kept]
+        # The TERMS_PER_NOVEL heaviest terms of every novel. Weights scaled into (0, 1) and taken off the
+        # novel's index sort by novel, then heaviest first, in one float sort, much faster than lexsort
+        order = np.argsort(docs - weights / (weights.max(initial=0) * 1.0001 + 1e-30), kind="stable")
+        docs, features, weights = docs[order], features[order], weights[order]
+        starts = np.searchsorted(docs, np.arange(len(vectors)))
+        kept = np.arange(len(docs)) - starts[docs] < TERMS_PER_NOVEL
+        docs, features, weights = docs[kept], features[kept], weights[kept]
+        norms = np.sqrt(np.bincount(docs, weights=weights.astype(np.float64) ** 2, minlength=len(vectors)))
+        weights = (weights / norms[docs]).astype(np.float32)
+        order = np.argsort(features, kind="stable")
+        self.docs, self.features, self.weights = docs[order], features[order], weights[order]
+
+    @classmethod
+    def from_entries(cls, novel_ids, features, weights):
+        """Block of (novel_id, feature, weight) entries that are weighed already, such as postings."""
+        block = cls.__new__(cls)
+        block.ids, docs = np.unique(novel_ids, return_inverse=True)
+        order = np.argsort(features, kind="stable")
+        block.docs = docs[order].astype(np.int32)
+        block.features, block.weights = features[order], weights[order]
+        return block
+
+    def postings(self):
+        """(novel_id, feature, weight) rows of every entry."""
+        return list(zip(self.ids[self.docs].tolist(), self.features.tolist(), self.weights.tolist()))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.docs.nbytes + self.features.nbytes + self.weights.nbytes
+
+
+def cosine(query, candidates):
+    """Dense len(query) x len(candidates) cosine matrix of two blocks."""
+    scores = np.zeros((len(query), len(candidates)), dtype=np.float32)
+    low = np.searchsorted(candidates.features, query.features, "left")
+    matches = np.searchsorted(candidates.features, query.features, "right") - low
+    # Join the query terms a slice at a time so no more than PAIR_BUDGET pairs exist at once
+    bounds = np.searchsorted(np.cumsum(matches), np.arange(PAIR_BUDGET, matches.sum(), PAIR_BUDGET))
+    for entries in np.split(np.arange(len(matches)), np.unique(bounds)):
+        counts = matches[entries]
+        total = counts.sum()
+        if not total:
+            continue
+        left = np.repeat(entries, counts)
+        right = np.repeat(low[entries], counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = query.docs[left].astype(np.int64) * len(candidates) + candidates.docs[right]
+        scores += np.bincount(cells, weights=query.weights[left] * candidates.weights[right],
+                              minlength=scores.size).reshape(scores.shape).astype(np.float32)
+    return scores
+
+
+class TopK:
+    """Running SIMILAR_K best candidates of every novel in a query block."""
+
+    def __init__(self, query):
+        self.query = query
+        self.scores = np.zeros((len(query), 0), dtype=np.float32)
+        self.ids = np.zeros((len(query), 0), dtype=np.int64)
+
+    def offer(self, candidates):
+        scores = cosine(self.query, candidates)
+        # A novel is not its own neighbour
+        scores[np.equal.outer(self.query.ids, candidates.ids)] = 0
+        scores = np.hstack([self.scores, scores])
+        ids = np.hstack([self.ids, np.broadcast_to(candidates.ids, (len(self.query), len(candidates)))])
+        if scores.shape[1] > SIMILAR_K:
+            best = np.argpartition(-scores, SIMILAR_K - 1, axis=1)[:, :SIMILAR_K]
+            scores, ids = np.take_along_axis(scores, best, 1), np.take_along_axis(ids, best, 1)
+        self.scores, self.ids = scores, ids
+
+    def rows(self):
+        """(novel_id, similar_id, score) of every novel's list, zero scores left out."""
+        novel_ids = np.repeat(self.query.ids, self.scores.shape[1])
+        scores = self.scores.ravel()
+        kept = scores > 0
+        return list(zip(novel_ids[kept].tolist(), self.ids.ravel()[kept].tolist(), scores[kept].tolist()))
+
+
+class Candidates:
+    """Every stored vector as Blocks, read a chunk at a time.
+
+    The first pass keeps the Blocks when all of them fit in CACHE_BYTES, so
+    the passes after it skip reading and weighing them again.
+    """
+
+    def __init__(self, shards, idf):
+        self.shards = shards
+        self.idf = idf
+        self._blocks = None
+
+    def __iter__(self):
+        if self._blocks is not None:
+            yield from self._blocks
+            return
+        blocks, size = [], 0
+        for connections in self.shards.read_pools:
+            for chunk in iter_vector_chunks(connections):
+                block = Block(chunk, self.idf)
+                size += block.nbytes
+                if size <= CACHE_BYTES:
+                    blocks.append(block)
+                yield block
+        if size <= CACHE_BYTES:
+            self._blocks = blocks
+
+
+def nearest(query, candidates):
+    """TopK of a query block against every candidate block."""
+    top = TopK(query)
+    for block in candidates:
+        top.offer(block)
+    return top
+
+
+def entry_blocks(novel_ids, features, weights):
+    """Blocks of CHUNK_NOVELS novels each from (novel_id, feature, weight) entry arrays."""
+    ids = np.unique(novel_ids)
+    for start in range(0, len(ids), CHUNK_NOVELS):
+        kept = np.isin(novel_ids, ids[start:start + CHUNK_NOVELS])
+        yield Block.from_entries(novel_ids[kept], features[kept], weights[kept])
+
+
+def posted_candidates(shards, query):
+    """Blocks of the novels holding query's terms, from content_postings.
+
+    Only the entries of the query's terms are read, the only ones a cosine
+    with the query adds up.
+    """
+    features = np.unique(query.features).tolist()
+    found = shards.fan_out(lambda db, index: read_postings(db, features))
+    return entry_blocks(*(np.concatenate(parts) for parts in zip(*found)))
+
+
+# Building
+
+def rebuild(shards, log=print):
+    """Vectorize every novel and recompute every list, a chunk at a time. Returns the number of novels."""
+    started = time.perf_counter()
+    for index, connections in enumerate(shards.read_pools):
+        with shards.pools[index].connection() as db:
+            db.execute("DELETE FROM novel_term_vectors")
+            db.execute("DELETE FROM term_document_counts")
+            db.commit()
+        after = 0
+        while True:
+            # Texts are read and vectorized off the writer, which is only borrowed to store each chunk
+            with connections.connection() as db:
+                ids = [row[0] for row in db.execute(
+                    "SELECT id FROM novels WHERE id > ? ORDER BY id LIMIT ?", (after, CHUNK_NOVELS))]
+            if not ids:
+                break
+            vectors = vectorize(connections, ids)
+            with shards.pools[index].connection() as db:
+                store_vectors(db, ids, vectors)
+                db.commit()
+            after = ids[-1]
+    log(f"vectorized in {time.perf_counter() - started:.1f}s")
+
+    idf = inverse_document_frequencies(shards)
+    candidates = Candidates(shards, idf)
+    novels = 0
+    for index, connections in enumerate(shards.read_pools):
+        with shards.pools[index].connection() as db:
+            db.execute("DELETE FROM content_neighbours")
+            db.commit()
+        after = 0
+        for chunk in iter_vector_chunks(connections):
+            block = Block(chunk, idf)
+            top = nearest(block, candidates)
+            ids = block.ids.tolist()
+            with shards.pools[index].connection() as db:
+                db.executemany(UPSERT_NEIGHBOUR, top.rows())
+                # Postings are replaced a range of ids at a time, incremental indexing keeps using the old ones
+                # meanwhile. Those of novels gone since go with the range
+                db.execute(f"DELETE FROM content_postings WHERE novel_id > ? AND novel_id <= ? "
+                           f"AND novel_id NOT IN ({','.join('?' * len(ids))})", [after, ids[-1], *ids])
+                store_postings(db, ids, block.postings())
+                db.commit()
+            after = ids[-1]
+            novels += len(chunk)
+        with shards.pools[index].connection() as db:
+            db.execute("DELETE FROM content_postings WHERE novel_id > ?", (after,))
+            db.commit()
+        log(f"shard {index}: {novels} novels scored in {time.perf_counter() - started:.1f}s")
+    return novels
+
+
+def index_novels(shards, novel_ids, idf=None):
+    """Re-vectorize novel_ids after an upload, edit or delete and update the lists around them.
+
+    idf defaults to a fresh read of the document counts. Lists that held one
+    of the novels are scored again in the same pass, so none is left short.
+    """
+    changed = list(dict.fromkeys(novel_ids))
+    if not changed:
+        return 0
+    groups = {}
+    for novel_id in changed:
+        groups.setdefault(shards.index(novel_id), []).append(novel_id)
+    idf = inverse_document_frequencies(shards) if idf is None else idf
+    marks = ",".join("?" * len(changed))
+    # Lists about to lose one of the novels
+    refill = {novel_id for ids in shards.fan_out(lambda db, index: [row[0] for row in db.execute(
+        f"SELECT DISTINCT novel_id FROM content_neighbours WHERE similar_id IN ({marks})", changed
+    )]) for novel_id in ids}.difference(changed)
+
+    vectors = {}
+    for index, ids in groups.items():
+        vectors.update(vectorize(shards.read_pools[index], ids))
+    query = Block(sorted(vectors.items()), idf)
+    postings = {}
+    for row in query.postings():
+        postings.setdefault(shards.index(row[0]), []).append(row)
+    for index, ids in groups.items():
+        with shards.pools[index].connection() as db:
+            store_vectors(db, ids, {novel_id: vectors[novel_id] for novel_id in ids if novel_id in vectors})
+            store_postings(db, ids, postings.get(index, []))
+            db.execute(f"DELETE FROM content_neighbours WHERE novel_id IN ({','.join('?' * len(ids))})", ids)
+            db.commit()
+    # Out of every list, those still similar enough come back below
+    for connections in shards.pools:
+        with connections.connection() as db:
+            db.executemany("DELETE FROM content_neighbours WHERE similar_id = ?", [(novel_id,) for novel_id in changed])
+            db.commit()
+
+    # The refilled novels are scored with their stored postings, alongside the changed ones
+    refill = sorted(refill)
+    stored = [row for rows in shards.fan_out(lambda db, index: db.execute(
+        f"SELECT novel_id, feature, weight FROM content_postings WHERE novel_id IN ({','.join('?' * len(refill))})",
+        refill,
+    ).fetchall()) for row in rows] if refill else []
+    entries = [np.concatenate(parts) for parts in zip((query.ids[query.docs], query.features, query.weights),
+                                                      _entries(stored))]
+    rows = []
+    candidates = Candidates(shards, idf)
+    for block in entry_blocks(*entries):
+        if len(np.unique(block.features)) > MAX_TERM_LOOKUPS:
+            rows.extend(nearest(block, candidates).rows())
+        else:
+            rows.extend(nearest(block, posted_candidates(shards, block)).rows())
+    # Cosine is symmetric: each changed novel is offered to the lists of its own neighbours
+    rows.extend((similar_id, novel_id, score) for novel_id, similar_id, score in list(rows) if novel_id in vectors)
+    by_shard = {}
+    for row in rows:
+        by_shard.setdefault(shards.index(row[0]), []).append(row)
+    for index, shard_rows in by_shard.items():
+        with shards.pools[index].connection() as db:
+            db.executemany(UPSERT_NEIGHBOUR, shard_rows)
+            for novel_id in {row[0] for row in shard_rows}:
+                _trim(db, novel_id)
+            db.commit()
+    return len(vectors)
+
+
+def _trim(db, novel_id):
+    surplus = db.execute(
+        "SELECT similar_id FROM content_neighbours WHERE novel_id = ? ORDER BY score DESC, similar_id", (novel_id,)
+    ).fetchall()[SIMILAR_K:]
+    db.executemany("DELETE FROM content_neighbours WHERE novel_id = ? AND similar_id = ?",
+                   [(novel_id, row[0]) for row in surplus])
+
+
+def unindexed(db, index, limit=CHUNK_NOVELS):
+    return [row[0] for row in db.execute(
+        "SELECT id FROM novels WHERE NOT EXISTS "
+        "(SELECT 1 FROM novel_term_vectors WHERE novel_term_vectors.novel_id = novels.id) ORDER BY id LIMIT ?",
+        (limit,),
+    )]
+
+
+class ContentIndexer:
+    """Background thread indexing the novels this worker uploaded or edited.
+
+    Every FULL_REBUILD_INTERVAL seconds it also rebuilds everything, unless
+    another worker holds the lock, being at it or sweeping.
+    """
+
+    def __init__(self, shards, lock_path, full_interval=FULL_REBUILD_INTERVAL):
+        self.shards = shards
+        self.lock_path = lock_path
+        self.full_interval = full_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._idf = None
+        self._idf_read_at = 0.0
+
+    def submit(self, novel_id):
+        self._queue.put(novel_id)
+
+    def sweep(self):
+        """Index every novel without a vector, everything when nothing is indexed yet."""
+        self._queue.put(_SWEEP)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="novel-content-indexer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # Queued novels are dropped, the next sweep finds the new ones
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def idf(self):
+        """inverse_document_frequencies, read again once IDF_MAX_AGE old."""
+        if self._idf is None or time.monotonic() - self._idf_read_at > IDF_MAX_AGE:
+            self._idf = inverse_document_frequencies(self.shards)
+            self._idf_read_at = time.monotonic()
+        return self._idf
+
+    def _run(self):
+        next_full = time.monotonic() + self.full_interval
+        while True:
+            try:
+                batch = [self._queue.get(timeout=max(next_full - time.monotonic(), 0))]
+            except queue.Empty:
+                self._rebuild()
+                next_full = time.monotonic() + self.full_interval
+                continue
+            while len(batch) < BATCH_NOVELS:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                return
+            try:
+                if _SWEEP in batch:
+                    self._sweep()
+                novel_ids = [novel_id for novel_id in batch if novel_id is not _SWEEP]
+                if novel_ids:
+                    index_novels(self.shards, novel_ids, self.idf())
+            except Exception:
+                logger.exception("Indexing novel text failed")
+
+    def _rebuild(self):
+        lock_file = claim(self.lock_path)
+        if lock_file is None:
+            return
+        try:
+            rebuild(self.shards, log=logger.info)
+            self._idf = None
+        except Exception:
+            logger.exception("Rebuilding similar novels by content failed")
+        finally:
+            lock_file.close()
+
+    def _sweep(self):
+        # Workers sweep one after another, the later ones find nothing left to do
+        lock_file = claim(self.lock_path, blocking=True)
+        try:
+            indexed = sum(self.shards.fan_out(
+                lambda db, index: db.execute("SELECT COUNT(*) FROM novel_term_vectors").fetchone()[0]))
+            posted = any(self.shards.fan_out(
+                lambda db, index: db.execute("SELECT 1 FROM content_postings LIMIT 1").fetchone()))
+            # Nothing indexed yet, or vectors from before content_postings existed
+            if not indexed or not posted:
+                if indexed or any(self.shards.fan_out(lambda db, index: unindexed(db, index, 1))):
+                    rebuild(self.shards, log=logger.info)
+                    self._idf = None
+                return
+            while True:
+                missing = [novel_id for ids in self.shards.fan_out(unindexed) for novel_id in ids]
+                if not missing:
+                    return
+                index_novels(self.shards, missing, self.idf())
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+
+_SWEEP = object()
+
+
+# Serving
+
+def similar_by_content(db, novel_id, limit):
+    """[(similar_id, score)] of one novel, best first."""
+    return [tuple(row) for row in db.execute(
+        "SELECT similar_id, score FROM content_neighbours WHERE novel_id = ? ORDER BY score DESC, similar_id LIMIT ?",
+        (novel_id, limit),
+    )]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the content-based similar novel lists")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--db", help="main database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    args = parser.parse_args()
+    if args.db:
+        os.environ["NOVEL_DB_PATH"] = args.db
+
+    from sharding import Shards
+
+    shards = Shards(path=args.db)
+    started = time.perf_counter()
+    novels = rebuild(shards)
+    print(f"Similar novels by content for {novels} novels in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
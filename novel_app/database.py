@@ -0,0 +1,182 @@
+"""Connections and the pools that lend them to requests.
+
+GET routes read through read_pool. With SQLite its connections are opened
+with mode=ro and PRAGMA query_only, so they can never take the write lock
+and, in WAL mode, never wait for it either. Everything that writes goes
+through pool, which for SQLite holds a single connection: handlers that
+write, the group commit thread and bulk imports borrow it in turn and
+queue in Python instead of spinning on busy_timeout.
+
+A handler holding the writer must not wait for the write queue, whose
+thread needs the same connection to commit.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import metrics
+from compression import register_functions
+
+DB_PATH = os.environ.get("NOVEL_DB_PATH", "novel_db.db")
+
+# "sqlite" (NOVEL_DB_PATH) or "mysql" (NOVEL_MYSQL_URL, see mysql_backend.py)
+BACKEND = os.environ.get("NOVEL_DB_BACKEND", "sqlite")
+if BACKEND == "mysql":
+    import mysql_backend
+
+    # Offline scripts still open SQLite files, so its errors stay in
+    DatabaseError = (sqlite3.Error, mysql_backend.Error)
+elif BACKEND == "sqlite":
+    DatabaseError = sqlite3.Error
+else:
+    raise RuntimeError(f"Unknown NOVEL_DB_BACKEND {BACKEND!r}, expected sqlite or mysql")
+
+# Starlette runs sync handlers on a 40 thread pool, so by default we keep
+# one warm reader for every worker thread.
+POOL_SIZE = int(os.environ.get("NOVEL_DB_POOL_SIZE", "40"))
+# SQLite has one writer at a time anyway, MySQL takes as many as there are threads
+WRITE_POOL_SIZE = int(os.environ.get("NOVEL_DB_WRITE_POOL_SIZE", 1 if BACKEND == "sqlite" else POOL_SIZE))
+
+# Pragmas applied to every pooled connection
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",     # 64 MiB page cache per connection
+    "PRAGMA mmap_size = 268435456",   # 256 MiB memory mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+# A read-only connection cannot change the journal mode, and query_only
+# turns any write that slips through into an error rather than a lock
+READ_PRAGMAS = tuple(pragma for pragma in PRAGMAS if "journal_mode" not in pragma) + ("PRAGMA query_only = ON",)
+
+# Size of the per-connection prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+
+def connect(path=None, readonly=False):
+    """Open a tuned connection. Used by the pools and by offline scripts."""
+    # Opened by URI so that mode=ro works, here and in ATTACH statements on this connection
+    target = Path(path or DB_PATH).resolve().as_uri()
+    if readonly:
+        target += "?mode=ro"
+    db = sqlite3.connect(
+        target,
+        uri=True,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        # Times statements and fetches for the request being served, see metrics.py
+        factory=metrics.TimedConnection,
+    )
+    db.row_factory = sqlite3.Row  # This allows us to access columns by name
+    for pragma in READ_PRAGMAS if readonly else PRAGMAS:
+        db.execute(pragma)
+    # novel_text(), used by the search index triggers
+    register_functions(db)
+    return db
+
+
+def open_connection(path=None, readonly=False):
+    """Connection to the configured backend, path only applies to SQLite."""
+    if BACKEND == "mysql":
+        return mysql_backend.connect(readonly=readonly)
+    return connect(path, readonly)
+
+
+class ConnectionPool:
+    """Keeps long-lived connections around instead of connecting per request.
+
+    FastAPI may run a dependency and its handler on different threads of the
+    pool, so connections are handed out one request at a time rather than
+    pinned with threading.local. Idle connections are reused LIFO so the
+    hottest ones keep their page and statement caches warm. The same pool
+    serves both backends, connect opens one connection of either.
+    """
+
+    def __init__(self, path=None, size=POOL_SIZE, connect=open_connection, readonly=False):
+        self.path = path or DB_PATH
+        self.size = size
+        self.readonly = readonly
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                opened = True
+            else:
+                opened = False
+        if opened:
+            try:
+                return self._connect(self.path, readonly=self.readonly)
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        # Every connection is busy, wait for one to come back
+        started = time.perf_counter()
+        db = self._idle.get()
+        metrics.observe(metrics.pool_wait, time.perf_counter() - started)
+        return db
+
+    def release(self, db):
+        # Never hand a connection with a half finished transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        if self._closed:
+            self._discard(db)
+        else:
+            self._idle.put(db)
+
+    def _discard(self, db):
+        db.close()
+        with self._lock:
+            self._opened -= 1
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "open": self._opened, "idle": self._idle.qsize()}
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+pool = ConnectionPool(size=WRITE_POOL_SIZE)
+read_pool = ConnectionPool(readonly=True)
+
+
+def get_db():
+    """FastAPI dependency that lends the writer connection to one request."""
+    with pool.connection() as db:
+        yield db
+
+
+def get_read_db():
+    """FastAPI dependency that lends a read-only connection to one request."""
+    with read_pool.connection() as db:
+        yield db
@@ -0,0 +1,168 @@
+import hashlib
+import re
+import zlib
+
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+from compression import decompress_bytes
+from database import read_pool
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [value.strip() for value in header.split(",")]
+    return any(value.removeprefix("W/") == etag for value in candidates)
+
+
+def _parse_range(header, length):
+    """Return (start, end) for a single byte range, None to serve the whole file."""
+    match = _RANGE_RE.match(header.replace(" ", ""))
+    if not match:
+        # Multiple or malformed ranges, RFC 9110 lets us ignore the header
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        suffix = int(last)
+        if suffix == 0:
+            raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{length}"})
+        return max(length - suffix, 0), length - 1
+    start = int(first)
+    end = min(int(last), length - 1) if last else length - 1
+    if start >= length or start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{length}"})
+    return start, end
+
+
+def _iter_chapters(db, segments, start, end):
+    """Yield the identity bytes [start, end] of the novel, at most CHUNK_SIZE at a time."""
+    offset = 0
+    for chapter_id, length, compressed in segments:
+        # Chapter covers bytes [offset, offset + length) of the whole novel
+        first, last = max(start, offset), min(end, offset + length - 1)
+        offset += length
+        if first > last:
+            continue
+        first -= offset - length
+        last -= offset - length
+        if compressed:
+            # Compressed chapters cannot be seeked into, inflate the whole chapter
+            row = db.execute("SELECT content FROM novel_chapters WHERE id = ?", (chapter_id,)).fetchone()
+            data = decompress_bytes(row[0] if row else None)
+            for begin in range(first, last + 1, CHUNK_SIZE):
+                yield data[begin:min(begin + CHUNK_SIZE, last + 1)]
+            continue
+        with db.blobopen("novel_chapters", "content", chapter_id, readonly=True) as blob:
+            blob.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = blob.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def _read_layout(db, novel_id):
+    """(content_etag, segments) of a novel, None when it does not exist."""
+    novel = db.execute("SELECT content_etag FROM novels WHERE id = ?", (novel_id,)).fetchone()
+    if not novel:
+        return None
+    segments = [
+        (row["id"], row["byte_length"], row["compressed"])
+        for row in db.execute(
+            "SELECT id, byte_length, typeof(content) = 'blob' AS compressed FROM novel_chapters "
+            "WHERE novel_id = ? AND byte_length > 0 ORDER BY position",
+            (novel_id,),
+        )
+    ]
+    return novel["content_etag"], segments
+
+
+def _iter_content(connections, novel_id, content_etag, start, end, gzip):
+    """Read the byte range chapter by chapter inside one read snapshot.
+
+    The connection is only taken once the server starts pulling the body, a
+    client that goes away before that never holds one. The headers were worked
+    out from an earlier snapshot, so the body checks the novel is unchanged.
+    """
+    with connections.connection() as db:
+        db.execute("BEGIN")
+        layout = _read_layout(db, novel_id)
+        if layout is None or layout[0] != content_etag:
+            # Edited in between, cutting the body short makes the client retry
+            raise RuntimeError(f"novel {novel_id} changed before its download started")
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if gzip else None
+        for chunk in _iter_chapters(db, layout[1], start, end):
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        if compressor:
+            yield compressor.flush()
+
+
+def stream_novel(request, novel_id: int, connections=read_pool):
+    """Serve a novel as text/plain with ETag, Range and on the fly gzip support.
+
+    connections is the read pool of the file holding the novel, see sharding.py.
+    """
+    with connections.connection() as db:
+        db.execute("BEGIN")
+        layout = _read_layout(db, novel_id)
+    if layout is None:
+        raise HTTPException(status_code=404, detail="Novel not found")
+    content_etag, segments = layout
+
+    length = sum(size for _, size, _ in segments)
+    etag = content_etag or hashlib.sha256().hexdigest()
+
+    accepts_gzip = "gzip" in request.headers.get("accept-encoding", "").lower()
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range is not None and not _etag_matches(if_range, f'"{etag}"'):
+        range_header = None
+
+    # Ranges are served from the identity encoding so offsets stay meaningful
+    gzip = accepts_gzip and not range_header and length > 0
+    strong_etag = f'"{etag}-gzip"' if gzip else f'"{etag}"'
+    headers = {
+        "ETag": strong_etag,
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+        "Content-Disposition": f'attachment; filename="novel-{novel_id}.txt"',
+    }
+
+    if _etag_matches(request.headers.get("if-none-match"), strong_etag):
+        return Response(status_code=304, headers=headers)
+
+    status_code = 200
+    start, end = 0, length - 1
+    if range_header and length > 0:
+        byte_range = _parse_range(range_header, length)
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    else:
+        headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        _iter_content(connections, novel_id, content_etag, start, end, gzip),
+        status_code=status_code,
+        media_type="text/plain; charset=utf-8",
+        headers=headers,
+    )
@@ -0,0 +1,239 @@
+"""Streaming NDJSON export of users, novels and engagement rows.
+
+Every line is one JSON object with a "type" field:
+
+    {"type": "user", "id": 1, "username": "...", "email": "...", "updated_at": ...}
+    {"type": "novel", "id": 7, "title": "...", "description": "...", "user_id": 1, "content": "..."}
+    {"type": "like" | "comment" | "wishlist", "id": 3, "novel_id": 7, "user_id": 1, ...}
+    {"type": "watermark", "since": "<token>"}
+
+Rows are read from one cursor per table inside a single read snapshot,
+EXPORT_BATCH rows at a time, so memory stays flat however big the tables
+are. Password hashes are never exported, and emails only to operators.
+
+The last line carries a watermark. Passing it back as `since` exports
+only what was added or changed after it: users and novels by their
+updated_at (kept by triggers), engagement rows by id. Deletions are not
+part of incremental exports.
+
+    python export.py [--db novel_db.db] [--out catalog.ndjson.gz] [--since TOKEN] [--tables novels,likes]
+"""
+import argparse
+import base64
+import binascii
+import gzip
+import json
+import sys
+import zlib
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from chapters import read_content
+from database import read_pool
+
+EXPORT_BATCH = 1000
+# Output is flushed to the client in chunks of about this size
+CHUNK_SIZE = 64 * 1024
+
+# Seconds since the epoch with sub-second precision
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+SCHEMA = (
+    "CREATE INDEX IF NOT EXISTS idx_novels_updated_at ON novels (updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users (updated_at)",
+    f"""CREATE TRIGGER IF NOT EXISTS novels_touch_insert AFTER INSERT ON novels BEGIN
+            UPDATE novels SET updated_at = {NOW} WHERE id = new.id;
+        END
+    """,
+    f"""CREATE TRIGGER IF NOT EXISTS novels_touch_update
+        AFTER UPDATE OF title, description, user_id, content_etag ON novels BEGIN
+            UPDATE novels SET updated_at = {NOW} WHERE id = new.id;
+        END
+    """,
+    f"""CREATE TRIGGER IF NOT EXISTS users_touch_insert AFTER INSERT ON users BEGIN
+            UPDATE users SET updated_at = {NOW} WHERE id = new.id;
+        END
+    """,
+    f"""CREATE TRIGGER IF NOT EXISTS users_touch_update AFTER UPDATE OF username, email ON users BEGIN
+            UPDATE users SET updated_at = {NOW} WHERE id = new.id;
+        END
+    """,
+)
+
+# Export name -> (record type, columns, watermark column)
+TABLES = {
+    "users": ("user", "id, username, email, updated_at", "updated_at"),
+    "novels": ("novel", "id, title, description, user_id, updated_at", "updated_at"),
+    "likes": ("like", "id, novel_id, user_id", "id"),
+    "comments": ("comment", "id, novel_id, user_id, text", "id"),
+    "wishlists": ("wishlist", "id, novel_id, user_id", "id"),
+}
+
+# Columns exported in place of TABLES' when the caller may not see personal data
+PUBLIC_COLUMNS = {
+    "users": "id, username, updated_at",
+}
+
+
+def create_change_tracking(db):
+    # Rows from before tracking keep updated_at NULL, a full export still includes them
+    for table in ("novels", "users"):
+        columns = [row["name"] for row in db.execute(f"PRAGMA table_info({table})")]
+        if "updated_at" not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN updated_at REAL")
+    for statement in SCHEMA:
+        db.execute(statement)
+
+
+def parse_tables(tables):
+    if not tables:
+        return list(TABLES)
+    names = [name.strip() for name in tables.split(",") if name.strip()]
+    unknown = [name for name in names if name not in TABLES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown tables: {', '.join(unknown)}")
+    return names
+
+
+def encode_watermark(marks):
+    raw = json.dumps(marks, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_watermark(since):
+    if not since:
+        return {}
+    try:
+        marks = json.loads(base64.urlsafe_b64decode(since + "=" * (-len(since) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid since watermark")
+    if not isinstance(marks, dict) or not all(
+        name in TABLES and isinstance(value, (int, float)) for name, value in marks.items()
+    ):
+        raise HTTPException(status_code=400, detail="Invalid since watermark")
+    return marks
+
+
+def current_watermark(db, tables):
+    """High-water marks of the snapshot, read off the indexes before exporting."""
+    marks = {}
+    for name in tables:
+        column = TABLES[name][2]
+        marks[name] = db.execute(f"SELECT COALESCE(MAX({column}), 0) FROM {name}").fetchone()[0]
+    return marks
+
+
+def export_records(db, tables, since, content=True, personal=True):
+    """Yield every record to export as a dict, table by table."""
+    for name in tables:
+        record_type, columns, column = TABLES[name]
+        if not personal:
+            columns = PUBLIC_COLUMNS.get(name, columns)
+        query = f"SELECT {columns} FROM {name}"
+        params = ()
+        if name in since:
+            # updated_at can repeat, >= exports ties again rather than missing them
+            query += f" WHERE {column} {'>=' if column == 'updated_at' else '>'} ?"
+            params = (since[name],)
+        query += f" ORDER BY {column}" if name in since else " ORDER BY id"
+        cursor = db.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            for row in rows:
+                record = {"type": record_type, **dict(row)}
+                if record_type == "novel" and content:
+                    record["content"] = read_content(db, row["id"])
+                yield record
+
+
+def iter_ndjson(db, tables, since, marks, content=True, personal=True):
+    """Encode the export as NDJSON chunks, ending with the watermark line."""
+    buffer = []
+    size = 0
+    for record in export_records(db, tables, since, content, personal):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    # Later exports resume from whichever is newer, the old mark or this snapshot
+    merged = {name: max(marks[name], since.get(name, 0)) for name in tables}
+    watermark = {"type": "watermark", "since": encode_watermark(merged)}
+    buffer.append(json.dumps(watermark, separators=(",", ":")).encode("utf-8") + b"\n")
+    yield b"".join(buffer)
+
+
+def _iter_response(connections, tables, since, content, personal, gzip):
+    # The connection is only taken once the server starts pulling the body,
+    # a client that goes away before that never holds one
+    with connections.connection() as db:
+        # One read snapshot for every table and the watermark
+        db.execute("BEGIN")
+        marks = current_watermark(db, tables)
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if gzip else None
+        for chunk in iter_ndjson(db, tables, since, marks, content, personal):
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        if compressor:
+            yield compressor.flush()
+
+
+def stream_export(request, tables, since, content=True, personal=False, connections=read_pool):
+    """Stream the export as application/x-ndjson, gzipped when the client accepts it.
+
+    Users' emails are only included with personal, for operators.
+    """
+    tables = parse_tables(tables)
+    since = decode_watermark(since)
+    gzip = "gzip" in request.headers.get("accept-encoding", "").lower()
+    headers = {"Vary": "Accept-Encoding", "Content-Disposition": 'attachment; filename="export.ndjson"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        _iter_response(connections, tables, since, content, personal, gzip),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the novel database as NDJSON")
+    parser.add_argument("--db", help="database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    parser.add_argument("--out", help="output file, gzipped when it ends in .gz, stdout by default")
+    parser.add_argument("--since", help="watermark printed on the last line of a previous export")
+    parser.add_argument("--tables", help=f"comma separated subset of {','.join(TABLES)}")
+    parser.add_argument("--no-content", action="store_true", help="leave novel text out")
+    args = parser.parse_args()
+
+    from database import connect
+
+    tables = parse_tables(args.tables)
+    since = decode_watermark(args.since)
+    db = connect(args.db)
+    db.execute("BEGIN")
+    marks = current_watermark(db, tables)
+    if args.out is None:
+        out = sys.stdout.buffer
+    elif args.out.endswith(".gz"):
+        out = gzip.open(args.out, "wb")
+    else:
+        out = open(args.out, "wb")
+    try:
+        for chunk in iter_ndjson(db, tables, since, marks, not args.no_content):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
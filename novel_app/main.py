@@ -1,39 +1,58 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
 import sqlite3
-import bcrypt
-import jwt
-from typing import Optional
+from typing import List, Literal, Optional
 import logging
-
-SECRET_KEY = "my_secret_key"
+import os
+
+from bulk_import import import_stream
+from catalog import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, check_ids, parse_ids
+from chapters import list_chapters, write_chapter
+import coherence
+from content_similarity import ContentIndexer, similar_by_content
+from database import DatabaseError, get_db, get_read_db, open_connection, pool, read_pool
+from downloads import stream_novel
+from export import stream_export
+import metrics
+import passwords
+from recommendations import Recommender, recommend, similar_to
+import repository
+from response_cache import cache, cached_json, page_tags
+from search import search_novels
+from sharding import get_novel_db, get_novel_read_db, shards
+import slow_queries
+from tokens import (apply_revocation, create_refresh_token, create_user_token, decode_token, is_admin, load_revocations,
+                    publish_revocation, read_revocations, revoke, verify_admin, verify_token)
 
 app = FastAPI()
+recommender = Recommender(shards, shards.path + ".recommend.lock")
+content_index = ContentIndexer(shards, shards.path + ".content.lock")
+app.add_middleware(metrics.MetricsMiddleware)
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("NOVEL_LOG_LEVEL", "INFO").upper())
 
-# Database connection helper for SQLite
-def get_db():
-    db = sqlite3.connect("novel_db.db")
-    db.row_factory = sqlite3.Row  # This allows us to access columns by name
-    return db
+# Sampled only when /metrics is scraped
+metrics.add_collector(lambda: metrics.gauge_lines("novel_response_cache", "Response cache statistics", cache.stats()))
+metrics.add_collector(lambda: metrics.gauge_lines("novel_db_pool", "Pooled writer connections", pool.stats()))
+metrics.add_collector(lambda: metrics.gauge_lines("novel_db_read_pool", "Pooled read-only connections", read_pool.stats()))
+metrics.add_collector(lambda: metrics.gauge_lines("novel_write_queue", "Queued writes, all shards",
+                                                  {"pending": shards.pending()}))
+metrics.add_collector(lambda: metrics.gauge_lines("novel_slow_query_log", "Slow statement log", slow_queries.stats(),
+                                                  kind="counter"))
 
-def create_user_token(user_id: int):
-    # PyJWT: encode method should be available
-    token = jwt.encode({"user_id": user_id}, SECRET_KEY, algorithm="HS256")
-    return token
+def reload_revocations():
+    with read_pool.connection() as db:
+        read_revocations(db)
 
-# Verify JWT token
-def verify_token(token: Optional[str]):
-    if token is None:
-        raise HTTPException(status_code=401, detail="Token is required")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return payload["user_id"]
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+# Tokens revoked by other serve.py workers, reloaded from the database if this one missed some
+coherence.subscribe("revoked", apply_revocation, reload_revocations)
+
+# "commit" waits for the group commit holding the row, "async" returns once it is queued
+Durability = Literal["commit", "async"]
+
+# "summary" is what list pages show, "full" adds the novel text
+Projection = Literal["summary", "full"]
 
 # Models
 class UserCreate(BaseModel):
@@ -50,6 +69,10 @@ class NovelCreate(BaseModel):
     description: str
     content: str
 
+class ChapterUpdate(BaseModel):
+    title: Optional[str] = None
+    content: str
+
 class LikeCreate(BaseModel):
     novel_id: int
 
@@ -60,284 +83,410 @@ class CommentCreate(BaseModel):
 class WishListCreate(BaseModel):
     novel_id: int
 
+class NovelBatch(BaseModel):
+    ids: List[int]
+    projection: Projection = "summary"
+
 class ProfileUpdate(BaseModel):
     username: str
     email: str
     password: str
 
-# Database table creation on startup
-def create_tables():
-    db = get_db()
-    cursor = db.cursor()
-
-    # Create the 'users' table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL
-        )
-    """)
-
-    # Create the 'novels' table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS novels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            description TEXT,
-            content TEXT,
-            user_id INTEGER,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-
-    # Create the 'likes' table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            novel_id INTEGER,
-            user_id INTEGER,
-            FOREIGN KEY (novel_id) REFERENCES novels(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-
-    # Create the 'comments' table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            novel_id INTEGER,
-            user_id INTEGER,
-            text TEXT,
-            FOREIGN KEY (novel_id) REFERENCES novels(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-
-    # Create the 'wishlists' table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS wishlists (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            novel_id INTEGER,
-            user_id INTEGER,
-            FOREIGN KEY (novel_id) REFERENCES novels(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-
-    db.commit()
-    db.close()
-
+# Bring the database schema up to date on startup
 @app.on_event("startup")
 def on_startup():
-    create_tables()
+    db = open_connection()
+    repository.migrate(db)
+    load_revocations(db)
+    db.close()
+    # Shard files, when NOVEL_SHARDS is above 1
+    shards.migrate()
+    passwords.configure()
+    shards.start()
+    # Only one worker per database rebuilds the similar novel lists
+    recommender.start()
+    # Novels added while no worker was running, or everything on a new database
+    content_index.start()
+    content_index.sweep()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    recommender.stop()
+    content_index.stop()
+    # Commit every queued like, comment and wishlist entry before exiting
+    shards.stop()
+    passwords.shutdown()
+    pool.close()
+    read_pool.close()
 
 # User registration endpoint
 @app.post("/users/", tags=["User Management"])
 def create_user(user: UserCreate):
-    db = get_db()
-    cursor = db.cursor()
-
-    # Hash password before storing it
-    hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
+    # Hash password before storing it, and before taking the writer connection
+    hashed_password = passwords.hash_password(user.password)
 
-    cursor.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)", 
-                   (user.username, user.email, hashed_password))
-    db.commit()
-    db.close()
+    with pool.connection() as db:
+        repository.create_user(db, user.username, user.email, hashed_password)
+        db.commit()
 
     return {"msg": "User created successfully"}
 
 @app.post("/login/", tags=["User Management"])
-def login_user(username:str,password:str):
-    db = None
+def login_user(username:str,password:str, db: sqlite3.Connection = Depends(get_read_db)):
     try:
-        # Establish DB connection
-        db = get_db()
-        cursor = db.cursor()
-
         # Query user by username
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        db_user = cursor.fetchone()
+        db_user = repository.find_user(db, username)
 
         # Check if the user exists
         if not db_user:
             raise HTTPException(status_code=401, detail="Account not found")
 
         # Verify the password by comparing the hashed password in the database
-        if not bcrypt.checkpw(password.encode('utf-8'), db_user['password']):
+        matches, upgraded_hash = passwords.check_password(password, db_user['password'])
+        if not matches:
             raise HTTPException(status_code=400, detail="Invalid password")
 
-        # Generate token
+        # Stored with an outdated bcrypt cost, keep the hash computed during the check
+        if upgraded_hash:
+            with pool.connection() as writer_db:
+                repository.set_password(writer_db, db_user['id'], upgraded_hash)
+                writer_db.commit()
+
+        # Generate a short lived access token and a refresh token to renew it
         token = create_user_token(db_user['id'])
-        return {"token": token}
+        return {"token": token, "refresh_token": create_refresh_token(db_user['id'])}
 
-    except sqlite3.Error as db_err:
+    except HTTPException:
+        raise
+    except DatabaseError as db_err:
         logging.error(f"Database error: {db_err}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(db_err)}")
     except Exception as e:
         logging.error(f"Unexpected error occurred: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
-    finally:
-        # Safely close the database connection
-        if db:
-            db.close()
+
+@app.post("/token/refresh/", tags=["User Management"])
+def refresh_user_token(refresh_token: str, db: sqlite3.Connection = Depends(get_db)):
+    payload = decode_token(refresh_token, "refresh")
+
+    # Refresh tokens are single use, the old one is revoked when a new one is issued
+    if not revoke(db, payload):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    db.commit()
+    publish_revocation(payload)
+
+    return {"token": create_user_token(payload["user_id"]),
+            "refresh_token": create_refresh_token(payload["user_id"])}
+
+@app.post("/logout/", tags=["User Management"])
+def logout_user(token: str, refresh_token: Optional[str] = None, db: sqlite3.Connection = Depends(get_db)):
+    revoked = [decode_token(token)]
+    if refresh_token:
+        revoked.append(decode_token(refresh_token, "refresh"))
+    for payload in revoked:
+        revoke(db, payload)
+    db.commit()
+    for payload in revoked:
+        publish_revocation(payload)
+
+    return {"msg": "Logged out"}
 
 @app.post("/novels/", tags=["Novel Management"])
 def upload_novel(novel: NovelCreate, token:str):
-    print('got the token',token)
     user_id = verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute("INSERT INTO novels (title, description, content, user_id) VALUES (?, ?, ?, ?)", 
-                   (novel.title, novel.description, novel.content, user_id))
-    db.commit()
-    db.close()
+    # The id decides the shard, so it is allocated before the novel is written
+    novel_id = shards.new_novel_id()
+    with shards.pool_for(novel_id).connection() as db:
+        novel_id = repository.create_novel(db, user_id, novel.title, novel.description, novel.content, novel_id)
+        db.commit()
+    content_index.submit(novel_id)
+    # A new novel lands on the last page of each listing it belongs to
+    cache.invalidate("catalog:tail", f"user:{user_id}:tail")
 
     return {"msg": "Novel uploaded successfully"}
 
+@app.post("/novels/import/", tags=["Novel Management"])
+async def import_novels(request: Request, token: Optional[str] = None, job: Optional[str] = None):
+    user_id = verify_token(token)
+    repository.require_sqlite("Bulk import")
+    shards.require_single("Bulk import")
+
+    # NDJSON body, one novel per line, optionally gzipped. Same job name resumes after its checkpoint
+    report = await import_stream(request, user_id, job)
+    cache.invalidate("catalog:tail", f"user:{user_id}:tail")
+    content_index.sweep()
+
+    return report
+
 @app.post("/novels/like/", tags=["Novel Management"])
-def like_novel(like: LikeCreate, token: Optional[str] = None):
+def like_novel(like: LikeCreate, token: Optional[str] = None, durability: Durability = "commit"):
     user_id = verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
+    # Liking twice is a no-op, (novel_id, user_id) is unique
+    shards.writer_for(like.novel_id).submit(repository.ADD_LIKE, (like.novel_id, user_id), durability,
+                  on_commit=lambda: cache.invalidate(f"summary:{like.novel_id}"))
 
-    cursor.execute("INSERT INTO likes (novel_id, user_id) VALUES (?, ?)", 
-                   (like.novel_id, user_id))
+    return {"msg": "Liked the novel"}
+
+@app.delete("/novels/like/{novel_id}/", tags=["Novel Management"])
+def unlike_novel(novel_id: int, token: Optional[str] = None, db: sqlite3.Connection = Depends(get_novel_db)):
+    user_id = verify_token(token)
+
+    repository.remove_like(db, novel_id, user_id)
     db.commit()
-    db.close()
+    cache.invalidate(f"summary:{novel_id}")
 
-    return {"msg": "Liked the novel"}
+    return {"msg": "Like removed"}
 
 @app.post("/novels/comment/", tags=["Novel Management"])
-def comment_novel(comment: CommentCreate, token: Optional[str] = None):
+def comment_novel(comment: CommentCreate, token: Optional[str] = None, durability: Durability = "commit"):
     user_id = verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute("INSERT INTO comments (novel_id, user_id, text) VALUES (?, ?, ?)", 
-                   (comment.novel_id, user_id, comment.text))
-    db.commit()
-    db.close()
+    shards.writer_for(comment.novel_id).submit(repository.ADD_COMMENT, (comment.novel_id, user_id, comment.text), durability,
+                  on_commit=lambda: cache.invalidate(f"summary:{comment.novel_id}"))
 
     return {"msg": "Comment added"}
 
 @app.post("/wishlist/", tags=["Novel Management"])
-def add_to_wishlist(wishlist: WishListCreate, token: Optional[str] = None):
+def add_to_wishlist(wishlist: WishListCreate, token: Optional[str] = None, durability: Durability = "commit"):
     user_id = verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute("INSERT INTO wishlists (novel_id, user_id) VALUES (?, ?)", 
-                   (wishlist.novel_id, user_id))
-    db.commit()
-    db.close()
+    shards.writer_for(wishlist.novel_id).submit(repository.ADD_TO_WISHLIST, (wishlist.novel_id, user_id), durability,
+                  on_commit=lambda: cache.invalidate(f"summary:{wishlist.novel_id}"))
 
     return {"msg": "Added to wishlist"}
 
-@app.get("/novels/{novel_id}/download/", tags=["Novel Management"])
-def download_novel(novel_id: int):
-    db = get_db()
-    cursor = db.cursor()
+@app.delete("/wishlist/{novel_id}/", tags=["Novel Management"])
+def remove_from_wishlist(novel_id: int, token: Optional[str] = None,
+                         db: sqlite3.Connection = Depends(get_novel_db)):
+    user_id = verify_token(token)
 
-    cursor.execute("SELECT * FROM novels WHERE id = ?", (novel_id,))
-    novel = cursor.fetchone()
-    db.close()
+    repository.remove_from_wishlist(db, novel_id, user_id)
+    db.commit()
+    cache.invalidate(f"summary:{novel_id}")
 
-    if not novel:
-        raise HTTPException(status_code=404, detail="Novel not found")
+    return {"msg": "Novel removed from wishlist"}
 
-    return novel
+@app.get("/novels/{novel_id}/download/", tags=["Novel Management"])
+def download_novel(novel_id: int, request: Request):
+    repository.require_sqlite("Ranged download")
+    # Streams text/plain in chunks, honouring Range, If-None-Match and Accept-Encoding
+    return stream_novel(request, novel_id, shards.read_pool_for(novel_id))
 
 @app.put("/novels/{novel_id}/", tags=["Novel Management"])
-def update_novel(novel_id: int, novel: NovelCreate, token: Optional[str] = None):
+def update_novel(novel_id: int, novel: NovelCreate, token: Optional[str] = None,
+                 db: sqlite3.Connection = Depends(get_novel_db)):
     user_id = verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
     # Update the novel's title, description, and content if the user owns the novel
-    query = "UPDATE novels SET title = ?, description = ?, content = ? WHERE id = ? AND user_id = ?"
-    cursor.execute(query, (novel.title, novel.description, novel.content, novel_id, user_id))
+    updated = repository.update_novel(db, novel_id, user_id, novel.title, novel.description, novel.content)
     db.commit()
-    db.close()
+    if updated:
+        cache.invalidate(f"summary:{novel_id}", f"novel:{novel_id}")
+        content_index.submit(novel_id)
 
     return {"msg": "Novel updated successfully"}
 
 @app.delete("/novels/{novel_id}/", tags=["Novel Management"])
-def delete_novel(novel_id: int, token: Optional[str] = None):
+def delete_novel(novel_id: int, token: Optional[str] = None, db: sqlite3.Connection = Depends(get_novel_db)):
     user_id = verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
     # Delete the novel only if the user is the one who uploaded it
-    cursor.execute("DELETE FROM novels WHERE id = ? AND user_id = ?", (novel_id, user_id))
+    deleted = repository.delete_novel(db, novel_id, user_id)
     db.commit()
-    db.close()
+    if deleted:
+        cache.invalidate(f"summary:{novel_id}", f"novel:{novel_id}")
+        content_index.submit(novel_id)
 
     return {"msg": "Novel deleted successfully"}
 
 @app.get("/users/{user_id}/novels/", tags=["User Management"])
-def get_user_novels(user_id: int):
-    db = get_db()
-    cursor = db.cursor()
+def get_user_novels(user_id: int, request: Request, cursor: Optional[str] = None,
+                    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Summaries only, the full text comes from GET /novels/{novel_id}/
+    def build():
+        page = shards.list_novel_summaries(cursor, limit, user_id=user_id)
+        return page, page_tags(page, f"user:{user_id}:tail")
+    return cached_json(request, ("user_novels", user_id, cursor, limit), build)
+
+@app.get("/users/{user_id}/wishlist/", tags=["User Management"])
+def get_user_wishlist(user_id: int, cursor: Optional[str] = None,
+                      limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Summaries of the wishlisted novels, ordered by novel id
+    return shards.list_wishlist(user_id, cursor, limit)
+
+@app.get("/users/{user_id}/recommendations/", tags=["User Management"])
+def get_user_recommendations(user_id: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Neighbours of what the user liked or wishlisted, the most liked novels for a user with neither
+    ranked = recommend(shards, user_id, limit)
+    if not ranked:
+        return {"items": shards.top_novels("likes", limit)}
+    return {"items": _with_scores(ranked)}
+
+def _with_scores(ranked):
+    novels = shards.fetch_novels([novel_id for novel_id, _ in ranked])["items"]
+    return [dict(novel, score=score) for novel, (_, score) in zip(novels, ranked) if novel]
 
-    cursor.execute("SELECT * FROM novels WHERE user_id = ?", (user_id,))
-    novels = cursor.fetchall()
-    db.close()
+@app.get("/novels/", tags=["Novel Management"])
+def get_all_novels(request: Request, cursor: Optional[str] = None,
+                   limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Summaries only, the full text comes from GET /novels/{novel_id}/
+    def build():
+        page = shards.list_novel_summaries(cursor, limit)
+        return page, page_tags(page, "catalog:tail")
+    return cached_json(request, ("novels", cursor, limit), build)
+
+# Declared before /novels/{novel_id}/ so "top" is not taken for a novel id
+@app.get("/novels/top/", tags=["Novel Management"])
+def get_top_novels(by: Literal["likes", "comments", "wishlists"] = "likes",
+                   limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE)):
+    # Served from novel_stats and its counter indexes, no COUNT(*) at read time
+    return shards.top_novels(by, limit)
+
+# Declared before /novels/{novel_id}/ so "search" is not taken for a novel id
+@app.get("/novels/search/", tags=["Novel Management"])
+def search_catalog(q: str = Query(..., min_length=1, max_length=200), cursor: Optional[str] = None,
+                   limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                   db: sqlite3.Connection = Depends(get_read_db)):
+    repository.require_sqlite("Search")
+    shards.require_single("Search")
+    # Ranked by BM25 over title, description and chapter text, with highlighted snippets
+    return search_novels(db, q, cursor, limit)
+
+# Declared before /novels/{novel_id}/ so "batch" is not taken for a novel id
+@app.get("/novels/batch/", tags=["Novel Management"])
+def get_novels_batch(ids: str, projection: Projection = "summary"):
+    # ids=3,1,7 comes back in that order, with null for ids that do not exist
+    return shards.fetch_novels(parse_ids(ids, projection), projection)
+
+@app.post("/novels/batch/", tags=["Novel Management"])
+def post_novels_batch(batch: NovelBatch):
+    # Same as GET, for id lists too long for a query string
+    return shards.fetch_novels(check_ids(batch.ids, batch.projection), batch.projection)
 
-    return novels
+@app.get("/novels/{novel_id}/", tags=["Novel Management"])
+def get_novel_details(novel_id: int, request: Request, db: sqlite3.Connection = Depends(get_novel_read_db)):
+    def build():
+        novel = repository.get_novel(db, novel_id)
 
-@app.get("/novels/", tags=["Novel Management"])
-def get_all_novels():
-    db = get_db()
-    cursor = db.cursor()
+        if not novel:
+            raise HTTPException(status_code=404, detail="Novel not found")
 
-    cursor.execute("SELECT * FROM novels")
-    novels = cursor.fetchall()
-    db.close()
+        return novel, {f"novel:{novel_id}"}
+    return cached_json(request, ("novel", novel_id), build)
 
-    return novels
+@app.get("/novels/{novel_id}/similar/", tags=["Novel Management"])
+def get_similar_novels(novel_id: int, by: Literal["readers", "content"] = "readers",
+                       limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+                       db: sqlite3.Connection = Depends(get_novel_read_db)):
+    if not repository.novel_exists(db, novel_id):
+        raise HTTPException(status_code=404, detail="Novel not found")
 
-@app.get("/novels/{novel_id}/", tags=["Novel Management"])
-def get_novel_details(novel_id: int):
-    db = get_db()
-    cursor = db.cursor()
+    # Readers also liked from recommendations.py, or closest text from content_similarity.py
+    neighbours = similar_to if by == "readers" else similar_by_content
+    return {"items": _with_scores(neighbours(db, novel_id, limit))}
 
-    cursor.execute("SELECT * FROM novels WHERE id = ?", (novel_id,))
-    novel = cursor.fetchone()
-    db.close()
+@app.get("/novels/{novel_id}/chapters/", tags=["Novel Management"])
+def get_novel_chapters(novel_id: int, db: sqlite3.Connection = Depends(get_novel_read_db)):
+    if not repository.novel_exists(db, novel_id):
+        raise HTTPException(status_code=404, detail="Novel not found")
+
+    return list_chapters(db, novel_id)
+
+@app.get("/novels/{novel_id}/chapters/{position}/", tags=["Novel Management"])
+def get_novel_chapter(novel_id: int, position: int, db: sqlite3.Connection = Depends(get_novel_read_db)):
+    chapter = repository.get_chapter(db, novel_id, position)
+
+    if not chapter:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+
+    return chapter
+
+@app.put("/novels/{novel_id}/chapters/{position}/", tags=["Novel Management"])
+def update_novel_chapter(novel_id: int, position: int, chapter: ChapterUpdate, token: Optional[str] = None,
+                         db: sqlite3.Connection = Depends(get_novel_db)):
+    user_id = verify_token(token)
 
+    novel = repository.novel_author(db, novel_id)
     if not novel:
         raise HTTPException(status_code=404, detail="Novel not found")
+    if novel["user_id"] != user_id:
+        raise HTTPException(status_code=403, detail="Not the author of this novel")
+
+    # Replace an existing chapter or append right after the last one
+    count = repository.chapter_count(db, novel_id)
+    if not 1 <= position <= count + 1:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+
+    title = chapter.title
+    if title is None and position > count:
+        title = f"Part {position}"
+    write_chapter(db, novel_id, position, title, chapter.content)
+    db.commit()
+    cache.invalidate(f"novel:{novel_id}")
+    content_index.submit(novel_id)
 
-    return novel
+    return {"msg": "Chapter updated successfully"}
+
+@app.get("/export/", tags=["Data Export"])
+def export_data(request: Request, token: Optional[str] = None, tables: Optional[str] = None,
+                since: Optional[str] = None, content: bool = True):
+    user_id = verify_token(token)
+    repository.require_sqlite("Export")
+    shards.require_single("Export")
+
+    # NDJSON straight off the database cursors, the last line is the watermark for `since`.
+    # Emails are left out unless the caller is an operator
+    return stream_export(request, tables, since, content, personal=is_admin(user_id))
+
+@app.get("/metrics", tags=["Monitoring"])
+def get_metrics():
+    # Prometheus text exposition format
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/cache/stats/", tags=["Monitoring"])
+def get_cache_stats():
+    return cache.stats()
+
+@app.get("/admin/slow-queries/", tags=["Monitoring"])
+def get_slow_queries(token: Optional[str] = None, flagged: bool = False,
+                     limit: int = Query(100, ge=1, le=slow_queries.LOG_SIZE)):
+    # Query plans and timings are for operators only
+    verify_admin(token)
+    # Newest first, `flagged` keeps only statements whose plan scans a hot table
+    return {
+        "threshold_ms": slow_queries.THRESHOLD * 1000,
+        "sample_rate": slow_queries.SAMPLE_RATE,
+        "hot_tables": sorted(slow_queries.HOT_TABLES),
+        **slow_queries.stats(),
+        "entries": slow_queries.entries(flagged, limit),
+    }
+
+@app.delete("/admin/slow-queries/", tags=["Monitoring"])
+def clear_slow_queries(token: Optional[str] = None):
+    verify_admin(token)
+    slow_queries.clear()
+    return {"msg": "Slow query log cleared"}
 
 @app.put("/users/{user_id}/", tags=["User Management"])
 def update_user_profile(user_id: int, profile: ProfileUpdate, token: Optional[str] = None):
     verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute("UPDATE users SET username = ?, email = ?, password = ? WHERE id = ?", 
-                   (profile.username, profile.email, bcrypt.hashpw(profile.password.encode('utf-8'), bcrypt.gensalt()), user_id))
-    db.commit()
-    db.close()
+    hashed_password = passwords.hash_password(profile.password)
+    with pool.connection() as db:
+        repository.update_user(db, user_id, profile.username, profile.email, hashed_password)
+        db.commit()
+    cache.invalidate(f"author:{user_id}")
 
     return {"msg": "User profile updated successfully"}
 
 @app.delete("/users/{user_id}/", tags=["User Management"])
-def delete_user(user_id: int, token: Optional[str] = None):
+def delete_user(user_id: int, token: Optional[str] = None, db: sqlite3.Connection = Depends(get_db)):
     verify_token(token)
 
-    db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    repository.delete_user(db, user_id)
     db.commit()
-    db.close()
+    cache.invalidate(f"author:{user_id}")
 
     return {"msg": "User deleted successfully"}
@@ -0,0 +1,350 @@
+"""Request, database and password hashing metrics in Prometheus text format.
+
+MetricsMiddleware times every request under its route template
+("/novels/{novel_id}/", not "/novels/42/") and counts responses by
+status. Connections from connect() are TimedConnections, which add each
+statement's time and rows to the request being served. Statements that
+open a write transaction count as lock wait too: with WAL, a single
+row write takes microseconds, so their time is mostly spent waiting for
+the write lock.
+
+Statements slower than the slow query threshold are also handed to
+slow_queries.py, which keeps them with their query plans.
+
+Recording is a few dict updates under one lock per request. Formatting
+only happens when /metrics is scraped.
+"""
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import slow_queries
+
+# Upper bounds in seconds, shared by every latency histogram
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, values, amount):
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, amount)] += 1
+        series[-1] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, series in sorted(self._series.items()):
+            labels = _labels(self.labels, values)
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{_braced(labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_braced(labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels, kind="counter"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.kind = kind
+        self._series = {}
+
+    def add(self, values, amount=1):
+        self._series[values] = self._series.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_braced(_labels(self.labels, values))} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _braced(labels):
+    return f"{{{labels}}}" if labels else ""
+
+
+requests_total = Counter("novel_http_requests_total", "Responses by route and status", ("route", "method", "status"))
+request_seconds = Histogram("novel_http_request_duration_seconds", "Request latency until the last body byte",
+                            ("route", "method"))
+in_flight = Counter("novel_http_requests_in_flight", "Requests being served", ("route", "method"), kind="gauge")
+db_queries = Counter("novel_db_queries_total", "SQL statements executed", ("route",))
+db_rows = Counter("novel_db_rows_total", "Rows fetched from SQLite", ("route",))
+db_seconds = Histogram("novel_db_seconds", "Time per request spent in SQLite, lock wait included", ("route",))
+db_lock_wait = Histogram("novel_db_lock_wait_seconds", "Time per request spent opening write transactions",
+                         ("route",))
+pool_wait = Histogram("novel_db_pool_wait_seconds", "Time spent waiting for a free pooled connection", ())
+password_seconds = Histogram("novel_password_hash_seconds", "bcrypt hash or check time, queueing included",
+                             ("operation",))
+password_rejected = Counter("novel_password_rejected_total", "Hash calls turned away with 503", ())
+json_seconds = Histogram("novel_json_encode_seconds", "JSON encoding of cached responses", ())
+db_slow = Counter("novel_db_slow_statements_total", "Statements over the slow query threshold", ("route",))
+
+METRICS = (requests_total, request_seconds, in_flight, db_queries, db_rows, db_seconds, db_lock_wait,
+           pool_wait, password_seconds, password_rejected, json_seconds, db_slow)
+
+# Called on scrape, each returns extra exposition lines
+_collectors = []
+
+
+def add_collector(collect):
+    _collectors.append(collect)
+
+
+def observe(metric, amount, *values):
+    with _lock:
+        metric.observe(values, amount)
+
+
+def count(metric, *values, amount=1):
+    with _lock:
+        metric.add(values, amount)
+
+
+def render():
+    with _lock:
+        lines = [line for metric in METRICS for line in metric.render()]
+    for collect in _collectors:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+
+def gauge_lines(name, help, values, kind="gauge"):
+    """Exposition lines for a dict of unlabelled values, used by collectors."""
+    lines = []
+    for key, value in values.items():
+        lines += [f"# HELP {name}_{key} {help}", f"# TYPE {name}_{key} {kind}", f"{name}_{key} {value}"]
+    return lines
+
+
+class DatabaseTime:
+    """SQLite work done on behalf of one request."""
+
+    __slots__ = ("route", "queries", "rows", "seconds", "lock_wait")
+
+    def __init__(self, route=None):
+        self.route = route
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.lock_wait = 0.0
+
+
+_current = ContextVar("novel_db_time", default=None)
+
+
+def _record_statement(connection, elapsed, was_in_transaction, sql):
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.seconds += elapsed
+    if not was_in_transaction and (connection.in_transaction or sql.lstrip()[:5].upper() == "BEGIN"):
+        stats.lock_wait += elapsed
+
+
+def _record_fetch(elapsed, rows):
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.rows += rows
+    stats.seconds += elapsed
+
+
+class TimedCursor(sqlite3.Cursor):
+    # The last statement, its time and rows so far, and its slow log entry:
+    # None until it crosses the threshold, False when sampled out
+    _statement = None
+    _elapsed = 0.0
+    _rows = 0
+    _slow = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        was_in_transaction = self.connection.in_transaction
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(started, was_in_transaction, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        was_in_transaction = self.connection.in_transaction
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._executed(started, was_in_transaction, sql, seq_of_parameters)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._fetched(started, 1)
+        return row
+
+    def _executed(self, started, was_in_transaction, sql, parameters):
+        elapsed = time.perf_counter() - started
+        _record_statement(self.connection, elapsed, was_in_transaction, sql)
+        self._statement = sql, parameters
+        self._elapsed = elapsed
+        self._rows = 0
+        self._slow = None
+        self._check_slow()
+
+    def _fetched(self, started, rows):
+        elapsed = time.perf_counter() - started
+        _record_fetch(elapsed, rows)
+        if self._statement is not None:
+            self._elapsed += elapsed
+            self._rows += rows
+            self._check_slow()
+
+    def _check_slow(self):
+        if self._slow:
+            self._slow["duration_ms"] = round(self._elapsed * 1000, 3)
+            self._slow["rows"] = self._rows
+        elif self._slow is None and self._elapsed >= slow_queries.THRESHOLD:
+            stats = _current.get()
+            route = stats.route if stats is not None else None
+            count(db_slow, route or "none")
+            sql, parameters = self._statement
+            self._slow = slow_queries.capture(self.connection, sql, parameters, self._elapsed, self._rows,
+                                              route) or False
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements and fetches count towards the current request."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute() would bypass cursor(), so go through it explicitly
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            stats = _current.get()
+            if stats is not None:
+                stats.seconds += time.perf_counter() - started
+
+
+def _record_database(route, stats):
+    with _lock:
+        db_queries.add((route,), stats.queries)
+        db_rows.add((route,), stats.rows)
+        db_seconds.observe((route,), stats.seconds)
+        if stats.lock_wait:
+            db_lock_wait.observe((route,), stats.lock_wait)
+
+
+@contextmanager
+def database_time(route):
+    """Attribute SQLite work outside of a request, such as a group commit, to route."""
+    stats = DatabaseTime(route)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        _record_database(route, stats)
+
+
+def route_template(scope):
+    from starlette.routing import Match
+
+    partial = None
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and database time per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope)
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = DatabaseTime(route)
+        token = _current.set(stats)
+        count(in_flight, route, method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            with _lock:
+                in_flight.add((route, method), -1)
+                requests_total.add((route, method, str(status)))
+                request_seconds.observe((route, method), elapsed)
+            _record_database(route, stats)
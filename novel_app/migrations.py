@@ -0,0 +1,248 @@
+"""Numbered schema migrations.
+
+Applied versions are recorded in schema_migrations. Pending migrations run
+in order at startup, or offline with:
+
+    python migrations.py status  [--db novel_db.db]
+    python migrations.py upgrade [--db novel_db.db] [--to VERSION]
+
+Every migration must be safe to run again after an interruption. Data
+migrations commit in batches so the server keeps serving while they run.
+New schema changes are appended to MIGRATIONS, never edited in place.
+"""
+import argparse
+import logging
+import time
+
+from bulk_import import create_import_checkpoints
+from chapters import migrate_inline_content
+from content_similarity import create_content_index, create_content_postings
+from export import create_change_tracking
+from recommendations import create_similarity_index
+from search import create_search_index
+from stats import create_stats
+
+# Rows visited per transaction by data migrations
+BATCH_SIZE = 5000
+
+
+def add_column_if_missing(db, table, column, definition):
+    columns = [row["name"] for row in db.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def create_tables(db):
+    # Create the 'users' table
+    db.execute("""CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )
+    """)
+
+    # Create the 'novels' table
+    db.execute("""CREATE TABLE IF NOT EXISTS novels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            content TEXT,
+            user_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+    # Create the 'likes' table
+    db.execute("""CREATE TABLE IF NOT EXISTS likes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER,
+            user_id INTEGER,
+            FOREIGN KEY (novel_id) REFERENCES novels(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+    # Create the 'comments' table
+    db.execute("""CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER,
+            user_id INTEGER,
+            text TEXT,
+            FOREIGN KEY (novel_id) REFERENCES novels(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+    # Create the 'wishlists' table
+    db.execute("""CREATE TABLE IF NOT EXISTS wishlists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER,
+            user_id INTEGER,
+            FOREIGN KEY (novel_id) REFERENCES novels(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+
+def create_chapters(db):
+    # Derived from the chapter hashes, used as the download ETag
+    add_column_if_missing(db, "novels", "content_etag", "TEXT")
+
+    # Create the 'novel_chapters' table, novels.content is only read to migrate old rows
+    db.execute("""CREATE TABLE IF NOT EXISTS novel_chapters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            title TEXT,
+            content TEXT,
+            content_hash TEXT NOT NULL,
+            byte_length INTEGER NOT NULL,
+            UNIQUE (novel_id, position),
+            FOREIGN KEY (novel_id) REFERENCES novels(id)
+        )
+    """)
+    db.commit()
+    migrate_inline_content(db)
+
+
+def add_lookup_indexes(db):
+    # Every per-novel and per-user lookup used to scan the whole table
+    db.execute("CREATE INDEX IF NOT EXISTS idx_likes_novel_id ON likes (novel_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_likes_user_id ON likes (user_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_comments_novel_id ON comments (novel_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_wishlists_user_id ON wishlists (user_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_novels_user_id ON novels (user_id)")
+
+
+def _delete_duplicates(db, table, after_id, up_to_id):
+    """Delete rows in (after_id, up_to_id] that repeat an earlier (novel_id, user_id) pair."""
+    return db.execute(f"""
+        DELETE FROM {table} WHERE id IN (
+            SELECT id FROM {table} AS later
+            WHERE later.id > ? AND later.id <= ? AND EXISTS (
+                SELECT 1 FROM {table} AS earlier
+                WHERE earlier.novel_id = later.novel_id AND earlier.user_id = later.user_id
+                  AND earlier.id < later.id
+            )
+        )
+    """, (after_id, up_to_id)).rowcount
+
+
+def _dedupe_and_enforce_unique(db, table, index_name):
+    """Remove repeated (novel_id, user_id) rows batch by batch, then add a unique index.
+
+    The first row of each pair is kept. Delete triggers keep novel_stats in step.
+    """
+    removed = 0
+    last_id = 0
+    max_id = db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    while last_id < max_id:
+        removed += _delete_duplicates(db, table, last_id, last_id + BATCH_SIZE)
+        db.commit()
+        last_id += BATCH_SIZE
+
+    # Rows written by the live server meanwhile are cleaned up under the write lock,
+    # in the same transaction that creates the index
+    db.execute("BEGIN IMMEDIATE")
+    max_id = db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    removed += _delete_duplicates(db, table, last_id, max_id)
+    db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table} (novel_id, user_id)")
+    db.commit()
+    if removed:
+        logging.info(f"Removed {removed} duplicate rows from {table}")
+
+
+def enforce_unique_engagement(db):
+    _dedupe_and_enforce_unique(db, "likes", "ux_likes_novel_user")
+    _dedupe_and_enforce_unique(db, "wishlists", "ux_wishlists_novel_user")
+    # The unique index starts with novel_id, so this one only slows down writes now
+    db.execute("DROP INDEX IF EXISTS idx_likes_novel_id")
+
+
+def create_revoked_tokens(db):
+    # Revoked token ids, kept until the token would have expired anyway
+    db.execute("""CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti TEXT PRIMARY KEY,
+            expires_at INTEGER NOT NULL
+        )
+    """)
+
+
+def index_compressed_chapters(db):
+    # chapters_fts read novel_chapters.content directly, which is compressed from now on
+    for trigger in ("chapters_fts_insert", "chapters_fts_delete", "chapters_fts_update"):
+        db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    db.execute("DROP TABLE IF EXISTS chapters_fts")
+    create_search_index(db)
+
+
+MIGRATIONS = [
+    (1, "create base tables", create_tables),
+    (2, "store novel text as chapters", create_chapters),
+    (3, "full-text search index", create_search_index),
+    (4, "engagement counters", create_stats),
+    (5, "lookup indexes on foreign keys", add_lookup_indexes),
+    (6, "unique likes and wishlist entries", enforce_unique_engagement),
+    (7, "revoked tokens", create_revoked_tokens),
+    (8, "search index over compressed chapter text", index_compressed_chapters),
+    (9, "change timestamps for incremental exports", create_change_tracking),
+    (10, "bulk import checkpoints", create_import_checkpoints),
+    (11, "similar novel lists", create_similarity_index),
+    (12, "content similarity index", create_content_index),
+    (13, "content postings for incremental indexing", create_content_postings),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db.commit()
+    return db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+
+def run_migrations(db, target=LATEST_VERSION):
+    """Apply every migration above the recorded version, up to target."""
+    version = current_version(db)
+    for number, name, migrate in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        started = time.perf_counter()
+        logging.info(f"Applying migration {number}: {name}")
+        migrate(db)
+        db.execute("INSERT OR IGNORE INTO schema_migrations (version, name) VALUES (?, ?)", (number, name))
+        db.commit()
+        logging.info(f"Migration {number} done in {time.perf_counter() - started:.1f}s")
+        version = number
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or upgrade the novel database schema")
+    parser.add_argument("command", choices=["status", "upgrade"])
+    parser.add_argument("--db", help="database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    parser.add_argument("--to", type=int, default=LATEST_VERSION, help="stop after this version")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from database import connect
+
+    db = connect(args.db)
+    version = current_version(db)
+    if args.command == "upgrade":
+        version = run_migrations(db, args.to)
+    else:
+        for number, name, _ in MIGRATIONS:
+            print(f"{'applied' if number <= version else 'pending':8} {number:3}  {name}")
+    print(f"Schema version {version} (latest {LATEST_VERSION})")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Password hashing off the request threads.
+
+bcrypt is CPU bound by design. Running it inline lets a burst of logins
+occupy every thread Starlette has, and catalog reads then queue behind
+it. Hashes are computed in a small process pool instead. At most
+MAX_PENDING calls may be queued or running at once; anything beyond
+that is rejected with 503 straight away instead of waiting.
+
+Pick the bcrypt cost for this machine with:
+
+    python passwords.py calibrate --target-ms 250
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from fastapi import HTTPException
+
+import metrics
+
+WORKERS = int(os.environ.get("NOVEL_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+MAX_PENDING = int(os.environ.get("NOVEL_HASH_MAX_PENDING", WORKERS * 4))
+
+# Cost used for new hashes. Hashes with another cost are upgraded on login.
+ROUNDS = int(os.environ.get("NOVEL_BCRYPT_ROUNDS", "12"))
+# When set, startup measures this machine and overrides ROUNDS
+TARGET_MS = os.environ.get("NOVEL_BCRYPT_TARGET_MS")
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password: bytes, hashed: bytes, rounds: int):
+    """Verify a password and, when its cost is outdated, return a fresh hash too."""
+    if not bcrypt.checkpw(password, hashed):
+        return False, None
+    if hash_rounds(hashed) != rounds:
+        return True, _hash(password, rounds)
+    return True, None
+
+
+def hash_rounds(hashed: bytes) -> int:
+    # $2b$12$<salt+hash>
+    try:
+        return int(hashed.split(b"$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def start():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, forking a threaded server process is not safe
+            _executor = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        metrics.count(metrics.password_rejected)
+        raise HTTPException(status_code=503, detail="Server busy, try again shortly", headers={"Retry-After": "1"})
+    started = time.perf_counter()
+    try:
+        return start().submit(fn, *args).result()
+    finally:
+        _slots.release()
+        metrics.observe(metrics.password_seconds, time.perf_counter() - started, fn.__name__.lstrip("_"))
+
+
+def _as_bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+
+def hash_password(password: str) -> bytes:
+    return _submit(_hash, password.encode("utf-8"), ROUNDS)
+
+
+def check_password(password: str, hashed):
+    """Return (matches, new_hash). new_hash is set when the stored cost should be upgraded."""
+    return _submit(_check, password.encode("utf-8"), _as_bytes(hashed), ROUNDS)
+
+
+def calibrate(target_ms: float, samples: int = 3) -> int:
+    """Highest cost whose hash time stays within target_ms on this machine."""
+    chosen = MIN_ROUNDS
+    password = b"calibration password"
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        started = time.perf_counter()
+        for _ in range(samples):
+            _hash(password, rounds)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / samples
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+    return chosen
+
+
+def configure():
+    """Called on startup, applies NOVEL_BCRYPT_TARGET_MS when it is set."""
+    global ROUNDS
+    if TARGET_MS:
+        ROUNDS = calibrate(float(TARGET_MS))
+    start()
+    return ROUNDS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the bcrypt cost that fits a latency budget")
+    parser.add_argument("command", choices=["calibrate"])
+    parser.add_argument("--target-ms", type=float, default=250)
+    args = parser.parse_args()
+
+    rounds = calibrate(args.target_ms)
+    print(f"bcrypt cost {rounds} fits {args.target_ms:.0f} ms, run the server with NOVEL_BCRYPT_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    main()
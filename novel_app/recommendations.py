@@ -0,0 +1,375 @@
+"""Item-to-item "readers also liked" recommendations.
+
+Likes and wishlist entries form a user x novel interaction matrix X. Two
+novels are similar when the same readers picked both, scored by cosine
+over X:
+
+    score(a, b) = co(a, b) / sqrt(n(a) * n(b))
+
+where co(a, b) counts readers of both and n(a) the readers of a. Pairs
+seen fewer than MIN_COOCCURRENCE times are dropped. The top SIMILAR_K
+neighbours of every novel are stored in similar_novels, in the shard of
+the novel, so serving a novel's list is one primary key range lookup, and
+a reader's recommendations are the lists of what they liked, summed.
+
+The lists are computed with NumPy, CHUNK_PAIRS co-occurrences at a time:
+the interactions are sorted by reader, every novel of a chunk is paired
+with the other novels of each of its readers, the pairs are counted with
+np.unique and the top SIMILAR_K per novel kept. A reader contributes at
+most MAX_USER_ITEMS novels, past that they add pairs quadratically and
+little signal.
+
+Recommender runs in the background. Its SimilarityIndex keeps the
+interactions it has read, so a refresh reads only the likes and wishlist
+entries added since the last run and recomputes the lists of every novel
+their readers interacted with. Every FULL_REBUILD_INTERVAL seconds, and
+on the first run, it reads and rebuilds everything, which also accounts
+for removed likes. Offline:
+
+    python recommendations.py rebuild [--db novel_db.db]
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from itertools import chain
+
+import numpy as np
+
+SIMILAR_K = int(os.environ.get("NOVEL_SIMILAR_K", 20))
+MIN_COOCCURRENCE = int(os.environ.get("NOVEL_SIMILAR_MIN_COOCCURRENCE", 2))
+MAX_USER_ITEMS = int(os.environ.get("NOVEL_SIMILAR_MAX_USER_ITEMS", 500))
+CHUNK_PAIRS = int(os.environ.get("NOVEL_SIMILAR_CHUNK_PAIRS", 4_000_000))
+REFRESH_INTERVAL = float(os.environ.get("NOVEL_RECOMMEND_INTERVAL", 30))
+FULL_REBUILD_INTERVAL = float(os.environ.get("NOVEL_RECOMMEND_FULL_REBUILD", 3600))
+# Most recent interactions of a reader looked at when recommending to them
+PROFILE_SIZE = 200
+
+# Engagement tables read as interactions, with the id column tracking what was added
+SOURCES = ("likes", "wishlists")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS similar_novels (
+            novel_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            similar_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (novel_id, position)
+        ) WITHOUT ROWID
+    """,
+    # Highest likes.id and wishlists.id covered by similar_novels
+    """CREATE TABLE IF NOT EXISTS similar_novels_marks (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+    """,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def create_similarity_index(db):
+    for statement in SCHEMA:
+        db.execute(statement)
+
+
+# Building
+
+def read_interactions(db, after=None):
+    """(user_id, novel_id, id) rows of one file as an n x 3 array, and the highest id of each source.
+
+    With after, the marks of an earlier read, only the rows added since.
+    """
+    after = after or {}
+    marks = {source: db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {source}").fetchone()[0] for source in SOURCES}
+    cursor = db.execute(
+        " UNION ALL ".join(
+            f"SELECT user_id, novel_id, id FROM {source} WHERE user_id IS NOT NULL AND novel_id IS NOT NULL "
+            f"AND id > {after.get(source, 0)} AND id <= {marks[source]}"
+            for source in SOURCES
+        )
+    )
+    rows = np.fromiter(chain.from_iterable(cursor), dtype=np.int64).reshape(-1, 3)
+    return rows, marks
+
+
+class Interactions:
+    """Deduplicated interactions sorted by reader, with novels numbered 0..n-1."""
+
+    def __init__(self, rows):
+        # Newest first within each reader, so the cap below drops their oldest picks
+        order = np.lexsort((-rows[:, 2], rows[:, 0]))
+        users, items = rows[order, 0], rows[order, 1]
+        # A novel both liked and wishlisted counts once
+        seen = np.unique(users * (items.max(initial=0) + 1) + items, return_index=True)[1]
+        keep = np.zeros(len(users), dtype=bool)
+        keep[seen] = True
+        users, items = users[keep], items[keep]
+        # Cap every reader at MAX_USER_ITEMS
+        _, user_index, lengths = np.unique(users, return_inverse=True, return_counts=True)
+        starts = np.cumsum(lengths) - lengths
+        keep = np.arange(len(users)) - starts[user_index] < MAX_USER_ITEMS
+        users, items = users[keep], items[keep]
+
+        self.item_ids, self.items = np.unique(items, return_inverse=True)
+        self.user_ids, self.users, self.lengths = np.unique(users, return_inverse=True, return_counts=True)
+        # Half the memory traffic of the default int64 while pairing
+        self.items, self.users = self.items.astype(np.int32), self.users.astype(np.int32)
+        self.starts = np.cumsum(self.lengths) - self.lengths
+        # Readers of every novel
+        self.readers = np.bincount(self.items, minlength=len(self.item_ids))
+
+    def __len__(self):
+        return len(self.items)
+
+    def targets_of(self, user_ids):
+        """Novels (as indexes) any of user_ids interacted with."""
+        users = np.flatnonzero(np.isin(self.user_ids, user_ids))
+        return np.unique(self.items[np.isin(self.users, users)])
+
+
+def _chunks(interactions, targets):
+    """Split targets so that pairing each chunk with its readers' novels makes about CHUNK_PAIRS pairs."""
+    # Every interaction of novel a pairs a with the other novels of that reader
+    pairs_per_item = np.bincount(interactions.items, weights=interactions.lengths[interactions.users] - 1,
+                                 minlength=len(interactions.item_ids))[targets]
+    bounds = np.searchsorted(np.cumsum(pairs_per_item), np.arange(CHUNK_PAIRS, pairs_per_item.sum(), CHUNK_PAIRS))
+    return np.split(targets, np.unique(bounds))
+
+
+def _top_neighbours(interactions, chunk):
+    """(novel, neighbour, score, position) arrays, as indexes, for the novels in chunk."""
+    n_items = len(interactions.item_ids)
+    entries = np.flatnonzero(np.isin(interactions.items, chunk))
+    users = interactions.users[entries]
+    lengths = interactions.lengths[users]
+    # For every entry, the positions of all novels of the same reader
+    total = lengths.sum()
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    left = np.repeat(interactions.items[entries], lengths)
+    right = interactions.items[np.repeat(interactions.starts[users], lengths) + offsets]
+    distinct = left != right
+    keys, counts = np.unique(left[distinct].astype(np.int64) * n_items + right[distinct], return_counts=True)
+
+    frequent = counts >= MIN_COOCCURRENCE
+    keys, counts = keys[frequent], counts[frequent]
+    left, right = keys // n_items, keys % n_items
+    scores = counts / np.sqrt(interactions.readers[left].astype(np.float64) * interactions.readers[right])
+
+    # Best first within each novel, ties to the lower id
+    order = np.lexsort((right, -scores, left))
+    left, right, scores = left[order], right[order], scores[order]
+    group_starts = np.flatnonzero(np.r_[True, left[1:] != left[:-1]])
+    ranks = np.arange(len(left)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(left)]))
+    top = ranks < SIMILAR_K
+    return left[top], right[top], scores[top], ranks[top]
+
+
+def similar_lists(interactions, targets=None):
+    """Rows (novel_id, position, similar_id, score) for targets, every novel when None."""
+    if targets is None:
+        targets = np.arange(len(interactions.item_ids))
+    rows = []
+    for chunk in _chunks(interactions, targets):
+        if not len(chunk):
+            continue
+        left, right, scores, ranks = _top_neighbours(interactions, chunk)
+        ids = interactions.item_ids
+        rows.extend(zip(ids[left].tolist(), ranks.tolist(), ids[right].tolist(), scores.tolist()))
+    return rows
+
+
+def write_lists(shards, rows, novel_ids, marks):
+    """Replace the lists of novel_ids (every novel when None) in their shards and record marks."""
+    by_shard = [[] for _ in range(shards.count)]
+    for row in rows:
+        by_shard[shards.index(row[0])].append(row)
+    replaced = [[] for _ in range(shards.count)]
+    for novel_id in novel_ids if novel_ids is not None else ():
+        replaced[shards.index(novel_id)].append((novel_id,))
+    for index, connections in enumerate(shards.pools):
+        with connections.connection() as db:
+            if novel_ids is None:
+                db.execute("DELETE FROM similar_novels")
+            else:
+                db.executemany("DELETE FROM similar_novels WHERE novel_id = ?", replaced[index])
+            db.executemany("INSERT INTO similar_novels (novel_id, position, similar_id, score) VALUES (?, ?, ?, ?)",
+                           by_shard[index])
+            db.executemany(
+                "INSERT INTO similar_novels_marks (source, last_id) VALUES (?, ?) "
+                "ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id",
+                list(marks[index].items()),
+            )
+            db.commit()
+
+
+class SimilarityIndex:
+    """Builds similar_novels, keeping every interaction read so far in memory.
+
+    The rows are what a rebuild reads anyway, kept so that a refresh only
+    asks the database for rows above the marks of the last read.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        # n x 3 (user_id, novel_id, id) of every shard, and per shard the highest id read of each source
+        self.rows = None
+        self.marks = None
+
+    def rebuild(self):
+        """Recompute every list from all interactions. Returns the novels done."""
+        results = self.shards.fan_out(lambda db, index: read_interactions(db))
+        self.rows = np.concatenate([rows for rows, _ in results])
+        self.marks = [marks for _, marks in results]
+        interactions = Interactions(self.rows)
+        write_lists(self.shards, similar_lists(interactions), None, self.marks)
+        return len(interactions.item_ids)
+
+    def refresh(self):
+        """Recompute the lists of every novel the readers of new interactions picked. Returns the novels done."""
+        if self.rows is None:
+            return self.rebuild()
+        results = self.shards.fan_out(lambda db, index: read_interactions(db, self.marks[index]))
+        added = np.concatenate([rows for rows, _ in results])
+        if not len(added):
+            return 0
+        self.rows = np.concatenate([self.rows, added])
+        self.marks = [marks for _, marks in results]
+        interactions = Interactions(self.rows)
+        targets = interactions.targets_of(np.unique(added[:, 0]))
+        write_lists(self.shards, similar_lists(interactions, targets), interactions.item_ids[targets].tolist(),
+                    self.marks)
+        return len(targets)
+
+
+def rebuild(shards):
+    """Recompute every list once, as the command line and resharding do. Returns the novels done."""
+    return SimilarityIndex(shards).rebuild()
+
+
+def claim(lock_path, blocking=False):
+    """An open file holding an exclusive lock on lock_path, None if another process holds it.
+
+    Without fcntl (Windows) there is a single process and the file is returned unlocked.
+    """
+    lock_file = open(lock_path, "a")
+    try:
+        import fcntl
+    except ImportError:
+        return lock_file
+    try:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class Recommender:
+    """Background thread keeping similar_novels current."""
+
+    def __init__(self, shards, lock_path, interval=REFRESH_INTERVAL, full_interval=FULL_REBUILD_INTERVAL):
+        self.shards = shards
+        self.index = SimilarityIndex(shards)
+        self.lock_path = lock_path
+        self.interval = interval
+        self.full_interval = full_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        # One builder per database however many workers serve it, the others only read
+        self._lock_file = claim(self.lock_path)
+        if self._lock_file is not None:
+            self._thread = threading.Thread(target=self._run, name="novel-recommender", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run(self):
+        last_full = None
+        while not self._stop.is_set():
+            full = last_full is None or time.monotonic() - last_full >= self.full_interval
+            started = time.perf_counter()
+            try:
+                novels = self.index.rebuild() if full else self.index.refresh()
+            except Exception:
+                logger.exception("Rebuilding similar novels failed")
+            else:
+                if full:
+                    last_full = time.monotonic()
+                if novels:
+                    logger.info("Similar novels %s for %d novels in %.2fs", "rebuilt" if full else "refreshed",
+                                novels, time.perf_counter() - started)
+            self._stop.wait(self.interval)
+
+
+# Serving
+
+def similar_to(db, novel_id, limit):
+    """[(similar_id, score)] of one novel, best first."""
+    return [tuple(row) for row in db.execute(
+        "SELECT similar_id, score FROM similar_novels WHERE novel_id = ? ORDER BY position LIMIT ?", (novel_id, limit)
+    )]
+
+
+def candidates(db, user_id):
+    """What one file knows for recommending to user_id: the novels they picked and their neighbours.
+
+    A reader's likes live in the shard of the novel, and so do its neighbour
+    lists, so the join never leaves the file.
+    """
+    picked = db.execute(
+        " UNION ".join(f"SELECT novel_id, id FROM {source} WHERE user_id = ?" for source in SOURCES)
+        + " ORDER BY id DESC LIMIT ?",
+        [user_id] * len(SOURCES) + [PROFILE_SIZE],
+    ).fetchall()
+    ids = [row[0] for row in picked]
+    neighbours = db.execute(
+        f"SELECT similar_id, score FROM similar_novels WHERE novel_id IN ({','.join('?' * len(ids))})", ids
+    ).fetchall() if ids else []
+    return ids, [tuple(row) for row in neighbours]
+
+
+def recommend(shards, user_id, limit):
+    """[(novel_id, score)] for user_id, novels they already picked left out."""
+    picked = set()
+    scores = {}
+    for ids, neighbours in shards.fan_out(lambda db, index: candidates(db, user_id)):
+        picked.update(ids)
+        for similar_id, score in neighbours:
+            scores[similar_id] = scores.get(similar_id, 0.0) + score
+    ranked = sorted((item for item in scores.items() if item[0] not in picked), key=lambda item: (-item[1], item[0]))
+    return ranked[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the item-to-item similar novel lists")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--db", help="main database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.db:
+        os.environ["NOVEL_DB_PATH"] = args.db
+
+    from sharding import Shards
+
+    shards = Shards(path=args.db)
+    started = time.perf_counter()
+    novels = rebuild(shards)
+    print(f"Similar novels for {novels} novels in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
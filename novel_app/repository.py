@@ -0,0 +1,143 @@
+"""The SQL behind the route handlers in main.py.
+
+Functions take a pooled connection and leave committing to the caller,
+so one handler can group several of them in a transaction. Statements are
+written for SQLite and run unchanged on MySQL through the connection
+wrapper in mysql_backend.py. Listings, batch reads and leaderboards live
+in catalog.py and stats.py and are shared the same way.
+
+Full-text search, ranged downloads, incremental export and bulk import
+are built on SQLite features (FTS5, incremental blob I/O, triggers with
+julianday(), last_insert_rowid()) and answer 501 on MySQL.
+"""
+from fastapi import HTTPException
+
+from chapters import list_chapters, read_content, write_chapters
+from compression import decompress
+from database import BACKEND
+from migrations import run_migrations
+
+# Queued through the write queue, repeats are no-ops thanks to the unique (novel_id, user_id) indexes
+ADD_LIKE = "INSERT OR IGNORE INTO likes (novel_id, user_id) VALUES (?, ?)"
+ADD_COMMENT = "INSERT INTO comments (novel_id, user_id, text) VALUES (?, ?, ?)"
+ADD_TO_WISHLIST = "INSERT OR IGNORE INTO wishlists (novel_id, user_id) VALUES (?, ?)"
+
+
+def migrate(db):
+    """Bring the schema of the configured backend up to date."""
+    if BACKEND == "mysql":
+        import mysql_backend
+
+        mysql_backend.create_schema(db)
+    else:
+        run_migrations(db)
+
+
+def require_sqlite(feature):
+    if BACKEND != "sqlite":
+        raise HTTPException(status_code=501, detail=f"{feature} is only available with the SQLite backend")
+
+
+# Users
+
+def create_user(db, username, email, password_hash):
+    return db.execute(
+        "INSERT INTO users (username, email, password) VALUES (?, ?, ?)", (username, email, password_hash)
+    ).lastrowid
+
+
+def find_user(db, username):
+    return db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+
+
+def set_password(db, user_id, password_hash):
+    db.execute("UPDATE users SET password = ? WHERE id = ?", (password_hash, user_id))
+
+
+def update_user(db, user_id, username, email, password_hash):
+    db.execute("UPDATE users SET username = ?, email = ?, password = ? WHERE id = ?",
+               (username, email, password_hash, user_id))
+
+
+def delete_user(db, user_id):
+    db.execute("DELETE FROM users WHERE id = ?", (user_id,))
+
+
+# Novels
+
+def create_novel(db, user_id, title, description, content, novel_id=None):
+    # novel_id is given on sharded layouts, None lets the database number it
+    novel_id = db.execute(
+        "INSERT INTO novels (id, title, description, user_id) VALUES (?, ?, ?, ?)",
+        (novel_id, title, description, user_id),
+    ).lastrowid
+    write_chapters(db, novel_id, content)
+    return novel_id
+
+
+def update_novel(db, novel_id, user_id, title, description, content):
+    """Replace a novel's fields and text if user_id wrote it. Returns whether it did."""
+    updated = db.execute(
+        "UPDATE novels SET title = ?, description = ? WHERE id = ? AND user_id = ?",
+        (title, description, novel_id, user_id),
+    ).rowcount
+    if updated:
+        write_chapters(db, novel_id, content)
+    return bool(updated)
+
+
+def delete_novel(db, novel_id, user_id):
+    """Delete a novel and its chapters if user_id wrote it. Returns whether it did."""
+    deleted = db.execute("DELETE FROM novels WHERE id = ? AND user_id = ?", (novel_id, user_id)).rowcount
+    if deleted:
+        db.execute("DELETE FROM novel_chapters WHERE novel_id = ?", (novel_id,))
+    return bool(deleted)
+
+
+def get_novel(db, novel_id):
+    """A novel with its full text and chapter list, or None."""
+    novel = db.execute("SELECT * FROM novels WHERE id = ?", (novel_id,)).fetchone()
+    if not novel:
+        return None
+    novel = dict(novel)
+    novel["content"] = read_content(db, novel_id)
+    novel["chapters"] = [dict(chapter) for chapter in list_chapters(db, novel_id)]
+    return novel
+
+
+def novel_exists(db, novel_id):
+    return db.execute("SELECT id FROM novels WHERE id = ?", (novel_id,)).fetchone() is not None
+
+
+def novel_author(db, novel_id):
+    """A row holding the novel's user_id, or None when there is no such novel."""
+    return db.execute("SELECT user_id FROM novels WHERE id = ?", (novel_id,)).fetchone()
+
+
+# Chapters
+
+def get_chapter(db, novel_id, position):
+    # Decompressed here rather than with novel_text(), which only exists on SQLite connections
+    row = db.execute(
+        "SELECT novel_id, position, title, content FROM novel_chapters WHERE novel_id = ? AND position = ?",
+        (novel_id, position),
+    ).fetchone()
+    if not row:
+        return None
+    chapter = dict(row)
+    chapter["content"] = decompress(chapter["content"])
+    return chapter
+
+
+def chapter_count(db, novel_id):
+    return db.execute("SELECT COUNT(*) FROM novel_chapters WHERE novel_id = ?", (novel_id,)).fetchone()[0]
+
+
+# Engagement
+
+def remove_like(db, novel_id, user_id):
+    db.execute("DELETE FROM likes WHERE novel_id = ? AND user_id = ?", (novel_id, user_id))
+
+
+def remove_from_wishlist(db, novel_id, user_id):
+    db.execute("DELETE FROM wishlists WHERE novel_id = ? AND user_id = ?", (novel_id, user_id))
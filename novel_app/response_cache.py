@@ -0,0 +1,178 @@
+"""Server-side cache of encoded JSON responses for novel reads.
+
+Entries are kept in an LRU bounded by total body bytes. Each entry is
+tagged with what it was built from, and writers invalidate by tag:
+
+    summary:{novel_id}   list pages showing that novel's summary and counts
+    novel:{novel_id}     the detail response of that novel
+    catalog:tail         the last page of GET /novels/, where new novels appear
+    user:{user_id}:tail  the last page of that user's novels
+    author:{user_id}     pages showing that user's name as an author
+
+Every response carries a strong ETag of its body, so unchanged reads can
+be answered with 304 and no body.
+
+Under serve.py each worker has its own cache. Invalidations are published
+to the others through coherence.py and applied before any of them reads
+or fills its cache.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+import coherence
+import metrics
+
+MAX_BYTES = int(os.environ.get("NOVEL_RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+class _Entry:
+    __slots__ = ("body", "etag", "tags")
+
+    def __init__(self, body, etag, tags):
+        self.body = body
+        self.etag = etag
+        self.tags = tags
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Bumped by every invalidation, tag -> sequence of its last invalidation, see put()
+        self.sequence = 0
+        self._invalidated_at = {}
+        self._cleared_at = 0
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        coherence.sync()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, tags, sequence):
+        """Store a response built after reading at `sequence`.
+
+        If one of its tags was invalidated while it was being built it may
+        already be stale, so it is returned to the caller but not cached.
+        """
+        entry = _Entry(body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', frozenset(tags))
+        if len(body) > self.max_bytes:
+            return entry
+        # Invalidations other workers published while this was built count too
+        coherence.sync()
+        with self._lock:
+            if self._cleared_at > sequence or any(
+                self._invalidated_at.get(tag, -1) > sequence for tag in entry.tags
+            ):
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            self.bytes += len(body)
+            for tag in entry.tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def invalidate(self, *tags):
+        self.invalidate_local(*tags)
+        for tag in tags:
+            coherence.publish("cache", tag)
+
+    def invalidate_local(self, *tags):
+        with self._lock:
+            self.sequence += 1
+            for tag in tags:
+                self._invalidated_at[tag] = self.sequence
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.sequence += 1
+            # Anything being built right now predates the clear
+            self._cleared_at = self.sequence
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+cache = ResponseCache()
+coherence.subscribe("cache", cache.invalidate_local, cache.clear)
+
+
+def _etag_matches(header, etag):
+    if header is None:
+        return False
+    return header.strip() == "*" or etag in [value.strip().removeprefix("W/") for value in header.split(",")]
+
+
+def cached_json(request, key, build):
+    """Serve key from the cache, or call build() -> (data, tags) and cache its JSON body."""
+    entry = cache.get(key)
+    if entry is None:
+        sequence = cache.sequence
+        data, tags = build()
+        started = time.perf_counter()
+        body = json.dumps(jsonable_encoder(data), separators=(",", ":")).encode("utf-8")
+        metrics.observe(metrics.json_seconds, time.perf_counter() - started)
+        entry = cache.put(key, body, tags, sequence)
+
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+
+def page_tags(page, tail_tag):
+    """Tags for one page of novel summaries."""
+    tags = {f"summary:{novel['id']}" for novel in page["items"]}
+    tags.update(f"author:{novel['user_id']}" for novel in page["items"] if novel["user_id"] is not None)
+    if page["next_cursor"] is None:
+        tags.add(tail_tag)
+    return tags
@@ -0,0 +1,281 @@
+"""Full-text search over novel titles, descriptions and chapter text.
+
+Two external-content FTS5 tables mirror the base tables through triggers,
+so the text is not stored twice and writes keep the index current:
+
+    novels_fts    title, description   (rowid = novels.id)
+    chapters_fts  content              (rowid = novel_chapters.id)
+
+Chapter text is stored compressed, so chapters_fts reads it through the
+novel_chapter_text view, which decompresses with novel_text().
+
+Rebuild the index of an existing database offline with:
+
+    python search.py rebuild [--db novel_db.db]
+"""
+import argparse
+import re
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+
+from catalog import SUMMARY_COLUMNS, SUMMARY_FROM, decode_cursor_payload, encode_cursor
+
+# Title matches weigh more than description matches
+NOVEL_WEIGHTS = "10.0, 4.0"
+
+SNIPPET_TOKENS = 16
+
+SCHEMA = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS novels_fts USING fts5(
+            title, description,
+            content='novels', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """,
+    """CREATE VIEW IF NOT EXISTS novel_chapter_text AS
+            SELECT id, novel_text(content) AS content, novel_id FROM novel_chapters
+    """,
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chapters_fts USING fts5(
+            content, novel_id UNINDEXED,
+            content='novel_chapter_text', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """,
+    """CREATE TRIGGER IF NOT EXISTS novels_fts_insert AFTER INSERT ON novels BEGIN
+            INSERT INTO novels_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+        END
+    """,
+    """CREATE TRIGGER IF NOT EXISTS novels_fts_delete AFTER DELETE ON novels BEGIN
+            INSERT INTO novels_fts (novels_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+        END
+    """,
+    """CREATE TRIGGER IF NOT EXISTS novels_fts_update AFTER UPDATE OF title, description ON novels BEGIN
+            INSERT INTO novels_fts (novels_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO novels_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+        END
+    """,
+    """CREATE TRIGGER IF NOT EXISTS chapters_fts_insert AFTER INSERT ON novel_chapters BEGIN
+            INSERT INTO chapters_fts (rowid, content, novel_id) VALUES (new.id, novel_text(new.content), new.novel_id);
+        END
+    """,
+    """CREATE TRIGGER IF NOT EXISTS chapters_fts_delete AFTER DELETE ON novel_chapters BEGIN
+            INSERT INTO chapters_fts (chapters_fts, rowid, content, novel_id)
+            VALUES ('delete', old.id, novel_text(old.content), old.novel_id);
+        END
+    """,
+    # Recompressing a row keeps its hash and does not touch the index
+    """CREATE TRIGGER IF NOT EXISTS chapters_fts_update AFTER UPDATE OF content, novel_id ON novel_chapters
+        WHEN old.content_hash IS NOT new.content_hash OR old.novel_id IS NOT new.novel_id BEGIN
+            INSERT INTO chapters_fts (chapters_fts, rowid, content, novel_id)
+            VALUES ('delete', old.id, novel_text(old.content), old.novel_id);
+            INSERT INTO chapters_fts (rowid, content, novel_id) VALUES (new.id, novel_text(new.content), new.novel_id);
+        END
+    """,
+)
+
+
+def create_search_index(db):
+    """Create the FTS tables and triggers, indexing existing rows the first time."""
+    existing = db.execute("SELECT name FROM sqlite_master WHERE name IN ('novels_fts', 'chapters_fts')").fetchall()
+    for statement in SCHEMA:
+        db.execute(statement)
+    if len(existing) < 2:
+        rebuild_search_index(db)
+
+
+def rebuild_search_index(db):
+    db.execute("INSERT INTO novels_fts (novels_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO chapters_fts (chapters_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO novels_fts (novels_fts) VALUES ('optimize')")
+    db.execute("INSERT INTO chapters_fts (chapters_fts) VALUES ('optimize')")
+
+
+def to_match_query(q: str) -> Optional[str]:
+    """Turn user input into a safe FTS5 query: every word must match, the last one as a prefix."""
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _best_rows(db, match, window):
+    """(novel_id, score, chapter_id) of the best window rows of each table, and the score below which both are complete.
+
+    ORDER BY rank with a LIMIT lets FTS5 keep only the best rows instead of
+    materializing and grouping every match. Chapter rows come back as
+    chapter ids and are mapped to novels through novel_chapters, which avoids
+    reading novel_id through the decompressing content view for every match.
+    """
+    novels = db.execute(
+        f"SELECT rowid, rank FROM novels_fts WHERE novels_fts MATCH ? AND rank MATCH 'bm25({NOVEL_WEIGHTS})' "
+        f"ORDER BY rank LIMIT ?",
+        (match, window),
+    ).fetchall()
+    chapters = db.execute(
+        "SELECT rowid, rank FROM chapters_fts WHERE chapters_fts MATCH ? ORDER BY rank LIMIT ?", (match, window)
+    ).fetchall()
+    novel_of = {}
+    chapter_ids = [row[0] for row in chapters]
+    for start in range(0, len(chapter_ids), 500):
+        batch = chapter_ids[start:start + 500]
+        novel_of.update(db.execute(
+            f"SELECT id, novel_id FROM novel_chapters WHERE id IN ({','.join('?' * len(batch))})", batch
+        ).fetchall())
+    # Past the last row of a table that filled its window there may be more rows
+    bound = min((rows[-1][1] for rows in (novels, chapters) if len(rows) == window), default=float("inf"))
+    rows = [(row[0], row[1], None) for row in novels]
+    rows += [(novel_of[row[0]], row[1], row[0]) for row in chapters if row[0] in novel_of]
+    return rows, bound
+
+
+def rank_novels(db, match, after, count):
+    """Up to count (score, novel_id) past the cursor, ordered by each novel's best score in either table.
+
+    A novel whose best score is below the bound has every row that good in
+    the window, so its best score is exact. The window grows until count
+    such novels follow the cursor or both tables are read to the end. Also
+    returns the best chapter id in the window of each novel that has one.
+    """
+    window = count
+    while True:
+        rows, bound = _best_rows(db, match, window)
+        best = {}
+        chapters = {}
+        for novel_id, score, chapter_id in rows:
+            best[novel_id] = min(score, best.get(novel_id, score))
+            if chapter_id is not None and score < chapters.get(novel_id, (float("inf"),))[0]:
+                chapters[novel_id] = (score, chapter_id)
+        placed = sorted((score, novel_id) for novel_id, score in best.items() if score < bound)
+        if after is not None:
+            placed = [row for row in placed if row > after]
+        if len(placed) >= count or bound == float("inf"):
+            return placed[:count], {novel_id: chapter[1] for novel_id, chapter in chapters.items()}
+        window *= 4
+
+
+def _chapter_snippets(db, match, ids, best_chapter):
+    """(novel_id, snippet) of one matching chapter of each novel in ids that has one.
+
+    That is the chapter which ranked the novel when rank_novels saw it,
+    otherwise its first matching chapter. chapters_fts cannot filter on
+    novel_id and bm25 restricted to a few rowids still reads the statistics
+    of the whole index for every row, so only the chosen chapters are matched
+    again, by rowid and without ranking.
+    """
+    chosen = {best_chapter[novel_id]: novel_id for novel_id in ids if novel_id in best_chapter}
+    missing = [novel_id for novel_id in ids if novel_id not in best_chapter]
+    if missing:
+        candidates = db.execute(
+            f"SELECT id, novel_id FROM novel_chapters WHERE novel_id IN ({','.join('?' * len(missing))}) "
+            f"ORDER BY novel_id, position",
+            missing,
+        ).fetchall()
+        matched = set()
+        for start in range(0, len(candidates), 500):
+            batch = [row[0] for row in candidates[start:start + 500]]
+            matched.update(row[0] for row in db.execute(
+                f"SELECT rowid FROM chapters_fts WHERE chapters_fts MATCH ? "
+                f"AND rowid IN ({','.join('?' * len(batch))})",
+                [match, *batch],
+            ))
+        seen = set()
+        for chapter_id, novel_id in candidates:
+            if chapter_id in matched and novel_id not in seen:
+                seen.add(novel_id)
+                chosen[chapter_id] = novel_id
+    if not chosen:
+        return []
+    return [
+        (chosen[row[0]], row[1])
+        for row in db.execute(
+            f"SELECT rowid, snippet(chapters_fts, 0, '<b>', '</b>', '…', {SNIPPET_TOKENS}) "
+            f"FROM chapters_fts WHERE chapters_fts MATCH ? AND rowid IN ({','.join('?' * len(chosen))})",
+            [match, *chosen],
+        )
+    ]
+
+
+def search_novels(db, q: str, cursor: Optional[str], limit: int):
+    """Return one page of novels ranked by BM25, best match first."""
+    match = to_match_query(q)
+    if match is None:
+        return {"items": [], "next_cursor": None}
+
+    after = None
+    if cursor:
+        payload = decode_cursor_payload(cursor)
+        if not isinstance(payload.get("score"), (int, float)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after = (payload["score"], payload["id"])
+
+    placed, best_chapter = rank_novels(db, match, after, limit + 1)
+    ranked = [{"score": score, "novel_id": novel_id} for score, novel_id in placed]
+    page = ranked[:limit]
+    if not page:
+        return {"items": [], "next_cursor": None}
+
+    ids = [row["novel_id"] for row in page]
+    placeholders = ",".join("?" * len(ids))
+    novels = {
+        row["id"]: dict(row)
+        for row in db.execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM {SUMMARY_FROM} WHERE novels.id IN ({placeholders})",
+            ids,
+        )
+    }
+    highlights = {
+        row[0]: (row[1], row[2])
+        for row in db.execute(
+            f"SELECT rowid, highlight(novels_fts, 0, '<b>', '</b>'), "
+            f"snippet(novels_fts, 1, '<b>', '</b>', '…', {SNIPPET_TOKENS}) "
+            f"FROM novels_fts WHERE novels_fts MATCH ? AND rowid IN ({placeholders})",
+            [match, *ids],
+        )
+    }
+    # One matching chapter per novel, only for the novels on this page
+    snippets = dict(_chapter_snippets(db, match, ids, best_chapter))
+
+    items = []
+    for row in page:
+        novel = novels.get(row["novel_id"])
+        if novel is None:
+            continue
+        title_highlight, description_snippet = highlights.get(row["novel_id"], (None, None))
+        novel["score"] = -row["score"]
+        novel["title_highlight"] = title_highlight or novel["title"]
+        novel["snippet"] = snippets.get(row["novel_id"]) or description_snippet
+        items.append(novel)
+
+    next_cursor = None
+    if len(ranked) > limit:
+        last = page[-1]
+        next_cursor = encode_cursor(last["novel_id"], score=last["score"])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the novel full-text search index")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--db", help="database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    args = parser.parse_args()
+
+    from database import connect
+
+    db = connect(args.db)
+    started = time.perf_counter()
+    for statement in SCHEMA:
+        db.execute(statement)
+    rebuild_search_index(db)
+    db.commit()
+    db.close()
+    print(f"Search index rebuilt in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Run novel_app with several worker processes forked from one preloaded parent.
+
+The parent imports the app and brings the schema up to date once, then
+binds the listening socket and forks the workers, which share its code
+pages and accept from the same socket. A worker that dies is replaced.
+SIGTERM or Ctrl+C stops the workers gracefully, and after GRACE seconds
+any that are still running are killed.
+
+Each worker keeps its own response and token caches. coherence.py keeps
+them in step: an invalidation in one worker reaches the others before
+their next cached read.
+
+    python serve.py --workers 4 --port 8000
+    NOVEL_WORKERS=4 NOVEL_KEEP_ALIVE=15 python serve.py
+
+Without os.fork (Windows) or with --workers 1 it runs one uvicorn process.
+The parent never opens a pooled connection, so no SQLite handle crosses a
+fork. /metrics reports the worker that happened to answer the scrape.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+
+WORKERS = int(os.environ.get("NOVEL_WORKERS", os.cpu_count() or 1))
+# Longer than uvicorn's 5s default so clients and proxies reuse connections between page loads
+KEEP_ALIVE = int(os.environ.get("NOVEL_KEEP_ALIVE", 15))
+# Connections the kernel queues while every worker is busy
+BACKLOG = int(os.environ.get("NOVEL_BACKLOG", 2048))
+GRACE = int(os.environ.get("NOVEL_SHUTDOWN_GRACE", 30))
+
+# A worker that dies sooner than this after starting is restarted with a delay
+MIN_UPTIME = 1.0
+
+logger = logging.getLogger("serve")
+
+
+def migrate():
+    import repository
+    from database import open_connection
+    from sharding import shards
+
+    db = open_connection()
+    try:
+        repository.migrate(db)
+    finally:
+        db.close()
+    shards.migrate()
+
+
+def listen(host, port, backlog):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, args):
+    import uvicorn
+
+    config = uvicorn.Config(app, host=args.host, port=args.port, backlog=args.backlog,
+                            timeout_keep_alive=args.keep_alive, log_level=args.log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def supervise(spawn, workers, grace):
+    """Keep worker processes running until SIGTERM or SIGINT, then stop them."""
+    children = {}
+    started = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        logger.info("Stopping %d workers", len(children))
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        signal.alarm(grace)
+
+    def kill(signum, frame):
+        for pid in children:
+            logger.warning("Worker %d did not stop within %ds, killing it", pid, grace)
+            os.kill(pid, signal.SIGKILL)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, kill)
+
+    for slot in range(workers):
+        pid = spawn()
+        children[pid], started[pid] = slot, time.monotonic()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        uptime = time.monotonic() - started.pop(pid, 0)
+        if slot is None or stopping:
+            continue
+        logger.warning("Worker %d exited with status %d, starting another one",
+                       pid, os.waitstatus_to_exitcode(status))
+        if uptime < MIN_UPTIME:
+            time.sleep(MIN_UPTIME)
+        pid = spawn()
+        children[pid], started[pid] = slot, time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve novel_app with several worker processes")
+    parser.add_argument("--host", default=os.environ.get("NOVEL_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("NOVEL_PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--keep-alive", type=int, default=KEEP_ALIVE, help="seconds an idle connection stays open")
+    parser.add_argument("--backlog", type=int, default=BACKLOG)
+    parser.add_argument("--grace", type=int, default=GRACE, help="seconds workers get to finish on shutdown")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+
+    # bcrypt pools are per worker, split the default between them
+    os.environ.setdefault("NOVEL_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2 // max(1, args.workers))))
+
+    # Preload: every module and the route table are imported once, before forking
+    import main as application
+
+    if args.workers <= 1 or not hasattr(os, "fork"):
+        import uvicorn
+
+        uvicorn.run(application.app, host=args.host, port=args.port, backlog=args.backlog,
+                    timeout_keep_alive=args.keep_alive, log_level=args.log_level)
+        return
+
+    import coherence
+
+    migrate()
+    coherence.enable()
+    sock = listen(args.host, args.port, args.backlog)
+    logger.info("Listening on %s:%d with %d workers", args.host, args.port, args.workers)
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            return pid
+        # uvicorn installs its own handlers for a graceful shutdown
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGALRM):
+            signal.signal(signum, signal.SIG_DFL)
+        code = 0
+        try:
+            run_worker(application.app, sock, args)
+        except BaseException:
+            logger.exception("Worker failed")
+            code = 1
+        finally:
+            os._exit(code)
+
+    supervise(spawn, args.workers, args.grace)
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
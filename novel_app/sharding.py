@@ -0,0 +1,442 @@
+"""Optional horizontal sharding of novels and their engagement rows.
+
+With NOVEL_SHARDS=N above 1, novels, chapters, likes, comments, wishlists
+and their counters live in N SQLite files next to the main database,
+novel_db.0-of-N.db to novel_db.{N-1}-of-N.db, and novel 42 lives in shard
+42 % N. Users, revoked tokens and the novel id sequence stay in the main
+file, which every shard connection attaches as "directory", so the
+summary queries joining users run unchanged on a shard.
+
+Every shard has its own writer connection and write queue, so N shards
+commit N transactions at once. Routes about one novel go straight to its
+shard, listings ask every shard in parallel and merge by id, leaderboards
+by count. Novel ids come from one sequence in the main file, so they keep
+increasing across shards and a new novel still lands on the last page of
+every listing.
+
+Search, export and bulk import are built on one file and answer 501 on a
+sharded layout. Moving to another shard count is done offline, with the
+server stopped, and ends by rebuilding the similar novel lists, by
+readers and by content, of the new layout:
+
+    python sharding.py status  [--db novel_db.db] [--shards N]
+    python sharding.py reshard --from 1 --to 4 [--db novel_db.db]
+
+NOVEL_SHARDS=1, the default, keeps everything in the main file and serves
+it with the pools in database.py.
+"""
+import argparse
+import contextvars
+import glob
+import heapq
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+from fastapi import HTTPException
+
+import catalog
+import content_similarity
+import recommendations
+import stats
+from database import BACKEND, DB_PATH, POOL_SIZE, WRITE_POOL_SIZE, ConnectionPool, connect, pool, read_pool
+from migrations import run_migrations
+from writes import WriteQueue, writer
+
+SHARD_COUNT = int(os.environ.get("NOVEL_SHARDS", 1))
+
+# Tables partitioned by novel id, in the order they are copied
+SHARDED_TABLES = ("novels", "novel_chapters", "likes", "comments", "wishlists")
+# Tables computed from the sharded ones, emptied along with them
+DERIVED_TABLES = ("novel_stats", "similar_novels", "similar_novels_marks",
+                  "novel_term_vectors", "term_document_counts", "content_neighbours", "content_postings")
+# Tables only the main file keeps
+DIRECTORY_TABLES = ("users", "revoked_tokens")
+
+SEQUENCE = """CREATE TABLE IF NOT EXISTS novel_id_sequence (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_id INTEGER NOT NULL
+    )
+"""
+
+
+def shard_paths(count, path=None):
+    """Files of a layout with count shards, the main file alone when count is 1."""
+    path = path or DB_PATH
+    if count == 1:
+        return [path]
+    root, ext = os.path.splitext(path)
+    return [f"{root}.{index}-of-{count}{ext}" for index in range(count)]
+
+
+def connect_shard(path, readonly=False, directory=None):
+    """Connection to one shard with the main file attached as "directory"."""
+    db = connect(path, readonly)
+    # Read-only on writers too: BEGIN IMMEDIATE would otherwise take the main file's write
+    # lock along with the shard's, and every shard would queue behind one lock again
+    directory = Path(directory or DB_PATH).resolve().as_uri()
+    db.execute("ATTACH DATABASE ? AS directory", (f"{directory}?mode=ro",))
+    return db
+
+
+def migrate_shard(path):
+    """Bring a shard file up to the latest schema, without the tables of the main file."""
+    db = connect(path)
+    try:
+        run_migrations(db)
+        # Unqualified "users" has to resolve to the attached main file
+        for table in DIRECTORY_TABLES:
+            db.execute(f"DROP TABLE IF EXISTS {table}")
+        db.commit()
+    finally:
+        db.close()
+
+
+def advance_sequence(db, last_id):
+    """Make sure the next novel id allocated by the main file is above last_id."""
+    db.execute(SEQUENCE)
+    db.execute(
+        "INSERT INTO novel_id_sequence (id, last_id) VALUES (1, ?) "
+        "ON CONFLICT (id) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+        (last_id,),
+    )
+
+
+def _max_novel_id(path):
+    db = connect(path)
+    try:
+        return db.execute("SELECT COALESCE(MAX(id), 0) FROM novels").fetchone()[0]
+    finally:
+        db.close()
+
+
+def _layout_files(path):
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(root)}.*-of-*{ext}"))
+
+
+class Shards:
+    """The shards of one layout, each with a writer pool, a read pool and a write queue."""
+
+    def __init__(self, count=SHARD_COUNT, path=None):
+        if count < 1:
+            raise RuntimeError(f"NOVEL_SHARDS must be at least 1, got {count}")
+        if count > 1 and BACKEND != "sqlite":
+            raise RuntimeError("Sharding is only available with the SQLite backend")
+        self.count = count
+        self.path = path or DB_PATH
+        self.paths = shard_paths(count, self.path)
+        # The main file, which allocates novel ids on sharded layouts
+        self.directory = pool if path is None else ConnectionPool(self.path, size=1)
+        if count == 1 and path is None:
+            self.pools, self.read_pools, self.writers = [pool], [read_pool], [writer]
+        elif count == 1:
+            self.pools = [self.directory]
+            self.read_pools = [ConnectionPool(self.path, readonly=True)]
+            self.writers = [WriteQueue(self.directory)]
+        else:
+            connect_to = partial(connect_shard, directory=self.path)
+            self.pools = [ConnectionPool(shard, size=WRITE_POOL_SIZE, connect=connect_to) for shard in self.paths]
+            self.read_pools = [ConnectionPool(shard, connect=connect_to, readonly=True) for shard in self.paths]
+            self.writers = [WriteQueue(connections) for connections in self.pools]
+        # Shared by every request fanning out, threads are started on demand
+        self._executor = ThreadPoolExecutor(POOL_SIZE, thread_name_prefix="novel-shard") if count > 1 else None
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def index(self, novel_id):
+        return novel_id % self.count if self.sharded else 0
+
+    def pool_for(self, novel_id):
+        return self.pools[self.index(novel_id)]
+
+    def read_pool_for(self, novel_id):
+        return self.read_pools[self.index(novel_id)]
+
+    def writer_for(self, novel_id):
+        return self.writers[self.index(novel_id)]
+
+    def require_single(self, feature):
+        if self.sharded:
+            raise HTTPException(status_code=501, detail=f"{feature} is not available on a sharded database")
+
+    def check_layout(self):
+        """Refuse to start on files written with another shard count."""
+        stray = [path for path in _layout_files(self.path) if path not in self.paths]
+        if stray:
+            raise RuntimeError(f"Found shard files of another layout ({', '.join(stray)}), "
+                               f"run sharding.py reshard to NOVEL_SHARDS={self.count} first")
+        if self.sharded and os.path.exists(self.path) and _max_novel_id(self.path):
+            raise RuntimeError(f"{self.path} still holds novels, run sharding.py reshard --from 1 "
+                               f"--to {self.count} first")
+
+    def migrate(self):
+        """Create or upgrade the shard files. The main file is migrated by repository.migrate."""
+        self.check_layout()
+        if not self.sharded:
+            return
+        for path in self.paths:
+            migrate_shard(path)
+        # Not through the pool: serve.py migrates in the parent, whose connections must not outlive the fork
+        db = connect(self.path)
+        try:
+            advance_sequence(db, max(_max_novel_id(path) for path in self.paths))
+            db.commit()
+        finally:
+            db.close()
+
+    def new_novel_id(self):
+        """Id for a novel about to be created, None to let the main file number it."""
+        if not self.sharded:
+            return None
+        with self.directory.connection() as db:
+            novel_id = db.execute(
+                "UPDATE novel_id_sequence SET last_id = last_id + 1 WHERE id = 1 RETURNING last_id"
+            ).fetchone()[0]
+            db.commit()
+        return novel_id
+
+    def fan_out(self, read, indexes=None):
+        """Run read(db, index) on the read pool of every shard at once, results in shard order."""
+        indexes = range(self.count) if indexes is None else indexes
+
+        def run(index):
+            with self.read_pools[index].connection() as db:
+                return read(db, index)
+
+        if self._executor is None:
+            return [run(index) for index in indexes]
+        # Each task keeps the request's context so its SQL time is attributed to the route
+        futures = [self._executor.submit(contextvars.copy_context().run, run, index) for index in indexes]
+        return [future.result() for future in futures]
+
+    def list_novel_summaries(self, cursor, limit, user_id=None):
+        pages = self.fan_out(lambda db, index: catalog.list_novel_summaries(db, cursor, limit, user_id))
+        return _merge_pages(pages, limit)
+
+    def list_wishlist(self, user_id, cursor, limit):
+        pages = self.fan_out(lambda db, index: catalog.list_wishlist(db, user_id, cursor, limit))
+        return _merge_pages(pages, limit)
+
+    def top_novels(self, by, limit):
+        lists = self.fan_out(lambda db, index: stats.top_novels(db, by, limit))
+        column = stats.COUNTERS[by]
+        return list(islice(heapq.merge(*lists, key=lambda novel: (-novel[column], novel["id"])), limit))
+
+    def fetch_novels(self, ids, projection="summary"):
+        groups = {}
+        for novel_id in dict.fromkeys(ids):
+            groups.setdefault(self.index(novel_id), []).append(novel_id)
+        if len(groups) == 1:
+            (index, _), = groups.items()
+            with self.read_pools[index].connection() as db:
+                return catalog.fetch_novels(db, ids, projection)
+        results = self.fan_out(lambda db, index: catalog.fetch_novels(db, groups[index], projection), list(groups))
+        novels = {novel["id"]: novel for result in results for novel in result["items"] if novel}
+        return {
+            "items": [novels.get(novel_id) for novel_id in ids],
+            "missing": [novel_id for novel_id in dict.fromkeys(ids) if novel_id not in novels],
+        }
+
+    def pending(self):
+        return sum(queue.pending() for queue in self.writers)
+
+    def start(self):
+        for queue in self.writers:
+            queue.start()
+
+    def stop(self):
+        """Flush every write queue. Pools of a sharded layout are closed too."""
+        for queue in self.writers:
+            queue.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self.sharded:
+            for connections in self.pools + self.read_pools:
+                connections.close()
+
+
+def _merge_pages(pages, limit):
+    if len(pages) == 1:
+        return pages[0]
+    items = list(islice(heapq.merge(*(page["items"] for page in pages), key=lambda novel: novel["id"]), limit))
+    more = any(page["next_cursor"] for page in pages) or sum(len(page["items"]) for page in pages) > limit
+    return {"items": items, "next_cursor": catalog.encode_cursor(items[-1]["id"]) if more and items else None}
+
+
+shards = Shards()
+
+
+def get_novel_db(novel_id: int):
+    """FastAPI dependency lending the writer of the shard holding novel_id."""
+    with shards.pool_for(novel_id).connection() as db:
+        yield db
+
+
+def get_novel_read_db(novel_id: int):
+    """FastAPI dependency lending a read-only connection to the shard holding novel_id."""
+    with shards.read_pool_for(novel_id).connection() as db:
+        yield db
+
+
+# Offline resharding
+
+def _columns(db, table):
+    return [row["name"] for row in db.execute(f"PRAGMA main.table_info({table})")]
+
+
+def _count(path, table):
+    db = connect(path)
+    try:
+        return db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        db.close()
+
+
+def _copy_into(target, index, count, sources, log):
+    """Copy every row of sources that belongs to shard index of count into target."""
+    db = connect(target)
+    try:
+        for source in sources:
+            db.execute("ATTACH DATABASE ? AS source", (source,))
+            for table in SHARDED_TABLES:
+                started = time.perf_counter()
+                key = "id" if table == "novels" else "novel_id"
+                # Novels keep their ids, the others are renumbered: two source shards may use the same ones
+                columns = [column for column in _columns(db, table) if table == "novels" or column != "id"]
+                names = ", ".join(columns)
+                copied = db.execute(
+                    f"INSERT INTO main.{table} ({names}) SELECT {names} FROM source.{table} "
+                    f"WHERE {key} % ? = ? ORDER BY id",
+                    (count, index),
+                ).rowcount
+                if table == "novels":
+                    # The insert trigger stamped them with the current time
+                    db.execute(
+                        "UPDATE main.novels SET updated_at = "
+                        "(SELECT updated_at FROM source.novels WHERE source.novels.id = main.novels.id) "
+                        "WHERE id % ? = ? AND id IN (SELECT id FROM source.novels)",
+                        (count, index),
+                    )
+                log(f"{source} -> {target}: {copied} {table} in {time.perf_counter() - started:.1f}s")
+            db.commit()
+            db.execute("DETACH DATABASE source")
+    finally:
+        db.close()
+
+
+def _clear_main(path, tables=SHARDED_TABLES):
+    db = connect(path)
+    try:
+        for table in reversed(tables):
+            db.execute(f"DELETE FROM {table}")
+        for table in DERIVED_TABLES:
+            db.execute(f"DELETE FROM {table}")
+        db.commit()
+    finally:
+        db.close()
+
+
+def _rebuild_derived(count, path, log):
+    """Recompute the similar novel lists of a new layout from the rows it holds now."""
+    layout = Shards(count, path)
+    try:
+        started = time.perf_counter()
+        novels = recommendations.rebuild(layout)
+        log(f"Similar novels rebuilt for {novels} novels in {time.perf_counter() - started:.1f}s")
+        started = time.perf_counter()
+        novels = content_similarity.rebuild(layout, log)
+        log(f"Similar novels by content rebuilt for {novels} novels in {time.perf_counter() - started:.1f}s")
+    finally:
+        layout.stop()
+        for connections in layout.pools + layout.read_pools:
+            connections.close()
+
+
+def reshard(source_count, target_count, path=None, keep=False, log=print):
+    """Move every novel and its rows from one shard count to another. The server must be stopped."""
+    path = path or DB_PATH
+    sources = shard_paths(source_count, path)
+    targets = shard_paths(target_count, path)
+    if source_count == target_count:
+        raise SystemExit(f"Already on {source_count} shards")
+    missing = [source for source in sources if not os.path.exists(source)]
+    if missing:
+        raise SystemExit(f"Missing source files: {', '.join(missing)}")
+    for target in targets:
+        if target == path:
+            if _max_novel_id(path):
+                raise SystemExit(f"{path} already holds novels")
+        elif os.path.exists(target):
+            raise SystemExit(f"{target} already exists")
+
+    expected = {table: sum(_count(source, table) for source in sources) for table in SHARDED_TABLES}
+    for target in targets:
+        if target != path:
+            migrate_shard(target)
+        else:
+            # Lists left from before the main file was sharded would be served until the rebuild below
+            _clear_main(path, ())
+    for index, target in enumerate(targets):
+        _copy_into(target, index, target_count, sources, log)
+
+    copied = {table: sum(_count(target, table) for target in targets) for table in SHARDED_TABLES}
+    if copied != expected:
+        raise SystemExit(f"Row counts differ after the copy, sources are left untouched: "
+                         f"expected {expected}, copied {copied}")
+
+    db = connect(path)
+    try:
+        advance_sequence(db, max(_max_novel_id(target) for target in targets))
+        db.commit()
+    finally:
+        db.close()
+    if source_count == 1:
+        _clear_main(path)
+    elif not keep:
+        for source in sources:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(source + suffix):
+                    os.remove(source + suffix)
+    log(f"Moved {expected['novels']} novels from {source_count} to {target_count} shards")
+    _rebuild_derived(target_count, path, log)
+
+
+def status(count, path=None):
+    path = path or DB_PATH
+    for shard in shard_paths(count, path):
+        exists = os.path.exists(shard)
+        counts = "  ".join(f"{table} {_count(shard, table)}" for table in SHARDED_TABLES) if exists else "missing"
+        print(f"{shard}: {counts}")
+    stray = [shard for shard in _layout_files(path) if shard not in shard_paths(count, path)]
+    if stray:
+        print(f"Files of other layouts: {', '.join(stray)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or change the shard layout of the novel database")
+    parser.add_argument("command", choices=["status", "reshard"])
+    parser.add_argument("--db", help="main database file, defaults to NOVEL_DB_PATH or novel_db.db")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="layout to inspect with status")
+    parser.add_argument("--from", dest="source", type=int, default=SHARD_COUNT, help="current shard count")
+    parser.add_argument("--to", dest="target", type=int, help="new shard count")
+    parser.add_argument("--keep", action="store_true", help="leave the old shard files in place")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "status":
+        status(args.shards, args.db)
+    elif args.target is None or args.target < 1:
+        parser.error("reshard needs --to with a count of at least 1")
+    else:
+        reshard(args.source, args.target, args.db, args.keep)
+
+
+if __name__ == "__main__":
+    main()
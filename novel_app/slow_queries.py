@@ -0,0 +1,138 @@
+"""Log of slow SQL statements with their query plans.
+
+TimedCursor (metrics.py) hands over every statement whose execution plus
+fetches took longer than NOVEL_SLOW_QUERY_MS. A NOVEL_SLOW_QUERY_SAMPLE
+share of them is kept in a ring buffer of the last NOVEL_SLOW_QUERY_LOG
+entries, each with:
+
+    route        route template of the request that ran it
+    sql          the statement, whitespace collapsed
+    parameters   types of the bound values, never the values themselves
+    duration_ms  execution plus fetch time, updated while rows are fetched
+    plan         EXPLAIN QUERY PLAN output, one line per step
+    flags        full scans of hot tables, such as "scan likes"
+
+Plans are computed once per statement text, with the parameters of the
+first slow run. Entries with flags are always
+kept, sampling only thins out the unflagged ones, and the first time a
+statement's plan scans a hot table a warning is logged.
+"""
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+THRESHOLD = float(os.environ.get("NOVEL_SLOW_QUERY_MS", 50)) / 1000
+SAMPLE_RATE = float(os.environ.get("NOVEL_SLOW_QUERY_SAMPLE", 1.0))
+LOG_SIZE = int(os.environ.get("NOVEL_SLOW_QUERY_LOG", 200))
+# Tables that grow with engagement, a scan of them gets slower every day
+HOT_TABLES = frozenset(os.environ.get("NOVEL_HOT_TABLES", "likes,comments,wishlists,novel_chapters").split(","))
+
+# Distinct statement texts whose plan is remembered
+PLAN_CACHE_SIZE = 512
+MAX_SQL_CHARS = 2000
+
+logger = logging.getLogger(__name__)
+
+# "SCAN likes", "SCAN likes USING COVERING INDEX ...", or "SCAN TABLE likes" before SQLite 3.36
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+_EXPLAINED = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_lock = threading.Lock()
+_entries = deque(maxlen=LOG_SIZE)
+_plans = OrderedDict()
+_totals = {"slow": 0, "kept": 0, "flagged": 0}
+
+
+def parameter_shape(parameters):
+    """Type names of the bound values, long runs of one type collapsed."""
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if not isinstance(parameters, (list, tuple)):
+        # executemany() parameters are an iterator we must not consume
+        return "batch"
+    names = [type(value).__name__ for value in parameters]
+    if len(names) > 8 and len(set(names)) == 1:
+        return [f"{len(names)} x {names[0]}"]
+    return names
+
+
+def _explain(connection, sql, parameters):
+    if not isinstance(parameters, (dict, list, tuple)):
+        parameters = ()
+    # The base class execute, so the plan itself is neither timed nor logged
+    rows = sqlite3.Connection.execute(connection, f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+    depth, plan, flags = {0: 0}, [], []
+    for step_id, parent, _, detail in rows:
+        depth[step_id] = depth.get(parent, 0) + 1
+        plan.append("  " * (depth[step_id] - 1) + detail)
+        scan = _SCAN.match(detail)
+        if scan and scan.group(1) in HOT_TABLES:
+            flags.append(f"scan {scan.group(1)}")
+    return plan, flags
+
+
+def _plan(connection, sql, parameters):
+    with _lock:
+        cached = _plans.get(sql)
+        if cached is not None:
+            _plans.move_to_end(sql)
+            return cached
+    plan, flags = [], []
+    if sql.lstrip()[:7].upper().startswith(_EXPLAINED):
+        try:
+            plan, flags = _explain(connection, sql, parameters)
+        except sqlite3.Error as exc:
+            plan = [f"EXPLAIN failed: {exc}"]
+    if flags:
+        logger.warning("Query plan scans %s: %s", ", ".join(flag[5:] for flag in flags), " ".join(sql.split()))
+    with _lock:
+        _plans[sql] = plan, flags
+        if len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan, flags
+
+
+def capture(connection, sql, parameters, elapsed, rows, route):
+    """Log a statement that crossed THRESHOLD, returns its entry or None when sampled out."""
+    plan, flags = _plan(connection, sql, parameters)
+    with _lock:
+        _totals["slow"] += 1
+        if not flags and random.random() >= SAMPLE_RATE:
+            return None
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "route": route,
+            "sql": " ".join(sql.split())[:MAX_SQL_CHARS],
+            "parameters": parameter_shape(parameters),
+            "duration_ms": round(elapsed * 1000, 3),
+            "rows": rows,
+            "plan": plan,
+            "flags": flags,
+        }
+        _entries.append(entry)
+        _totals["kept"] += 1
+        _totals["flagged"] += bool(flags)
+    return entry
+
+
+def entries(flagged_only=False, limit=None):
+    """Logged statements, newest first."""
+    with _lock:
+        logged = [dict(entry) for entry in reversed(_entries) if entry["flags"] or not flagged_only]
+    return logged[:limit] if limit else logged
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _plans.clear()
+
+
+def stats():
+    with _lock:
+        return {**_totals, "logged": len(_entries)}
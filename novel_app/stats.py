@@ -0,0 +1,110 @@
+"""Denormalized engagement counters.
+
+novel_stats holds one row per novel with like, comment and wishlist
+counts. Triggers on likes, comments and wishlists update it inside the
+writer's own transaction, so every write path (single inserts, deletes,
+batch jobs) keeps it exact without COUNT(*) scans at read time.
+"""
+from catalog import SUMMARY_COLUMNS
+
+# Engagement table (and leaderboard name) -> counter column
+COUNTERS = {
+    "likes": "like_count",
+    "comments": "comment_count",
+    "wishlists": "wishlist_count",
+}
+
+
+def _triggers(table, column):
+    return (
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_stats_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO novel_stats (novel_id, {column}) VALUES (new.novel_id, 1)
+                ON CONFLICT (novel_id) DO UPDATE SET {column} = {column} + 1;
+            END
+        """,
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_stats_delete AFTER DELETE ON {table} BEGIN
+                UPDATE novel_stats SET {column} = MAX({column} - 1, 0) WHERE novel_id = old.novel_id;
+            END
+        """,
+    )
+
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS novel_stats (
+            novel_id INTEGER PRIMARY KEY,
+            like_count INTEGER NOT NULL DEFAULT 0,
+            comment_count INTEGER NOT NULL DEFAULT 0,
+            wishlist_count INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (novel_id) REFERENCES novels(id)
+        )
+    """,
+    # Leaderboards walk these indexes in order and stop after LIMIT rows
+    "CREATE INDEX IF NOT EXISTS idx_novel_stats_likes ON novel_stats (like_count DESC, novel_id)",
+    "CREATE INDEX IF NOT EXISTS idx_novel_stats_comments ON novel_stats (comment_count DESC, novel_id)",
+    "CREATE INDEX IF NOT EXISTS idx_novel_stats_wishlists ON novel_stats (wishlist_count DESC, novel_id)",
+    """CREATE TRIGGER IF NOT EXISTS novels_stats_delete AFTER DELETE ON novels BEGIN
+            DELETE FROM novel_stats WHERE novel_id = old.id;
+        END
+    """,
+    *(statement for table, column in COUNTERS.items() for statement in _triggers(table, column)),
+)
+
+
+# Novels recounted per transaction by rebuild_stats
+BATCH_SIZE = 5000
+
+
+def create_stats(db):
+    """Create novel_stats and its triggers, counting existing rows.
+
+    This only runs while the migration is unrecorded, and rebuild_stats sets
+    counts rather than adding to them, so an interrupted backfill starts over
+    cleanly.
+    """
+    for statement in SCHEMA:
+        db.execute(statement)
+    # The recount looks rows up by novel; migration 5 keeps the first two, the wishlists one is dropped after
+    db.execute("CREATE INDEX IF NOT EXISTS idx_likes_novel_id ON likes (novel_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_comments_novel_id ON comments (novel_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_wishlists_stats_backfill ON wishlists (novel_id)")
+    db.commit()
+    rebuild_stats(db)
+    db.execute("DROP INDEX IF EXISTS idx_wishlists_stats_backfill")
+
+
+def rebuild_stats(db, batch_size=BATCH_SIZE):
+    """Recount everything from the engagement tables, one range of novel ids per transaction.
+
+    The triggers are live meanwhile. Every batch sets its counts from
+    COUNT(*) under the write lock, so rows the triggers already counted are
+    not counted twice.
+    """
+    last_id = 0
+    max_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM novels").fetchone()[0]
+    while last_id < max_id:
+        bounds = (last_id, last_id + batch_size)
+        db.execute("INSERT OR IGNORE INTO novel_stats (novel_id) SELECT id FROM novels WHERE id > ? AND id <= ?",
+                   bounds)
+        for table, column in COUNTERS.items():
+            db.execute(f"""
+                UPDATE novel_stats SET {column} = (
+                    SELECT COUNT(*) FROM {table} WHERE {table}.novel_id = novel_stats.novel_id
+                )
+                WHERE novel_id > ? AND novel_id <= ?
+            """, bounds)
+        db.commit()
+        last_id += batch_size
+
+
+def top_novels(db, by, limit):
+    """Most engaged novels, read in order straight off the counter index."""
+    column = COUNTERS[by]
+    # CROSS JOIN keeps novel_stats as the outer loop so the index drives the ORDER BY
+    rows = db.execute(
+        f"SELECT {SUMMARY_COLUMNS} FROM novel_stats "
+        f"CROSS JOIN novels ON novels.id = novel_stats.novel_id "
+        f"LEFT JOIN users ON users.id = novels.user_id "
+        f"WHERE novel_stats.{column} > 0 ORDER BY novel_stats.{column} DESC, novel_stats.novel_id LIMIT ?",
+        (limit,),
+    ).fetchall()
+    return [dict(row) for row in rows]
@@ -0,0 +1,291 @@
+"""Contract checks every storage backend has to pass.
+
+Runs the repository, catalog, stats, token, write queue and streaming
+functions the routes use against one backend and compares what comes
+back. The same checks run for SQLite and MySQL, so a difference between
+the two shows up here and not in production:
+
+    python storage_contract.py --backend sqlite
+    python storage_contract.py --backend mysql --mysql-url mysql://root@127.0.0.1:3306/novel_contract
+
+SQLite runs on a temporary file. MySQL runs on the database in the URL,
+which should be a scratch one: rows created by the checks are deleted
+afterwards, but the tables are created if missing. Exits with 1 if any
+check fails.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+LONG_TEXT = "".join(
+    f"Chapter {number}\n\n" + "The river rose in the night and the lanterns went out. " * 120 + "\n"
+    for number in range(1, 4)
+)
+
+
+class Contract:
+    def __init__(self):
+        self.failures = []
+
+    def check(self, name, condition, detail=""):
+        print(f"{'ok  ' if condition else 'FAIL'} {name}{'' if condition else f': {detail}'}")
+        if not condition:
+            self.failures.append(name)
+
+
+def run(contract, db):
+    import catalog
+    import repository
+    import stats
+    import tokens
+    from chapters import write_chapter
+    from database import BACKEND, ConnectionPool
+    from writes import WriteQueue
+
+    suffix = uuid.uuid4().hex[:8]
+    author = repository.create_user(db, f"author-{suffix}", f"author-{suffix}@example.com", b"$2b$04$hash")
+    reader = repository.create_user(db, f"reader-{suffix}", f"reader-{suffix}@example.com", b"$2b$04$hash")
+    db.commit()
+    try:
+        user = repository.find_user(db, f"author-{suffix}")
+        contract.check("users round trip", user is not None and user["id"] == author and bytes(user["password"])
+                       == b"$2b$04$hash", repr(user and dict(user)))
+
+        novel_id = repository.create_novel(db, author, "Lanterns", "A river story", LONG_TEXT)
+        db.commit()
+        novel = repository.get_novel(db, novel_id)
+        contract.check("novel text round trip", novel is not None and novel["content"] == LONG_TEXT)
+        contract.check("novel split into chapters", novel is not None and len(novel["chapters"]) == 3,
+                       repr(novel and novel["chapters"]))
+        contract.check("novel etag derived", novel is not None and len(novel["content_etag"] or "") == 64)
+
+        contract.check("update by another user refused",
+                       not repository.update_novel(db, novel_id, reader, "Stolen", "", "x"))
+        contract.check("update without changes still matches",
+                       repository.update_novel(db, novel_id, author, "Lanterns", "A river story", LONG_TEXT))
+        db.commit()
+
+        write_chapter(db, novel_id, 2, None, "A short second chapter.")
+        write_chapter(db, novel_id, 4, "Epilogue", "And then it was morning.")
+        db.commit()
+        chapter = repository.get_chapter(db, novel_id, 2)
+        contract.check("chapter upsert keeps title", chapter is not None and chapter["title"] == "Chapter 2"
+                       and chapter["content"] == "A short second chapter.\n\n", repr(chapter))
+        contract.check("chapter append", repository.chapter_count(db, novel_id) == 4)
+        contract.check("missing chapter", repository.get_chapter(db, novel_id, 9) is None)
+
+        first = db.execute(repository.ADD_LIKE, (novel_id, reader)).rowcount
+        again = db.execute(repository.ADD_LIKE, (novel_id, reader)).rowcount
+        db.execute(repository.ADD_TO_WISHLIST, (novel_id, reader))
+        db.commit()
+        contract.check("like once, then ignored", (first, again) == (1, 0), repr((first, again)))
+
+        queue = WriteQueue(flush_interval=0.001)
+        try:
+            results = [queue.submit(repository.ADD_COMMENT, (novel_id, reader, f"comment {i}")) for i in range(3)]
+        finally:
+            queue.stop()
+        contract.check("write queue commits", results == [1, 1, 1], repr(results))
+        check_write_failures(contract, repository.ADD_COMMENT, (novel_id, reader, "late comment"))
+
+        page = catalog.list_novel_summaries(db, None, 100, user_id=author)
+        summary = next((item for item in page["items"] if item["id"] == novel_id), None)
+        contract.check("counters follow engagement", summary is not None and
+                       (summary["like_count"], summary["comment_count"], summary["wishlist_count"]) == (1, 3, 1),
+                       repr(summary))
+        contract.check("summary shows author", summary is not None and summary["author"] == f"author-{suffix}")
+
+        batch = catalog.fetch_novels(db, [novel_id, -1, novel_id], "full")
+        contract.check("batch keeps order and gaps", batch["missing"] == [-1] and batch["items"][1] is None
+                       and batch["items"][0]["id"] == batch["items"][2]["id"] == novel_id)
+        contract.check("batch full text", batch["items"][0] is not None and
+                       batch["items"][0]["content"] == repository.get_novel(db, novel_id)["content"])
+        ids = ",".join(str(novel_id) for _ in range(catalog.MAX_FULL_BATCH_IDS + 1))
+        contract.check("full batch has its own cap", rejected(catalog.parse_ids, ids, "full")
+                       and not rejected(catalog.parse_ids, ids, "summary")
+                       and not rejected(catalog.check_ids, [novel_id] * catalog.MAX_FULL_BATCH_IDS, "full"))
+
+        top = stats.top_novels(db, "comments", 100)
+        contract.check("leaderboard reads counters", any(row["id"] == novel_id for row in top))
+
+        repository.remove_like(db, novel_id, reader)
+        repository.remove_from_wishlist(db, novel_id, reader)
+        db.commit()
+        summary = catalog.fetch_novels(db, [novel_id])["items"][0]
+        contract.check("counters follow removals", (summary["like_count"], summary["wishlist_count"]) == (0, 0),
+                       repr(summary))
+
+        payload = {"jti": f"contract-{suffix}", "exp": int(time.time()) + 60}
+        revoked = tokens.revoke(db, payload), tokens.revoke(db, payload)
+        db.execute("DELETE FROM revoked_tokens WHERE jti = ?", (payload["jti"],))
+        db.commit()
+        contract.check("revoke once", revoked == (True, False), repr(revoked))
+
+        pool = ConnectionPool(size=1)
+        try:
+            with pool.connection() as pooled:
+                pooled.execute("UPDATE novels SET title = ? WHERE id = ?", ("Uncommitted", novel_id))
+            with pool.connection() as pooled:
+                title = pooled.execute("SELECT title FROM novels WHERE id = ?", (novel_id,)).fetchone()["title"]
+            contract.check("pool rolls back unfinished transactions", title == "Lanterns", title)
+        finally:
+            pool.close()
+
+        if BACKEND == "sqlite":
+            # Downloads read chapters through SQLite blob handles
+            check_download(contract, novel_id)
+        check_export(contract)
+
+        contract.check("delete by another user refused", not repository.delete_novel(db, novel_id, reader))
+        contract.check("delete by author", repository.delete_novel(db, novel_id, author))
+        db.commit()
+        contract.check("deleted novel is gone", repository.get_novel(db, novel_id) is None
+                       and not repository.novel_exists(db, novel_id))
+        contract.check("deleted novel leaves no counters",
+                       db.execute("SELECT COUNT(*) FROM novel_stats WHERE novel_id = ?", (novel_id,)).fetchone()[0]
+                       == 0)
+    finally:
+        db.rollback()
+        for table in ("likes", "comments", "wishlists"):
+            db.execute(f"DELETE FROM {table} WHERE user_id IN (?, ?)", (author, reader))
+        db.execute("DELETE FROM novel_chapters WHERE novel_id IN (SELECT id FROM novels WHERE user_id = ?)",
+                   (author,))
+        db.execute("DELETE FROM novels WHERE user_id = ?", (author,))
+        repository.delete_user(db, author)
+        repository.delete_user(db, reader)
+        db.commit()
+
+
+def rejected(call, *args):
+    from fastapi import HTTPException
+
+    try:
+        call(*args)
+    except HTTPException as error:
+        return error.status_code == 400
+    return False
+
+
+class StuckPool:
+    """Write pool stand-in whose connections hang for a while, then fail."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    @contextmanager
+    def connection(self):
+        time.sleep(self.delay)
+        raise RuntimeError("no connection")
+        yield
+
+
+def check_write_failures(contract, sql, params):
+    from fastapi import HTTPException
+    from writes import WriteQueue
+
+    queue = WriteQueue(connections=StuckPool(0.2), flush_interval=0.001, commit_timeout=0.05)
+    try:
+        try:
+            queue.submit(sql, params)
+            status = None
+        except HTTPException as error:
+            status = error.status_code
+        contract.check("slow write batch answers 503", status == 503, repr(status))
+        queue.commit_timeout = 5
+        try:
+            queue.submit(sql, params)
+            failure = None
+        except Exception as error:
+            failure = error
+        contract.check("writer survives a failed batch", isinstance(failure, RuntimeError)
+                       and queue._thread is not None and queue._thread.is_alive(), repr(failure))
+    finally:
+        queue.stop()
+
+
+class FakeRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+def check_download(contract, novel_id):
+    from database import ConnectionPool
+    from downloads import stream_novel
+    from repository import get_novel
+
+    pool = ConnectionPool(size=2, readonly=True)
+    try:
+        response = stream_novel(FakeRequest(), novel_id, connections=pool)
+        # A client gone before the first chunk, the server drops the body unread
+        response.body_iterator.close()
+        stats = pool.stats()
+        contract.check("abandoned download holds no connection", stats["idle"] == stats["open"], repr(stats))
+
+        response = stream_novel(FakeRequest(), novel_id, connections=pool)
+        body = b"".join(response.body_iterator)
+        with pool.connection() as db:
+            content = get_novel(db, novel_id)["content"].encode("utf-8")
+        contract.check("download matches novel text", body == content
+                       and int(response.headers["Content-Length"]) == len(content), f"{len(body)} != {len(content)}")
+        stats = pool.stats()
+        contract.check("finished download returns its connection", stats["idle"] == stats["open"], repr(stats))
+    finally:
+        pool.close()
+
+
+def check_export(contract):
+    from database import ConnectionPool
+    from export import stream_export
+
+    pool = ConnectionPool(size=2, readonly=True)
+    try:
+        response = stream_export(FakeRequest(), "novels", None, connections=pool)
+        response.body_iterator.close()
+        stats = pool.stats()
+        contract.check("abandoned export holds no connection", stats["idle"] == stats["open"], repr(stats))
+
+        response = stream_export(FakeRequest(), "novels", None, connections=pool)
+        lines = b"".join(response.body_iterator).splitlines()
+        contract.check("export ends with its watermark", bool(lines) and b'"type":"watermark"' in lines[-1],
+                       repr(lines[-1:]))
+        stats = pool.stats()
+        contract.check("finished export returns its connection", stats["idle"] == stats["open"], repr(stats))
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the storage contract checks against one backend")
+    parser.add_argument("--backend", choices=["sqlite", "mysql"], default=os.environ.get("NOVEL_DB_BACKEND", "sqlite"))
+    parser.add_argument("--mysql-url", help="defaults to NOVEL_MYSQL_URL")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Both are read when database and mysql_backend are imported
+        os.environ["NOVEL_DB_BACKEND"] = args.backend
+        os.environ["NOVEL_DB_PATH"] = os.path.join(tmp, "contract.db")
+        if args.mysql_url:
+            os.environ["NOVEL_MYSQL_URL"] = args.mysql_url
+
+        import repository
+        from database import open_connection
+
+        db = open_connection()
+        repository.migrate(db)
+        contract = Contract()
+        try:
+            run(contract, db)
+        finally:
+            db.close()
+
+    print(f"\n{args.backend}: {len(contract.failures)} of the checks failed" if contract.failures
+          else f"\n{args.backend}: all checks passed")
+    sys.exit(1 if contract.failures else 0)
+
+
+if __name__ == "__main__":
+    main()
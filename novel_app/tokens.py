@@ -0,0 +1,201 @@
+"""JWT access and refresh tokens with a verified-token cache.
+
+Access tokens are short lived and used on every authenticated call.
+Refresh tokens only buy new access tokens. Both carry exp and a jti, so
+they can be cached and revoked.
+
+Once a token has been verified, its sha256 digest maps to (user_id, jti,
+expiry) in a bounded LRU. Later calls with the same token are one dict
+lookup. An entry never outlives the token's exp, and revoking a jti drops
+its entries.
+
+Revocations are published to the other serve.py workers through
+coherence.py, which drop the token from their caches as well.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import jwt
+from fastapi import HTTPException
+
+import coherence
+
+SECRET_KEY = os.environ.get("NOVEL_SECRET_KEY", "my_secret_key")
+ALGORITHM = "HS256"
+
+ACCESS_TOKEN_TTL = int(os.environ.get("NOVEL_ACCESS_TOKEN_TTL", 15 * 60))
+REFRESH_TOKEN_TTL = int(os.environ.get("NOVEL_REFRESH_TOKEN_TTL", 30 * 24 * 3600))
+
+CACHE_SIZE = int(os.environ.get("NOVEL_TOKEN_CACHE_SIZE", 10000))
+
+# Comma separated ids of the users allowed on operator endpoints
+ADMIN_USERS = {int(user_id) for user_id in os.environ.get("NOVEL_ADMIN_USERS", "").split(",") if user_id.strip()}
+
+
+class TokenCache:
+    """LRU of verified tokens, each entry expiring with its token."""
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return entry
+
+    def put(self, digest, user_id, jti, expires_at):
+        with self._lock:
+            self._entries[digest] = (user_id, jti, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_jti(self, jti):
+        with self._lock:
+            for digest in [digest for digest, entry in self._entries.items() if entry[1] == jti]:
+                del self._entries[digest]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = TokenCache()
+
+# jti -> exp of every revoked token that has not expired yet
+_revoked = {}
+_revoked_lock = threading.Lock()
+
+
+def _issue(user_id: int, token_type: str, ttl: int):
+    now = int(time.time())
+    payload = {"user_id": user_id, "type": token_type, "jti": uuid.uuid4().hex, "iat": now, "exp": now + ttl}
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def create_user_token(user_id: int):
+    return _issue(user_id, "access", ACCESS_TOKEN_TTL)
+
+
+def create_refresh_token(user_id: int):
+    return _issue(user_id, "refresh", REFRESH_TOKEN_TTL)
+
+
+def _digest(token: str):
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def is_revoked(jti):
+    coherence.sync()
+    with _revoked_lock:
+        return jti in _revoked
+
+
+def decode_token(token: Optional[str], token_type: str = "access"):
+    """Fully verify a token and return its payload, bypassing the cache."""
+    if token is None:
+        raise HTTPException(status_code=401, detail="Token is required")
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp", "jti"]})
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("type") != token_type:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if is_revoked(payload["jti"]):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    return payload
+
+
+# Verify JWT token
+def verify_token(token: Optional[str]):
+    if token is None:
+        raise HTTPException(status_code=401, detail="Token is required")
+    digest = _digest(token)
+    # Tokens another worker revoked have to leave the cache before it is trusted
+    coherence.sync()
+    entry = cache.get(digest)
+    if entry is not None:
+        return entry[0]
+
+    payload = decode_token(token)
+    cache.put(digest, payload["user_id"], payload["jti"], payload["exp"])
+    return payload["user_id"]
+
+
+def is_admin(user_id):
+    return user_id in ADMIN_USERS
+
+
+def verify_admin(token: Optional[str]):
+    """verify_token for operator endpoints, refused unless the user is in NOVEL_ADMIN_USERS."""
+    user_id = verify_token(token)
+    if not is_admin(user_id):
+        raise HTTPException(status_code=403, detail="Operator access required")
+    return user_id
+
+
+def load_revocations(db):
+    """Drop expired revocations and load the rest, called on startup."""
+    now = int(time.time())
+    db.execute("DELETE FROM revoked_tokens WHERE expires_at <= ?", (now,))
+    db.commit()
+    read_revocations(db)
+
+
+def read_revocations(db):
+    """Replace the revocations and cached tokens of this process with what db holds."""
+    with _revoked_lock:
+        _revoked.clear()
+        _revoked.update(db.execute("SELECT jti, expires_at FROM revoked_tokens").fetchall())
+    cache.clear()
+
+
+def _forget(jti, expires_at):
+    with _revoked_lock:
+        now = time.time()
+        for revoked_jti in [revoked_jti for revoked_jti, expiry in _revoked.items() if expiry <= now]:
+            del _revoked[revoked_jti]
+        _revoked[jti] = expires_at
+    cache.discard_jti(jti)
+
+
+def apply_revocation(message):
+    """A revocation published by another worker, as "<jti> <exp>"."""
+    jti, expires_at = message.split()
+    _forget(jti, int(expires_at))
+
+
+def revoke(db, payload):
+    """Revoke a decoded token until it would have expired anyway.
+
+    Caller commits, then calls publish_revocation. Returns False when the
+    token had already been revoked.
+    """
+    return db.execute(
+        "INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)", (payload["jti"], payload["exp"])
+    ).rowcount == 1
+
+
+def publish_revocation(payload):
+    """Apply a committed revocation to this worker and publish it to the others.
+
+    Until the commit, a rolled back revocation would leave the token refused
+    by every cache while the database still accepts it.
+    """
+    _forget(payload["jti"], payload["exp"])
+    coherence.publish("revoked", f"{payload['jti']} {payload['exp']}")
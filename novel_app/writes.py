@@ -0,0 +1,183 @@
+"""Group commit for small engagement inserts.
+
+Likes, comments and wishlist entries are queued to one writer thread. The
+writer collects rows for up to FLUSH_INTERVAL or BATCH_ROWS, whichever
+comes first, and commits them in a single transaction. SQLite then sees
+one writer doing one commit per batch, not a connection and a commit
+per click.
+
+Callers pick the durability they need:
+
+    "commit"  wait until the row's batch has committed (default)
+    "async"   return once the row is queued; lost if the process dies first
+
+A full queue rejects new writes with 503 rather than letting requests pile
+up, and so does a "commit" write whose batch has not committed within
+COMMIT_TIMEOUT. stop() drains everything still queued before returning.
+The writer connection is borrowed from the write pool per batch, so with
+SQLite the queue and the handlers that write directly take turns on one
+connection.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as ResultTimeout
+
+from fastapi import HTTPException
+
+import metrics
+from database import DatabaseError, pool
+
+BATCH_ROWS = int(os.environ.get("NOVEL_WRITE_BATCH_ROWS", 256))
+FLUSH_INTERVAL = float(os.environ.get("NOVEL_WRITE_FLUSH_MS", 2)) / 1000
+QUEUE_SIZE = int(os.environ.get("NOVEL_WRITE_QUEUE_SIZE", 10000))
+# How long a request may wait for room in a full queue before getting 503
+ENQUEUE_TIMEOUT = 0.25
+# How long a "commit" write waits for its batch before getting 503, the row may still commit later
+COMMIT_TIMEOUT = float(os.environ.get("NOVEL_WRITE_COMMIT_TIMEOUT", 5))
+
+_STOP = object()
+
+
+class WriteQueue:
+    def __init__(self, connections=pool, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE,
+                 commit_timeout=COMMIT_TIMEOUT):
+        self.connections = connections
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.commit_timeout = commit_timeout
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="novel-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Flush everything queued so far and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def submit(self, sql, params=(), durability="commit", on_commit=None):
+        """Queue one statement. With "commit" durability, wait for it and return its rowcount.
+
+        on_commit is called from the writer thread once the row has committed.
+        """
+        if self._thread is None:
+            self.start()
+        future = Future() if durability == "commit" else None
+        try:
+            self._queue.put((sql, params, future, on_commit), timeout=ENQUEUE_TIMEOUT)
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Server busy, try again shortly", headers={"Retry-After": "1"})
+        if future is not None:
+            try:
+                return future.result(timeout=self.commit_timeout)
+            except ResultTimeout:
+                raise HTTPException(status_code=503, detail="Server busy, try again shortly",
+                                    headers={"Retry-After": "1"})
+        return None
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_rows:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch, stopping = self._collect(item)
+            self._flush(batch)
+        # Drain whatever was queued behind the stop marker
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        for start in range(0, len(leftover), self.batch_rows):
+            self._flush(leftover[start:start + self.batch_rows])
+
+    def _flush(self, batch):
+        results = None
+        try:
+            with self.connections.connection() as db, metrics.database_time("write_queue"):
+                results = self._write(db, batch)
+        except Exception as e:
+            # Fail this batch, not the writer thread and every caller queued behind it
+            logging.error(f"Write batch of {len(batch)} rows failed: {e}")
+            if results is None:
+                results = [(future, None, None, e) for _, _, future, _ in batch]
+        self._deliver(results)
+
+    def pending(self):
+        """Writes queued and not picked up by the writer yet."""
+        return self._queue.qsize()
+
+    def _write(self, db, batch):
+        results = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for sql, params, future, on_commit in batch:
+                # A savepoint per row, so one bad row does not fail its neighbours
+                db.execute("SAVEPOINT queued_write")
+                try:
+                    rowcount = db.execute(sql, params).rowcount
+                    db.execute("RELEASE queued_write")
+                    results.append((future, on_commit, rowcount, None))
+                except Exception as e:
+                    db.execute("ROLLBACK TO queued_write")
+                    db.execute("RELEASE queued_write")
+                    results.append((future, None, None, e))
+            db.commit()
+        except DatabaseError as e:
+            logging.error(f"Write batch of {len(batch)} rows failed: {e}")
+            if db.in_transaction:
+                db.rollback()
+            results = [(future, None, None, e) for _, _, future, _ in batch]
+        return results
+
+    def _deliver(self, results):
+        for future, on_commit, rowcount, error in results:
+            if on_commit is not None:
+                try:
+                    on_commit()
+                except Exception as e:
+                    logging.error(f"on_commit callback failed: {e}")
+            if future is None:
+                if error is not None:
+                    logging.error(f"Queued write failed: {error}")
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(rowcount)
+
+
+writer = WriteQueue()